@@ -0,0 +1,5 @@
+__version__ = "0.4.10a3"
+
+from .api import UpgradePolicy, convert, export_layers, export_terrain, make_config, transform, upgrade
+
+__all__ = ["UpgradePolicy", "convert", "export_layers", "export_terrain", "make_config", "transform", "upgrade"]
@@ -1,25 +1,45 @@
 #!/usr/bin/env python3
 import argparse
-import json
 import logging
+import multiprocessing
 import re
 import sys
-from dataclasses import dataclass
 from pathlib import Path
 from platform import python_version
 # from subprocess import run
 from time import time
-from typing import Any, Optional, Union
-from zipfile import ZipFile
+from typing import Any, Callable, Dict, List, Optional, Union
+
+if not __package__:
+    # started as `python mapper` or as frozen script, directory is imported as package for relative imports
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    __package__ = "mapper"
 
 import colorama
 from appdirs import AppDirs
-from base import CONFIG_FILE, CONTACTS, DEFAULT_TOML, ActionHandler, GameDefs, GameVer, MapperConfig
-from maps.format import INTERNAL_ARC_NAME, TimberbornMap, TimberbornSingletons
-from maps.gamemap import is_game_map, is_game_save, read_game_map, read_terrain, ascii_preview
-from maps.heightmap import ImageToTimberbornHeightmapLinearConversionSpec, ImageToTimberbornHeightmapSpec, read_heightmap
-from maps.treemap import ImageToTimberbornTreemapSpec, read_tree_map
-from maps.watermap import read_water_map
+
+from . import __version__
+from .base import CONFIG_FILE, CONTACTS, DEFAULT_TOML, ActionHandler, GameDefs, GameVer, MapperConfig
+from .benchmark import BENCHMARK_DENSITIES, BENCHMARK_SIZES, benchmark_upgrade
+from .conversion import ImageToTimberbornSpec, ImageToTimberbornWatermapSpec, add_map_stages, conversion_fingerprint
+from .maps import codec
+from .maps.codec import JSON_BACKENDS
+from .maps.diff import diff_map, patch_map
+from .maps.format import TimberbornMap
+from .maps.gamemap import ascii_preview, is_game_map, is_game_save, load_map_file, read_game_map, read_map_bytes, read_terrain
+from .maps.heightmap import ImageToTimberbornHeightmapLinearConversionSpec, ImageToTimberbornHeightmapSpec
+from .maps.lakes import LakeSpec
+from .maps.layers import export_library, write_layers
+from .maps.library import index_library
+from .maps.terrain import patch_terrain
+from .maps.transform import transform_map
+from .maps.treemap import ImageToTimberbornTreemapSpec
+from .memory import MemoryBudget, format_size, peak_rss
+from .output import is_up_to_date
+from .pipeline import StageGraph
+from .progress import PROGRESS_SINKS, make_sink, set_sink
+from .session import MapSession
+from .sweep import expand_sweep, is_sweep
 
 try:
     import tomllib
@@ -34,11 +54,10 @@ else:
 # |_|  |_\__,_|_|_||_|
 # Main
 
-__version__ = "0.4.10a3"
-
 APPNAME = "TimberbornMapper"
 # Original script creator
 APP_AUTHOR = "MattMcMullan"
+LIBRARY_DB_FILE = "library.sqlite"
 
 
 R = colorama.Style.RESET_ALL
@@ -49,70 +68,46 @@ BOLD = colorama.Style.BRIGHT
 CODE = colorama.Back.WHITE + colorama.Fore.BLACK
 
 
-@dataclass
-class ImageToTimberbornWatermapSpec:
-    filename: str
-
+def int_or_default(value: str) -> Union[int, str]:
+    """ argparse type of int options that default to 'DEFAULT', so values from config file are not overridden """
+    return value if value == "DEFAULT" else int(value)
 
-class ImageToTimberbornSpec:
-    def __init__(
-        self,
-        heightmap: Union[ImageToTimberbornHeightmapSpec, dict],
-        width: int = -1,  # XXX should use optional instead of sentinel value
-        height: int = -1,
-        treemap: Union[Optional[ImageToTimberbornTreemapSpec], dict] = None,
-        watermap: Union[Optional[ImageToTimberbornWatermapSpec], dict] = None,
-    ):
-        self.width = width
-        self.height = height
 
-        if isinstance(heightmap, dict):
-            heightmap = ImageToTimberbornHeightmapSpec(**heightmap)
-        self.heightmap = heightmap
+def write_to(output_path: Path, config: Any, fingerprint: Optional[str] = None) -> Callable[[TimberbornMap], Path]:
+    return lambda timber_map: timber_map.write(output_path, config, fingerprint)
 
-        if isinstance(treemap, dict):
-            treemap = ImageToTimberbornTreemapSpec(**treemap)
-        self.treemap = treemap
 
-        if isinstance(watermap, dict):
-            watermap = ImageToTimberbornWatermapSpec(**watermap)
-        self.watermap = watermap
-
-    width: int
-    height: int
-    heightmap: ImageToTimberbornHeightmapSpec
-    treemap: Optional[ImageToTimberbornTreemapSpec]
-    watermap: Optional[ImageToTimberbornWatermapSpec]
+def up_to_date(output_path: Path, fingerprint: str, config: Any) -> bool:
+    """ with `--skip-up-to-date`, whether map at output path was already made from the same inputs """
+    timber_path = output_path.with_suffix(GameDefs.MAP_SUFFIX.value)
+    if config.skip_up_to_date and is_up_to_date(timber_path, fingerprint):
+        logging.info(f"'{timber_path}' is up to date, skipped")
+        return True
+    return False
 
 
 def image_to_timberborn(spec: ImageToTimberbornSpec, path: Path, output_path: Path, args: Any) -> Path:
     config = args
 
     logging.info(f"Output dir: `{output_path.parent}`")
-
-    t = -time()
-    heightmap = read_heightmap(width=spec.width, height=spec.height, spec=spec.heightmap, path=path, args=config)
-    logging.info(f"Finished in {t + time():.2f} sec.")
-
-    t = -time()
-    if spec.watermap is None:
-        water_map = read_water_map(heightmap, None, None)
-    else:
-        water_map = read_water_map(heightmap, filename=spec.watermap.filename, path=path)
-    logging.info(f"Finished water map in {t + time():.2f} sec.")
-
-    t = -time()
-    tree_map = read_tree_map(heightmap, water_map, spec=spec.treemap, path=path)
-    logging.info(f"Finished tree map in {t + time():.2f} sec.")
-
-    singletons = TimberbornSingletons(
-        MapSize=heightmap.map_size,
-        SoilMoistureSimulator=water_map.soil_moisture_simulator,
-        TerrainMap=heightmap.terrain_map,
-        WaterMap=water_map.water_map,
-    )
-    timber_map = TimberbornMap(config.game_version, singletons, tree_map.entities, MapperVersion=__version__)
-    timber_path = timber_map.write(output_path, config)
+    if config.seed is not None:
+        logging.info(f"Random seed: {config.seed}")
+
+    fingerprint = conversion_fingerprint(spec, path.joinpath, config)
+    if up_to_date(output_path, fingerprint, config):
+        return output_path.with_suffix(GameDefs.MAP_SUFFIX.value)
+
+    budget = MemoryBudget.from_config(config.max_memory)
+    # memory estimates assume one image is decoded at a time, so stages don't overlap under a limit
+    graph = StageGraph(workers=1 if budget.is_limited else 0)
+    final_stage = add_map_stages(graph, spec, path.joinpath, write_to(output_path, config, fingerprint), str(output_path),
+                                 config, budget, shared={})
+    timber_path = graph.run()[final_stage]
+    graph.report_timings()
+
+    rss = peak_rss()
+    if rss:
+        logging.debug(f"Peak memory usage: {format_size(rss)}")
     print(f"\nSaved to '{timber_path}'\nYou can now open it in Timberborn map editor to add finishing touches.")
     return timber_path
 
@@ -132,6 +127,14 @@ def make_output_path(args: Any, suffix=GameDefs.MAP_SUFFIX.value) -> Path:
     return output_path
 
 
+def make_layers_path(args: Any) -> Path:
+    """ spec file of exported layers, layer images are written next to it """
+    if args.output:
+        output_path = args.output if args.output.is_absolute() else Path.cwd() / args.output
+        return output_path.with_suffix(".json")
+    return args.input.with_name(f"{args.input.stem}_spec.json")
+
+
 def manual_image_to_timberborn(args: Any) -> None:
     treemap = None
     if args.treemap is not None:
@@ -140,6 +143,9 @@ def manual_image_to_timberborn(args: Any) -> None:
             treeline_cutoff=args.treeline_cutoff,
             birch_cutoff=args.birch_cutoff,
             pine_cutoff=args.pine_cutoff,
+            placement=args.tree_placement,
+            spacing=args.tree_spacing,
+            density=args.tree_density,
         )
 
     watermap = None
@@ -148,6 +154,10 @@ def manual_image_to_timberborn(args: Any) -> None:
             filename=args.water_map,
         )
 
+    lakes = None
+    if args.lakes:
+        lakes = LakeSpec(min_basin_size=args.lake_min_size, water_level=args.lake_level)
+
     output_path = make_output_path(args)
 
     image_to_timberborn(
@@ -164,6 +174,7 @@ def manual_image_to_timberborn(args: Any) -> None:
             ),
             treemap=treemap,
             watermap=watermap,
+            lakes=lakes,
         ),
         args.input.parent,
         output_path,
@@ -171,35 +182,29 @@ def manual_image_to_timberborn(args: Any) -> None:
     )
 
 
+def benchmark_json(path: Path) -> None:
+    text = read_map_bytes(path)
+    print(f"Map JSON: {format_size(len(text))}")
+    results = codec.benchmark(text)
+    baseline = results[0]
+    for result in results:
+        print(
+            f"{result['codec']: >8}: decode {result['decode']:.3f} sec. ({baseline['decode'] / result['decode']:.1f}x), "
+            f"encode {result['encode']:.3f} sec. ({baseline['encode'] / result['encode']:.1f}x), "
+            f"output {'identical' if result['identical'] else 'DIFFERENT'}"
+        )
+
+
 def read_json_input(config: Any) -> None:
-    if config.input.suffix.lower() == GameDefs.MAP_SUFFIX.value:
-        with ZipFile(config.input) as timber_zip:
-            namelist = timber_zip.namelist()
-            if INTERNAL_ARC_NAME in namelist:
-                world_file_name = INTERNAL_ARC_NAME
-            else:
-                world_file_name = ""
-                logging.warning(
-                    f'"{config.input.basename}" doesn\'t include "{INTERNAL_ARC_NAME}"! Will use first ".json" file'
-                )
-                for name in namelist:
-                    if name.endswith(".json"):
-                        world_file_name = name
-                if not world_file_name:
-                    logging.error("No suitable file found!")
-                    raise RuntimeError("Input file doesn't contain expected data")
-
-            with timber_zip.open(world_file_name, "r") as world_file:
-                data = json.loads(world_file.read())
-    else:
-        with open(config.input, "r") as f:
-            data = json.load(f)
+    data = load_map_file(config.input)
 
     action_handler = ActionHandler()
 
     if "heightmap" in data.keys():
         logging.info("Found key 'heightmap' in json data, processing as spec file")
         specfile_to_timberborn(data, config)
+    elif is_game_map(data) and config.export_layers:
+        write_layers(data, make_layers_path(config))
     elif is_game_map(data):
         action_handler.add_action(
             code="export-terrain",
@@ -215,6 +220,39 @@ def read_json_input(config: Any) -> None:
             args=(data, config),
             kwargs={}
         )
+        if config.compare:
+            action_handler.add_action(
+                code="diff-map",
+                description=f"{BOLD}[BETA]{R} Compare with '{config.compare}' (input is treated as newer map)",
+                function=diff_map,
+                args=(data, config),
+                kwargs={'output_path': make_output_path(config, suffix='.json')}
+            )
+        if config.patch:
+            action_handler.add_action(
+                code="apply-patch",
+                description=f"{BOLD}[BETA]{R} Apply patch '{config.patch}' and pack as '{GameDefs.MAP_SUFFIX.value}'",
+                function=patch_map,
+                args=(data, config),
+                kwargs={'output_path': make_output_path(config)}
+            )
+        if config.terrain:
+            action_handler.add_action(
+                code="patch-terrain",
+                description=f"{BOLD}[BETA]{R} Replace terrain with '{config.terrain}', keeping entities, and pack as "
+                            f"'{GameDefs.MAP_SUFFIX.value}'",
+                function=patch_terrain,
+                args=(data, config),
+                kwargs={'output_path': make_output_path(config)}
+            )
+        if config.transform:
+            action_handler.add_action(
+                code="transform-map",
+                description=f"{BOLD}[BETA]{R} Transform map by '{config.transform}' and pack as '{GameDefs.MAP_SUFFIX.value}'",
+                function=transform_map,
+                args=(data, config),
+                kwargs={'output_path': make_output_path(config)}
+            )
 
         file_game_ver = data.get("GameVersion", None)
         if is_game_save(data):
@@ -242,6 +280,13 @@ def read_json_input(config: Any) -> None:
                 args=(data, config),
                 kwargs={'output_path': make_output_path(config)}
             )
+        action_handler.add_action(
+            code="export-layers",
+            description=f'{BOLD}[BETA]{R} Export heights, water, moisture and trees as PNG with a spec file to make map back',
+            function=write_layers,
+            args=(data, make_layers_path(config)),
+            kwargs={}
+        )
 
         if config.select_action:
             action_index = int(config.select_action)
@@ -254,6 +299,9 @@ def read_json_input(config: Any) -> None:
             logging.info(f"Non-interactive mode: assuming '{action_handler.get_action(action_index).code}'")
             action_handler.run_action(action_index)
 
+        elif config.session:
+            MapSession(data, config).run(action_handler)
+
         else:
             action_handler.render_choices()
             action_handler.run_by_input()
@@ -263,7 +311,37 @@ def read_json_input(config: Any) -> None:
 
 def specfile_to_timberborn(specdict: dict, config: Any) -> None:
     output_path = make_output_path(config)
-    image_to_timberborn(ImageToTimberbornSpec(**specdict), config.input.parent, output_path, config)
+    if is_sweep(specdict):
+        sweep_to_timberborn(specdict, config.input.parent, output_path, config)
+    else:
+        image_to_timberborn(ImageToTimberbornSpec(**specdict), config.input.parent, output_path, config)
+
+
+def sweep_to_timberborn(specdict: dict, path: Path, output_path: Path, config: Any) -> List[Path]:
+    """ make a map for every combination of list-valued parameters in spec, sharing stages they have in common """
+    variants = expand_sweep(specdict)
+    logging.info(f"Sweep spec: {len(variants)} variants, output dir: `{output_path.parent}`")
+
+    budget = MemoryBudget.from_config(config.max_memory)
+    graph = StageGraph(workers=1 if budget.is_limited else 0)
+    shared: Dict[tuple, str] = {}
+    final_stages: List[Union[str, Path]] = []  # stage name, or path of a map that is up to date
+    for index, (suffix, variant) in enumerate(variants, start=1):
+        variant_path = output_path.with_name(f"{output_path.stem}_{suffix}{output_path.suffix}")
+        spec = ImageToTimberbornSpec(**variant)
+        fingerprint = conversion_fingerprint(spec, path.joinpath, config)
+        if up_to_date(variant_path, fingerprint, config):
+            final_stages.append(variant_path.with_suffix(GameDefs.MAP_SUFFIX.value))
+            continue
+        final_stages.append(add_map_stages(graph, spec, path.joinpath, write_to(variant_path, config, fingerprint),
+                                           str(variant_path), config, budget, shared, label=str(index)))
+    logging.info(f"{len(graph.stages)} distinct stages for {len(variants)} variants")
+
+    results = graph.run()
+    graph.report_timings()
+    timber_paths = [results[name] if isinstance(name, str) else name for name in final_stages]
+    print("\nSaved:\n" + "\n".join(f"  '{timber_path}'" for timber_path in timber_paths))
+    return timber_paths
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -297,7 +375,8 @@ def build_parser() -> argparse.ArgumentParser:
         formatter_class=argparse.RawTextHelpFormatter,
     )
 
-    parser.add_argument("input", type=Path, help="Path to a heightmap image or json spec file")
+    parser.add_argument("input", type=Path,
+                        help="Path to a heightmap image or json spec file, or a directory of maps to index")
     parser.add_argument(
         "--output", type=Path, help="Path to output the resulting map to. Defaults to input file name, with timber ext."
     )
@@ -340,7 +419,28 @@ def build_parser() -> argparse.ArgumentParser:
         default=0.7,
     )
 
+    parser.add_argument(
+        "--tree-placement", choices=("pixel", "poisson"), default="pixel",
+        help="'pixel' puts a tree on every pixel over treeline cutoff, 'poisson' uses treemap as density\n"
+             "and keeps distance between trees, skipping water and steep tiles. Defaults to 'pixel'.",
+    )
+    parser.add_argument("--tree-spacing", type=float, default=None,
+                        help="Minimum distance between trees with 'poisson' placement. Defaults to per-species values.")
+    parser.add_argument("--tree-density", type=float, default=1.0,
+                        help="Multiplier of treemap values as tree probability with 'poisson' placement. Defaults to 1.0.")
+
     parser.add_argument("--water-map", type=str, help="Path to a grayscale water map image. None by default.", default=None)
+    parser.add_argument("--lakes", action="store_true",
+                        help="Fill terrain depressions with water. Works with or without a water map.")
+    parser.add_argument("--lake-min-size", type=int, default=4,
+                        help="Depressions with fewer cells than that stay dry. Defaults to 4.")
+    parser.add_argument("--lake-level", type=float, default=1.0,
+                        help="Part of depression depth filled with water, 1.0 fills up to the spill point. Defaults to 1.0.")
+    parser.add_argument("--moisture-workers", type=int, default=0,
+                        help="Number of processes solving soil moisture on large maps. Defaults to number of CPU cores.")
+
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for random placement details and entity Ids. Same seed and inputs give identical map file.")
 
     parser.add_argument('-c', '--confpath', type=str, default='',
                         help="Path to config file. Will use default location if empty. '0' to disable.")
@@ -350,6 +450,31 @@ def build_parser() -> argparse.ArgumentParser:
                         help="Open config file with editor, editor command as argument or vi as default")
     """
     parser.add_argument('--keep-json', action='store_true', default='DEFAULT', help="Do not remove map .json after packing")
+    parser.add_argument('--compression', choices=('store', 'fast', 'default', 'max'), default='DEFAULT',
+                        help="Compression profile of output map. 'store' is fastest to write, 'max' gives smallest file")
+    parser.add_argument('--compression-workers', type=int, default=0,
+                        help="Number of threads compressing output map. Defaults to number of CPU cores.")
+    parser.add_argument('--max-memory', type=str, default='DEFAULT',
+                        help="Memory limit like '512M' or '2G'. Map generation fails early if it won't fit,\n"
+                             "or streams entities into output when that is enough.")
+    parser.add_argument('--json-backend', choices=JSON_BACKENDS, default='DEFAULT',
+                        help="JSON encoder and decoder of map files. 'auto' uses orjson when installed.\n"
+                             "Output is the same with every backend.")
+    parser.add_argument('--benchmark-json', action='store_true',
+                        help="Time decoding and encoding of input map with every installed JSON backend and exit")
+    parser.add_argument('--benchmark-upgrade', action='store_true',
+                        help="Make synthetic legacy maps in input directory, time reading, upgrading, writing, preview\n"
+                             "and layers export of each and save results there as 'benchmark_results.json'.\n"
+                             "Conversion of procedural terrain is timed too if numpy is installed, otherwise it's skipped")
+    parser.add_argument('--benchmark-sizes', type=str, default=",".join(map(str, BENCHMARK_SIZES)),
+                        help="Comma-separated sizes of square synthetic maps for --benchmark-upgrade")
+    parser.add_argument('--benchmark-densities', type=str, default=",".join(map(str, BENCHMARK_DENSITIES)),
+                        help="Comma-separated shares of dry tiles with entities in synthetic maps for --benchmark-upgrade")
+    parser.add_argument('--benchmark-baseline', type=Path, default=None,
+                        help="Results of earlier --benchmark-upgrade run to compare with")
+    parser.add_argument('--progress', choices=PROGRESS_SINKS, default='DEFAULT',
+                        help="How long steps report progress: 'bar' in terminal, 'jsonl' as JSON lines to stderr or 'none'.\n"
+                             "Defaults to 'bar', it's hidden when log level is above info.")
     parser.add_argument('--replace-entities', action='store', default='DEFAULT',
                         help="DEFAULT, 0, or JSON dictionary of original:target mapping of Entity Template IDs")
     # parser.add_argument('--write-config', action="store_true", help='Write (overwrite) config file at defualt location.')
@@ -359,9 +484,59 @@ def build_parser() -> argparse.ArgumentParser:
 
     parser.add_argument('-I', '--non-interactive', action='store_true', default='DEFAULT', help="Disable interactions"),
 
+    parser.add_argument('--lock-output', action='store_true', default='DEFAULT',
+                        help="Hold a '.lock' file next to each written map, so runs writing the same map wait for each other.\n"
+                             "Maps are always written into a temporary file and renamed into place when complete.")
+    parser.add_argument('--skip-up-to-date', action='store_true', default='DEFAULT',
+                        help="Don't convert again when output map was made from the same spec, images and options")
+    parser.add_argument('--session', action='store_true', default='DEFAULT',
+                        help="Keep input map loaded and show actions again after each one, until 'quit'.\n"
+                             "What actions work out from the map is reused, so following actions are fast.")
+    parser.add_argument('--fix-entities', action='store_true', default='DEFAULT',
+                        help="On map upgrade snap trees and plants to terrain height, drop entities with duplicate Id,\n"
+                             "several trees or plants on one tile and entities outside of map")
+    parser.add_argument('--unknown-entities', choices=('ask', 'keep', 'remove'), default='DEFAULT',
+                        help="On map upgrade, what to do with entities of unknown templates. Defaults to 'ask',\n"
+                             "in non-interactive mode they are kept.")
     parser.add_argument('--no-entity-replace', action="store_true",
                         help="Disable replacing outdated objects according to specification")
 
+    parser.add_argument('--preview-size', type=int_or_default, default='DEFAULT',
+                        help="Max size of ASCII map preview in cells. 0 to fit terminal. Defaults to 40.")
+
+    parser.add_argument('--compare', type=Path, default=None,
+                        help="Path to another (older) map to compare input map with, enables 'diff-map' action")
+    parser.add_argument('--write-patch', action='store_true',
+                        help="Save differences found by 'diff-map' as a patch that can be applied to the older map")
+    parser.add_argument('--patch', type=Path, default=None,
+                        help="Path to a patch file made with --write-patch, enables 'apply-patch' action")
+    parser.add_argument('--terrain', type=Path, default=None,
+                        help="Path to a new height image or spec file for input map, enables 'patch-terrain' action.\n"
+                             "Only heights (and water, with --water-map or in spec) are replaced, moisture is solved\n"
+                             "again around changed cells and entities there are snapped to new terrain.\n"
+                             "Image heights are set by --min-height and --max-height.")
+    parser.add_argument('--transform', type=str, default=None,
+                        help="Transforms of input map separated by ';', enables 'transform-map' action.\n"
+                             "crop:X,Y,W,H - keep W x H cells from (X, Y), resample:WxH - scale to W x H cells,\n"
+                             "rotate:DEG - turn clockwise by multiple of 90 degrees, flip:x or flip:y - mirror.\n"
+                             "Example: --transform \"crop:0,0,128,128; rotate:90\"")
+
+    parser.add_argument('--export-layers', action='store_true',
+                        help="Export heights, water, moisture and trees of input map as PNG images with a spec file\n"
+                             "that makes the map back. With a directory as input, exports every map in it\n"
+                             "into --output directory or 'layers' subdirectory.")
+    parser.add_argument('--index-workers', type=int, default=0,
+                        help="Number of processes reading maps when indexing or exporting a directory.\n"
+                             "Defaults to number of CPU cores.")
+    parser.add_argument('--library-db', type=str, default='DEFAULT',
+                        help="Path to maps index database. Defaults to a file in user cache directory.")
+    parser.add_argument('--query-size', type=str, default=None,
+                        help="When indexing a directory, list only maps of this size, like 256x256")
+    parser.add_argument('--query-version-below', type=str, default=None,
+                        help="When indexing a directory, list only maps with GameVersion lower than this, like 0.4.9")
+    parser.add_argument('--query-template', type=str, default=None,
+                        help="When indexing a directory, list only maps having entities of this template")
+
     parser.add_argument('--select-action', action='store', default='',
                         help="(ALPHA) automatically select interaction by number")
 
@@ -473,10 +648,38 @@ def main() -> None:
         config.input = Path.cwd() / config.input
 
     logging.info(f"Input path: `{config.input}`")
+    codec.use_backend(config.json_backend)
+    if config.progress == "bar" and logging.root.level > logging.INFO:
+        set_sink(make_sink("none"))
+    else:
+        set_sink(make_sink(config.progress))
+
+    if args.benchmark_upgrade:
+        benchmark_upgrade(config)
+        return
+
+    if config.input.is_dir() and config.export_layers:
+        output_dir = Path(config.output) if config.output else config.input / "layers"
+        export_library(config.input, output_dir, workers=config.index_workers)
+        return
+
+    if config.input.is_dir():
+        if config.library_db:
+            db_path = Path(config.library_db)
+        else:
+            db_path = Path(AppDirs(APPNAME, APP_AUTHOR).user_cache_dir) / LIBRARY_DB_FILE
+            db_path.parent.mkdir(parents=True, exist_ok=True)
+        logging.debug(f"Maps index database: '{db_path}'")
+        index_library(config.input, config, db_path)
+        return
 
     if not config.input.is_file():
         sys.exit(f"Path `{config.input}` is not a file or not accessible. Please check it and try again.")
 
+    if args.benchmark_json:
+        benchmark_json(config.input)
+        return
+
     # wrapping execution in exception catcher to halt window form closing in interactive mode
     try:
         suffix = config.input.suffix.lower()
@@ -513,4 +716,5 @@ def main() -> None:
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # moisture solve uses worker processes, required by frozen Windows builds
     main()
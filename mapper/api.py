@@ -0,0 +1,128 @@
+#    _   ___ ___
+#   /_\ | _ \_ _|
+#  / _ \|  _/| |
+# /_/ \_\_| |___|
+# API
+import io
+from dataclasses import dataclass
+from typing import Any, Dict, Mapping, Optional, Union
+
+from . import __version__
+from .base import MapperConfig
+from .conversion import ImageToTimberbornSpec, add_map_stages
+from .image_utils import ImageSource, build_image
+from .maps.format import TimberbornMap
+from .maps.gamemap import load_map_data, load_terrain, upgrade_game_map
+from .maps.layers import encode_layers, extract_layers
+from .maps.transform import parse_transforms, transform_map_data
+from .memory import MemoryBudget
+from .pipeline import StageGraph
+from .sweep import is_sweep
+
+# Functions of this module work on in-memory data only: they don't ask anything, print, read config files or
+# write files. Each call has its own configuration and random generator, so calls can run in parallel threads.
+
+
+@dataclass
+class UpgradePolicy:
+    unknown_entities: str = "keep"  # keep or remove entities of templates mapper doesn't know
+    replace_entities: bool = True  # replace outdated templates, like ChestnutTree with Pine
+    fix_entities: bool = False  # snap trees and plants to terrain, drop duplicates and entities outside of map
+    game_version: Optional[str] = None  # GameVersion of upgraded map, defaults to the one mapper targets
+
+
+def make_config(seed: Optional[int] = None, compression: str = "default", **options: Any) -> MapperConfig:
+    """ configuration of one call, defaults are CLI ones without a config file
+
+    Work runs in the calling thread, `options` may override it, like `moisture_workers=0` to use all cores.
+    """
+    config = MapperConfig(mapper_version=__version__)
+    config.non_interactive = True
+    config.seed = seed
+    config.compression = compression
+    config.compression_workers = 1
+    config.moisture_workers = 1
+    config.update_extend(**options)
+    return config
+
+
+def convert(
+    spec: Union[ImageToTimberbornSpec, dict],
+    images: Mapping[str, ImageSource],
+    seed: Optional[int] = None,
+    compression: str = "default",
+    **options: Any,
+) -> bytes:
+    """ spec (same as in spec files) and images named in it -> `.timber` archive contents
+
+    `images` maps file names used in spec to encoded image files or their paths.
+    """
+    if isinstance(spec, dict):
+        if is_sweep(spec):
+            raise ValueError("Spec has list-valued parameters, convert each variant of expand_sweep() instead")
+        spec = ImageToTimberbornSpec(**spec)
+    config = make_config(seed, compression, **options)
+
+    def source(filename: str) -> ImageSource:
+        try:
+            return images[str(filename)]
+        except KeyError:
+            raise ValueError(f"Image '{filename}' named in spec is not given") from None
+
+    graph = StageGraph(workers=1)
+    budget = MemoryBudget.from_config(config.max_memory)
+    final_stage = add_map_stages(graph, spec, source, lambda timber_map: timber_map.to_bytes(config), "", config, budget,
+                                 shared={})
+    return graph.run()[final_stage]
+
+
+def export_terrain(map_data: bytes, format: str = "PNG") -> bytes:
+    """ `.timber` archive or map json -> grayscale terrain image file """
+    heights, map_size = load_terrain(load_map_data(map_data))
+    buffer = io.BytesIO()
+    build_image(heights, map_size).save(buffer, format)
+    return buffer.getvalue()
+
+
+def export_layers(map_data: bytes, name: str = "map") -> Dict[str, bytes]:
+    """ `.timber` archive or map json -> file name -> contents of layer PNGs and `<name>_spec.json`
+
+    Spec and images can go to `convert()` as they are to make the map back.
+    """
+    return encode_layers(extract_layers(load_map_data(map_data)), name)
+
+
+def transform(map_data: bytes, transforms: str, compression: str = "default", **options: Any) -> bytes:
+    """ `.timber` archive or map json -> `.timber` archive contents transformed like 'crop:0,0,128,128; rotate:90' """
+    config = make_config(None, compression, **options)
+    data = transform_map_data(load_map_data(map_data), parse_transforms(transforms))
+    timber_map = TimberbornMap(
+        data.pop("GameVersion"),
+        data.pop("Singletons"),
+        data.pop("Entities"),
+        data.pop("TimeStamp", None),
+        MapperVersion=config._mapper_version,
+    )
+    return timber_map.to_bytes(config)
+
+
+def upgrade(
+    map_data: bytes,
+    policy: Optional[UpgradePolicy] = None,
+    seed: Optional[int] = None,
+    compression: str = "default",
+    **options: Any,
+) -> bytes:
+    """ `.timber` archive or map json -> `.timber` archive contents upgraded to current game version """
+    policy = policy or UpgradePolicy()
+    config = make_config(
+        seed,
+        compression,
+        unknown_entities=policy.unknown_entities,
+        no_entity_replace=not policy.replace_entities,
+        fix_entities=policy.fix_entities,
+        **options,
+    )
+    if policy.game_version:
+        config.game_version = policy.game_version
+    return upgrade_game_map(load_map_data(map_data), config).to_bytes(config)
@@ -19,6 +19,12 @@ config_version = 1
 non_interactive = false
 keep_json = false
 maps_dir = ""
+# one of: store, fast, default, max
+compression = "default"
+# limit like "512M", empty for no limit
+max_memory = ""
+# one of: auto, json, orjson
+json_backend = "auto"
 
 [map]
 max_map_size_defualt = -1
@@ -58,6 +64,22 @@ class MapperConfig(argparse.Namespace):
         self.nocolor = False
         self.non_interactive = False
         self.keep_json = False
+        self.compression = "default"
+        self.compression_workers = 0  # 0 - use all cores
+        self.seed = None
+        self.moisture_workers = 0  # 0 - use all cores
+        self.preview_size = 40
+        self.max_memory = ""
+        self.index_workers = 0  # 0 - use all cores
+        self.library_db = ""
+        self.fix_entities = False
+        self.session = False
+        self.lock_output = False
+        self.skip_up_to_date = False
+        self.json_backend = "auto"  # auto, json or orjson
+        self.progress = "bar"  # bar, jsonl or none
+        self.unknown_entities = "ask"  # ask, keep or remove, asking is skipped in non-interactive mode
+        self.no_entity_replace = False
 
         self._mapper_version = mapper_version
         self._os_key = self.get_os()
@@ -211,13 +233,12 @@ class ActionHandler:
         else:
             return self.actions[0]
 
-    def run_by_input(self):
+    def select_by_input(self):
         answer = ""
         choices = [str(i) for i in range(len(self.actions)+1)] + ['q']
         while answer not in choices:
             answer = input("> ").strip().lower()
+        return 0 if answer == 'q' else int(answer)
 
-        if answer == 'q':
-            return self.run_action(0)
-        else:
-            return self.run_action(int(answer))
+    def run_by_input(self):
+        return self.run_action(self.select_by_input())
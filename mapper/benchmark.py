@@ -0,0 +1,147 @@
+#  ___              _                 _
+# | _ ) ___ _ _  __| |_  _ __  __ _ _| |__
+# | _ \/ -_) ' \/ _| ' \| '  \/ _` | '_| / /
+# |___/\___|_||_\__|_||_|_|_|_\__,_|_| |_\_\
+# Benchmark
+import contextlib
+import io
+import logging
+import multiprocessing
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from platform import python_version
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional
+
+from . import __version__
+from .api import convert, make_config
+from .maps import codec
+from .maps.gamemap import ascii_preview, load_singletons, read_map_bytes, upgrade_game_map
+from .maps.layers import encode_layers, extract_layers
+from .maps.noise import NUMPY_AVAILABLE, noise_layers, noise_map_spec
+from .maps.synthetic import write_synthetic_maps
+from .memory import format_size, peak_rss
+from .output import write_atomic
+
+BENCHMARK_SIZES = [64, 128, 256]
+BENCHMARK_DENSITIES = [0.05, 0.3]
+BENCHMARK_STAGES = ("read", "parse", "singletons", "upgrade", "write", "preview", "export-layers", "convert-noise")
+# stage counts as slower than baseline above this ratio, smaller differences are noise of single runs
+REGRESSION_RATIO = 1.25
+
+
+def run_case(path: str, repeat: int = 3) -> Dict[str, Any]:
+    """ time every stage of reading and upgrading one map, best of `repeat` runs
+
+    Peak memory is read after each stage, so it shows which stage made the process grow. 'convert-noise' makes
+    a new map of the same size from procedural terrain, so conversion is timed without reading images, it needs
+    numpy and is recorded as None without it.
+    Meant to run in a fresh process, see `run_benchmark()`.
+    """
+    config = make_config(seed=0, unknown_entities="keep", preview_size=40)
+    stages: Dict[str, Dict[str, Optional[float]]] = {}
+
+    def timed(stage: str, function: Callable[..., Any], *args: Any) -> Any:
+        start = perf_counter()
+        result = function(*args)
+        seconds = perf_counter() - start
+        best = stages.get(stage, {}).get("seconds")
+        stages[stage] = {"seconds": seconds if best is None else min(best, seconds), "peak_rss": peak_rss()}
+        return result
+
+    entities = 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_path = Path(temp_dir) / "upgraded.tmp"
+        for _ in range(repeat):
+            text = timed("read", read_map_bytes, Path(path))
+            data = timed("parse", codec.loads, text)
+            entities = len(data["Entities"])
+            size = data["Singletons"]["MapSize"]["Size"]
+            width, height = size["X"], size["Y"]
+            timed("singletons", load_singletons, data["Singletons"])
+            with contextlib.redirect_stdout(io.StringIO()):
+                timed("preview", ascii_preview, data, config)
+            timed("export-layers", lambda map_data: encode_layers(extract_layers(map_data), "map"), data)
+            timber_map = timed("upgrade", upgrade_game_map, data, config)
+            timed("write", timber_map.write, output_path, config)
+            del data, timber_map
+            if NUMPY_AVAILABLE:
+                noise_layers.cache_clear()
+                timed("convert-noise", convert, noise_map_spec(width, height), {}, 0)
+            else:
+                stages["convert-noise"] = {"seconds": None, "peak_rss": None}
+
+    upgrade_seconds = stages["upgrade"]["seconds"]
+    return {
+        "map": Path(path).name,
+        "file_size": Path(path).stat().st_size,
+        "entities": entities,
+        "entities_per_sec": entities / upgrade_seconds if upgrade_seconds else None,
+        "stages": {stage: stages[stage] for stage in BENCHMARK_STAGES},
+    }
+
+
+def run_benchmark(directory: Path, sizes: List[int], densities: List[float], repeat: int = 3) -> Dict[str, Any]:
+    """ make synthetic legacy maps in `directory` (kept for reuse) and benchmark each in its own process """
+    paths = write_synthetic_maps(directory, sizes, densities)
+    cases = []
+    context = multiprocessing.get_context("spawn")  # forked workers would start with memory of this process
+    for (size, density), path in paths.items():
+        logging.info(f"Benchmarking '{path.name}'")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            case = executor.submit(run_case, str(path), repeat).result()
+        cases.append({"size": size, "density": density, **case})
+    return {"mapper_version": __version__, "python": python_version(), "json_backend": codec.codec.name, "cases": cases}
+
+
+def case_key(case: Dict[str, Any]) -> str:
+    return f"{case['size']}x{case['size']} @ {case['density']}"
+
+
+def compare_results(results: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> List[str]:
+    """ print results, with baseline ratios of stage times if given, returns keys of slower stages """
+    baseline_cases = {case_key(case): case for case in (baseline or {}).get("cases", [])}
+    if baseline:
+        print(f"Baseline: mapper {baseline.get('mapper_version')}, python {baseline.get('python')}")
+    regressions = []
+    for case in results["cases"]:
+        key = case_key(case)
+        before = baseline_cases.get(key)
+        print(f"\n{key}: {case['entities']} entities, {format_size(case['file_size'])},"
+              f" {case['entities_per_sec'] or 0:,.0f} entities/sec. on upgrade")
+        for stage, values in case["stages"].items():
+            if values["seconds"] is None:
+                print(f"{stage: >14}: skipped")
+                continue
+            line = f"{stage: >14}: {values['seconds']: >7.3f} sec."
+            if values["peak_rss"]:
+                line += f"  peak {format_size(values['peak_rss']): >10}"
+            old = before["stages"].get(stage) if before else None
+            if old and old.get("seconds"):
+                ratio = values["seconds"] / old["seconds"]
+                line += f"  {ratio: >5.2f}x baseline"
+                if ratio > REGRESSION_RATIO:
+                    line += "  SLOWER"
+                    regressions.append(f"{key} {stage}")
+            print(line)
+    if baseline:
+        print(f"\n{len(regressions)} stages slower than baseline" + (f": {', '.join(regressions)}" if regressions else ""))
+    return regressions
+
+
+def benchmark_upgrade(config: Any) -> Dict[str, Any]:
+    """ `--benchmark-upgrade`: benchmark maps in input directory, save results there and compare to baseline """
+    directory = Path(config.input)
+    sizes = [int(size) for size in str(config.benchmark_sizes).split(",")]
+    densities = [float(density) for density in str(config.benchmark_densities).split(",")]
+    results = run_benchmark(directory, sizes, densities)
+
+    baseline = None
+    if config.benchmark_baseline:
+        baseline = codec.loads(Path(config.benchmark_baseline).read_bytes())
+    compare_results(results, baseline)
+    results_path = directory / "benchmark_results.json"
+    write_atomic(results_path, codec.dumps(results, indent=4))
+    print(f"\nResults saved to '{results_path}', pass it as --benchmark-baseline to compare later runs")
+    return results
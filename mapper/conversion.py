@@ -0,0 +1,158 @@
+#   ___                         _
+#  / __|___ _ ___ _____ _ _ ___(_)___ _ _
+# | (__/ _ \ ' \ V / -_) '_(_-<| / _ \ ' \
+#  \___\___/_||_\_/\___|_| /__/|_\___/_||_|
+# Conversion
+import hashlib
+import logging
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+from .image_utils import ImageSource, MapImage
+from .maps.format import TimberbornMap, TimberbornSingletons
+from .maps.heightmap import Heightmap, ImageToTimberbornHeightmapSpec, read_heightmap
+from .maps.lakes import LakeSpec
+from .maps.noise import is_noise_source, load_layer_image, predict_layer_size
+from .maps.randomness import MapperRandom
+from .maps.treemap import ImageToTimberbornTreemapSpec, TreeMap, read_tree_map
+from .maps.watermap import WaterMap, read_water_map
+from .memory import MemoryBudget, estimate_entities, estimate_layers
+from .output import file_digest, fingerprint
+from .pipeline import StageGraph
+
+
+@dataclass
+class ImageToTimberbornWatermapSpec:
+    filename: str
+
+
+class ImageToTimberbornSpec:
+    def __init__(
+        self,
+        heightmap: Union[ImageToTimberbornHeightmapSpec, dict],
+        width: int = -1,  # XXX should use optional instead of sentinel value
+        height: int = -1,
+        treemap: Union[Optional[ImageToTimberbornTreemapSpec], dict] = None,
+        watermap: Union[Optional[ImageToTimberbornWatermapSpec], dict] = None,
+        lakes: Union[Optional[LakeSpec], dict] = None,
+    ):
+        self.width = width
+        self.height = height
+
+        if isinstance(heightmap, dict):
+            heightmap = ImageToTimberbornHeightmapSpec(**heightmap)
+        self.heightmap = heightmap
+
+        if isinstance(treemap, dict):
+            treemap = ImageToTimberbornTreemapSpec(**treemap)
+        self.treemap = treemap
+
+        if isinstance(watermap, dict):
+            watermap = ImageToTimberbornWatermapSpec(**watermap)
+        self.watermap = watermap
+
+        if isinstance(lakes, dict):
+            lakes = LakeSpec(**lakes)
+        self.lakes = lakes
+
+    width: int
+    height: int
+    heightmap: ImageToTimberbornHeightmapSpec
+    treemap: Optional[ImageToTimberbornTreemapSpec]
+    watermap: Optional[ImageToTimberbornWatermapSpec]
+    lakes: Optional[LakeSpec]
+
+
+def add_map_stages(
+    graph: StageGraph,
+    spec: ImageToTimberbornSpec,
+    source: Callable[[str], ImageSource],
+    write: Callable[[TimberbornMap], Any],
+    write_key: str,
+    config: Any,
+    budget: MemoryBudget,
+    shared: Dict[tuple, str],
+    label: str = "",
+) -> str:
+    """ add stages making one map to `graph`, returns name of its final stage
+
+    Images named in spec are looked up by `source` (noise sources are generated instead), finished map is passed
+    to `write` and its result is the result of the final stage, `write_key` tells writes of different maps apart.
+    Stages are looked up in `shared` by their parameters first, so maps of a sweep that only differ
+    downstream reuse decoded images, heights and moisture.
+    """
+    def layer_source(filename: str) -> ImageSource:
+        return filename if is_noise_source(filename) else source(filename)
+
+    map_size = predict_layer_size(layer_source(spec.heightmap.filename), spec.width, spec.height)
+    budget.require("Reading map layers", estimate_layers(*map_size))
+
+    def stage(key: tuple, function: Callable[..., Any], inputs: Tuple[str, ...] = ()) -> str:
+        if key not in shared:
+            name = key[0] if key[0] not in graph else f"{key[0]} {label or len(shared)}"
+            graph.add(name, function, inputs)
+            shared[key] = name
+        return shared[key]
+
+    def decode_layer(layer_spec: Any) -> Optional[MapImage]:
+        if layer_spec is None:
+            return None
+        logging.debug(f"Decoding '{layer_spec.filename}'")
+        return load_layer_image(layer_source(layer_spec.filename), *map_size)
+
+    def image_key(title: str, layer_spec: Any) -> tuple:
+        return (title, str(layer_spec.filename) if layer_spec else None, map_size)
+
+    def build_heightmap(image: MapImage) -> Heightmap:
+        return read_heightmap(*map_size, None, spec.heightmap, config, map_image=image)
+
+    def build_water_map(heightmap: Heightmap, image: Optional[MapImage]) -> WaterMap:
+        filename = spec.watermap.filename if spec.watermap else None
+        return read_water_map(heightmap, filename, None, workers=config.moisture_workers, map_image=image, lakes=spec.lakes)
+
+    def build_tree_map(heightmap: Heightmap, water_map: WaterMap, image: Optional[MapImage]) -> TreeMap:
+        rng = MapperRandom(config.seed)
+        return read_tree_map(heightmap, water_map, spec=spec.treemap, path=None, rng=rng, map_image=image)
+
+    def write_map(heightmap: Heightmap, water_map: WaterMap, tree_map: TreeMap) -> Any:
+        map_area = (heightmap.width, heightmap.height)
+        if budget.fits(estimate_entities(*map_area, len(tree_map), streamed=False)):
+            entities = tree_map.entities
+        else:
+            budget.require("Writing entities", estimate_entities(*map_area, len(tree_map), streamed=True))
+            logging.info("Entities will be streamed into output to stay within memory limit")
+            entities = tree_map.iter_entities()
+
+        singletons = TimberbornSingletons(
+            MapSize=heightmap.map_size,
+            SoilMoistureSimulator=water_map.soil_moisture_simulator,
+            TerrainMap=heightmap.terrain_map,
+            WaterMap=water_map.water_map,
+        )
+        return write(TimberbornMap(config.game_version, singletons, entities, MapperVersion=config._mapper_version))
+
+    height_image = stage(image_key("height image", spec.heightmap), partial(decode_layer, spec.heightmap))
+    water_image = stage(image_key("water image", spec.watermap), partial(decode_layer, spec.watermap))
+    tree_image = stage(image_key("tree image", spec.treemap), partial(decode_layer, spec.treemap))
+    conversion = tuple(repr(value) for value in (
+        spec.heightmap.linear_conversion, spec.heightmap.bucketized_conversion, spec.heightmap.preprocessing
+    ))
+    heightmap = stage(("heightmap", height_image, conversion), build_heightmap, (height_image,))
+    water_map = stage(("water map", heightmap, water_image, repr(spec.lakes)), build_water_map, (heightmap, water_image))
+    tree_map = stage(("tree map", heightmap, water_map, tree_image, repr(spec.treemap)), build_tree_map,
+                     (heightmap, water_map, tree_image))
+    return stage(("write", write_key), write_map, (heightmap, water_map, tree_map))
+
+
+def conversion_fingerprint(spec: ImageToTimberbornSpec, source: Callable[[str], ImageSource], config: Any) -> str:
+    """ fingerprint of everything a converted map depends on: spec, contents of its images and config values """
+    parts = [str(config._mapper_version), str(config.game_version), str(config.seed), str(config.compression),
+             str(spec.width), str(spec.height), repr(spec.lakes)]
+    for layer_spec in (spec.heightmap, spec.watermap, spec.treemap):
+        parts.append(repr(layer_spec))
+        if layer_spec is None or is_noise_source(layer_spec.filename):
+            continue
+        image = source(layer_spec.filename)
+        parts.append(hashlib.sha1(image).hexdigest() if isinstance(image, bytes) else file_digest(image))
+    return fingerprint(parts)
@@ -4,23 +4,37 @@
 # |___|_|_|_\__,_\__, \___|_|\_\___/_| |_|_|_\__,_|_|_/__\__,_|\__|_\___/_||_|
 #               |___/
 # Image Normalization
+import io
 import logging
-from pathlib import Path
-from typing import List
+from array import array
 from math import floor
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple, Union
 
 from PIL import Image, ImageOps
 
+# image file path or encoded image file contents
+ImageSource = Union[Path, str, bytes]
+# Image.point() maps "I" image through a table of this many entries, so intensities must fit 16 bits
+LOOKUP_TABLE_SIZE = 65536
+
+
+def open_image(source: ImageSource) -> Image.Image:
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(source))
+    return Image.open(source)
+
 
-def read_monochrome_image(filename: Path, width: int, height: int) -> Image.Image:
-    image = Image.open(filename)
+def read_monochrome_image(filename: ImageSource, width: int, height: int) -> Image.Image:
+    image = open_image(filename)
 
     try:
         image.verify()
     except Exception as exc:
-        logging.critical("Couldn't verify '%s' as image file, it might be broken or not an image.", filename)
+        name = filename if isinstance(filename, (Path, str)) else "<in-memory image>"
+        logging.critical("Couldn't verify '%s' as image file, it might be broken or not an image.", name)
         raise exc
-    image = Image.open(filename)  # it has to be re-opened after verify()
+    image = open_image(filename)  # it has to be re-opened after verify()
 
     image = ImageOps.mirror(image)  # Timberborn's map array structures are mirrored horizontally:
     logging.info(f"Image Size: {image.size}")
@@ -37,6 +51,20 @@ def read_monochrome_image(filename: Path, width: int, height: int) -> Image.Imag
     return image
 
 
+def predict_image_size(filename: ImageSource, width: int, height: int) -> Tuple[int, int]:
+    """ size read_monochrome_image() will produce, only image header is read """
+    with open_image(filename) as image:
+        image_width, image_height = image.size
+    return (width if width > 0 else image_width, height if height > 0 else image_height)
+
+
+def load_map_image(filename: ImageSource, width: int, height: int) -> "MapImage":
+    """ decode and normalize image, decoded pixels are released right away """
+    map_image = MapImage(filename, width, height)
+    map_image.release_image()
+    return map_image
+
+
 def prepare_color_matrix(height_array, map_size, grades=4) -> List:
     highest = max(height_array)
     lowest = min(height_array)
@@ -60,43 +88,104 @@ def build_image(height_array, size) -> Image.Image:
     color_step = round(255 / high)
     color_array = [color_step * i for i in height_array]
     # logging.debug(f"Intensity array: {color_array}")
-    image = Image.new("L", size, color=0)
 
-    index = 0
-    for x in range(0, size[0]):
-        for y in range(0, size[1]):
-            image.putpixel((x, y), color_array[index])
-            index += 1
-
-    return image
+    # array goes column by column, so fill transposed image row by row and flip it back
+    image = Image.new("L", (size[1], size[0]), color=0)
+    image.putdata(color_array)
+    return image.transpose(Image.TRANSPOSE)
 
 
 class MapImage:
     image = None
+    _pixels = None  # 16-bit copy of released image
+    _extrema = None
+    _size = (0, 0)
     _normalized_data = None
     _rounded_normalized_data = None
 
-    def __init__(self, filename: Path, width: int, height: int):
+    def __init__(self, filename: ImageSource, width: int, height: int):
         logging.debug(f"Init MapImage {width} x {height}")
         self.image = read_monochrome_image(filename, width, height)
 
     @property
-    def normalized_data(self) -> List[float]:
+    def size(self) -> Tuple[int, int]:
+        if self.image is None:
+            return self._size
+        return self.image.size
+
+    @property
+    def pixels(self) -> Optional[Image.Image]:
+        """ "I" image of source intensities, None if only normalized data is kept """
+        if self.image is not None:
+            return self.image
+        if self._pixels is not None:
+            return self._pixels.convert("I")
+        return None
+
+    @property
+    def extrema(self) -> Tuple[int, int]:
+        if self._extrema is None:
+            self._extrema = self.pixels.getextrema()
+            logging.info(f"Image Data Range: {self._extrema[0]} - {self._extrema[1]}")
+        return self._extrema
+
+    @property
+    def normalized_data(self) -> Sequence[float]:
         if not self._normalized_data:
             self._normalized_data = self.normalize_image_data()
         return self._normalized_data
 
     @property
-    def rounded_normalized_data(self) -> List[int]:
+    def rounded_normalized_data(self) -> Sequence[int]:
+        """ normalized data is in 0..1 range, so rounded values fit in bytes """
         if not self._rounded_normalized_data:
-            self._rounded_normalized_data = [round(pixel) for pixel in self.normalized_data]
+            rounded = self.lookup(round)
+            if rounded is None:
+                rounded = bytes(round(pixel) for pixel in self.normalized_data)
+            self._rounded_normalized_data = rounded
         return self._rounded_normalized_data
 
-    def normalize_image_data(self) -> List[float]:
-        data = self.image.getdata()
-        image_min = min(data)
-        image_max = max(data)
+    def fits_lookup(self) -> bool:
+        if self.image is None and self._pixels is None:
+            return False
+        low, high = self.extrema
+        return 0 <= low and high < LOOKUP_TABLE_SIZE
+
+    def lookup(self, function: Callable[[float], int]) -> Optional[bytes]:
+        """ `function` of normalized value of every pixel as bytes, row by row, None if it can't be a lookup table
+
+        `function` is called once per intensity between image min and max, Image.point() applies the table to
+        pixels without going through Python. Results must be in 0..255.
+        """
+        if not self.fits_lookup():
+            return None
+        low, high = self.extrema
+        image_range = high - low
+        table = [function((pixel - low) / image_range) for pixel in range(low, high + 1)]
+        if min(table) < 0 or max(table) > 255:
+            return None
+        return self.pixels.point([0] * low + table + [0] * (LOOKUP_TABLE_SIZE - 1 - high), "L").tobytes()
+
+    def normalize_image_data(self) -> Sequence[float]:
+        image_min, image_max = self.extrema
         image_range = image_max - image_min
-        print(f"Image Data Range: {image_min} - {image_max}")
-
-        return [(pixel - image_min) / image_range for pixel in data]
+        data = self.pixels.getdata()
+        if self.fits_lookup():
+            # one division per intensity instead of one per pixel
+            table = [0.0] * image_min + [(pixel - image_min) / image_range for pixel in range(image_min, image_max + 1)]
+            return array("d", map(table.__getitem__, data))
+        return array("d", [(pixel - image_min) / image_range for pixel in data])
+
+    def release_image(self) -> None:
+        """ drop decoded image, size stays available
+
+        Image that fits lookup tables is kept as 16-bit copy and normalized lazily, normalized data of others is
+        computed first.
+        """
+        if self.image is not None:
+            if self.fits_lookup():
+                self._pixels = self.image.convert("I;16")
+            elif not self._normalized_data:
+                self._normalized_data = self.normalize_image_data()
+            self._size = self.image.size
+            self.image = None
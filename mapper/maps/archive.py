@@ -0,0 +1,187 @@
+#    _          _    _
+#   /_\  _ _ __| |_ (_)_ _____
+#  / _ \| '_/ _| ' \| \ V / -_)
+# /_/ \_\_| \__|_||_|_|\_/\___|
+# Archive
+import logging
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from time import localtime
+from typing import BinaryIO, Iterable, Optional, Tuple
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+# size of uncompressed blocks handed to compression workers
+BLOCK_SIZE = 1 << 20
+# deflate window, tail of previous block is used as preset dictionary for the next one
+WINDOW_SIZE = 1 << 15
+
+# zip stores local time with 2 sec. precision, earliest date is 1980-01-01
+REPRODUCIBLE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+ZIP_VERSION = 20
+ZIP_MAX_SIZE = 0xFFFFFFFF
+
+
+class CompressionProfile(Enum):
+    """ .timber compression presets: (zip method, zlib level) """
+    store = (ZIP_STORED, 0)
+    fast = (ZIP_DEFLATED, 1)
+    default = (ZIP_DEFLATED, 8)  # level used by earlier versions
+    max = (ZIP_DEFLATED, 9)
+
+    @property
+    def method(self) -> int:
+        return self.value[0]
+
+    @property
+    def level(self) -> int:
+        return self.value[1]
+
+    @classmethod
+    def get(cls, name: str) -> "CompressionProfile":
+        try:
+            return cls[str(name).lower()]
+        except KeyError:
+            logging.warning(f"Unknown compression profile '{name}', using 'default'")
+            return cls.default
+
+
+def deflate_block(data: bytes, level: int, last: bool, zdict: bytes = b"") -> bytes:
+    """ compress one block as part of a raw deflate stream
+
+    Non-last blocks end on a sync flush point (byte-aligned, no final bit set), so compressed blocks
+    can be concatenated into one valid stream. Only the last block finishes the stream.
+    """
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def dos_date_time(date_time: Optional[Tuple[int, ...]] = None) -> Tuple[int, int]:
+    """ (year, month, day, hour, min, sec) tuple as in ZipInfo.date_time, current local time by default """
+    if date_time is None:
+        date_time = localtime()[:6]
+    year, month, day, hour, minute, second = date_time
+    dos_date = (max(year, 1980) - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | second // 2
+    return dos_date, dos_time
+
+
+class TimberArchiveWriter:
+    """ Write a single-member zip archive from a stream of text chunks
+
+    Chunks are gathered into fixed size blocks, so output doesn't depend on the number of workers.
+    With deflate, blocks are compressed on a thread pool (zlib releases GIL) while the caller keeps
+    serializing, finished blocks are written in order.
+    """
+
+    def __init__(
+        self,
+        fp: BinaryIO,
+        arcname: str,
+        profile: CompressionProfile = CompressionProfile.default,
+        workers: int = 0,
+        block_size: int = BLOCK_SIZE,
+        date_time: Optional[Tuple[int, ...]] = None,
+        comment: bytes = b"",
+    ):
+        self.fp = fp
+        self.arcname = arcname.encode("utf-8")
+        self.profile = profile
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.block_size = block_size
+        self.dos_date, self.dos_time = dos_date_time(date_time)
+        self.comment = comment
+
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+
+    def write_stream(self, chunks: Iterable[str]) -> None:
+        header_offset = self.fp.tell()
+        self._write_local_header()
+
+        if self.profile.method == ZIP_STORED:
+            for block in self._iter_blocks(chunks):
+                self._update_crc(block)
+                self.fp.write(block)
+                self.compress_size += len(block)
+        else:
+            self._write_deflated(chunks)
+
+        if self.file_size > ZIP_MAX_SIZE or self.compress_size > ZIP_MAX_SIZE:
+            raise ValueError("Map data exceeds 4 GiB which is not supported by the archive writer")
+
+        end_offset = self.fp.tell()
+        self.fp.seek(header_offset + 14)  # crc-32, compressed size, uncompressed size
+        self.fp.write(struct.pack("<III", self.crc, self.compress_size, self.file_size))
+        self.fp.seek(end_offset)
+        self._write_central_directory(header_offset, end_offset)
+
+    def _iter_blocks(self, chunks: Iterable[str]) -> Iterable[bytes]:
+        buffer = []
+        size = 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= self.block_size:
+                yield "".join(buffer).encode("utf-8")
+                buffer = []
+                size = 0
+        if buffer:
+            yield "".join(buffer).encode("utf-8")
+
+    def _update_crc(self, block: bytes) -> None:
+        self.crc = zlib.crc32(block, self.crc)
+        self.file_size += len(block)
+
+    def _write_deflated(self, chunks: Iterable[str]) -> None:
+        level = self.profile.level
+        pending = deque()
+        max_pending = self.workers * 2
+
+        def flush_pending(limit: int) -> None:
+            while len(pending) > limit:
+                data = pending.popleft().result()
+                self.fp.write(data)
+                self.compress_size += len(data)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            previous = None
+            zdict = b""
+            for block in self._iter_blocks(chunks):
+                if previous is not None:
+                    pending.append(executor.submit(deflate_block, previous, level, False, zdict))
+                    zdict = previous[-WINDOW_SIZE:]
+                    flush_pending(max_pending)
+                self._update_crc(block)
+                previous = block
+            # last block finishes the stream, empty input still needs a valid (empty) stream
+            pending.append(executor.submit(deflate_block, previous or b"", level, True, zdict))
+            flush_pending(0)
+
+    def _write_local_header(self) -> None:
+        # crc and sizes are patched after data is written
+        self.fp.write(struct.pack(
+            "<4sHHHHHIIIHH", b"PK\x03\x04", ZIP_VERSION, 0, self.profile.method, self.dos_time, self.dos_date,
+            0, 0, 0, len(self.arcname), 0
+        ))
+        self.fp.write(self.arcname)
+
+    def _write_central_directory(self, header_offset: int, directory_offset: int) -> None:
+        directory = struct.pack(
+            "<4sHHHHHHIIIHHHHHII", b"PK\x01\x02", ZIP_VERSION, ZIP_VERSION, 0, self.profile.method,
+            self.dos_time, self.dos_date, self.crc, self.compress_size, self.file_size, len(self.arcname),
+            0, 0, 0, 0, 0, header_offset
+        ) + self.arcname
+        self.fp.write(directory)
+        self.fp.write(struct.pack(
+            "<4sHHHHIIH", b"PK\x05\x06", 0, 0, 1, 1, len(directory), directory_offset, len(self.comment)
+        ))
+        self.fp.write(self.comment)
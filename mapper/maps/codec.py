@@ -0,0 +1,144 @@
+#   ___         _
+#  / __|___  __| |___ __
+# | (__/ _ \/ _` / -_) _|
+#  \___\___/\__,_\___\__|
+# Codec
+import json
+import logging
+import re
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    ORJSON_AVAILABLE = False
+else:
+    ORJSON_AVAILABLE = True
+
+JSON_BACKENDS = ("auto", "json", "orjson")
+
+# whole strings are matched first, so numbers are only rewritten outside of them
+_STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+# floats that orjson writes differently from repr(): exponents and decimals below 1e-4
+_FLOAT = r'-?\d+(?:\.\d+)?e[-+]?\d+|-?0\.0000\d*'
+_FLOAT_RE = re.compile(_STRING + r'|(?<![\d.])(' + _FLOAT + ')')
+# cheap check for exponents ending a number token, with "0.0000" it skips the string-aware pass for most texts
+_EXPONENT_TOKEN_RE = re.compile(r'e(?<=\de)-?\d+(?=[\s\],}]|$)')
+_COMPACT_RE = re.compile(_STRING + r'|([,:])')
+
+
+class JsonCodec:
+    """ Stdlib `json`, reference output of every codec
+
+    `dumps()` gives the same text as `json.dumps(obj, indent=indent)`, so other backends can be swapped in
+    without changing map files. Map classes are dict subclasses and are encoded as plain dicts.
+    """
+    name = "json"
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+    def dumps(self, obj: Any, indent: Optional[int] = None) -> str:
+        return json.dumps(obj, indent=indent)
+
+
+class OrjsonCodec(JsonCodec):
+    """ orjson, with output rewritten to match stdlib byte for byte
+
+    orjson only indents by 2, has no spaces after separators in compact mode, writes exponents without sign
+    and padding (`1e-6` vs `1e-06`) and doesn't use them below 1e-4. Those are fixed up by regexes that skip
+    strings. Non-ASCII text, non-finite floats and ints beyond 64 bits are encoded differently, such values
+    go to stdlib.
+    """
+    name = "orjson"
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+    def dumps(self, obj: Any, indent: Optional[int] = None) -> str:
+        try:
+            text = orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent is not None else 0).decode()
+        except TypeError:
+            return JsonCodec.dumps(self, obj, indent)
+        if not text.isascii() or "null" in text:
+            # null may be an encoded NaN or infinity
+            return JsonCodec.dumps(self, obj, indent)
+        if "0.0000" in text or _EXPONENT_TOKEN_RE.search(text):
+            text = _FLOAT_RE.sub(_float_repr, text)
+        if indent is None:
+            return _COMPACT_RE.sub(_spaced_separator, text)
+        return _reindent(text, indent) if indent != 2 else text
+
+
+def _float_repr(match: "re.Match") -> str:
+    return match.group(0) if match.group(1) is None else repr(float(match.group(1)))
+
+
+def _reindent(text: str, indent: int) -> str:
+    """ 2 spaces per level -> `indent` spaces
+
+    Encoded strings never contain raw newlines or tabs, so lines are marked with a tab per level,
+    deepest first so shallower ones don't match them, and tabs are expanded at once.
+    """
+    depth = 0
+    while "\n" + "  " * (depth + 1) in text:
+        depth += 1
+    for level in range(depth, 0, -1):
+        text = text.replace("\n" + "  " * level, "\n" + "\t" * level)
+    return text.replace("\t", " " * indent)
+
+
+def _spaced_separator(match: "re.Match") -> str:
+    return match.group(0) if match.group(1) is None else match.group(1) + " "
+
+
+CODECS: Dict[str, JsonCodec] = {"json": JsonCodec()}
+if ORJSON_AVAILABLE:
+    CODECS["orjson"] = OrjsonCodec()
+
+codec: JsonCodec = CODECS["orjson" if ORJSON_AVAILABLE else "json"]
+
+
+def use_backend(name: str) -> JsonCodec:
+    """ select codec used by `loads()` and `dumps()`, 'auto' picks the fastest installed one """
+    global codec
+    if name in ("auto", "", None):
+        name = "orjson" if ORJSON_AVAILABLE else "json"
+    elif name not in CODECS:
+        logging.warning(f"JSON backend '{name}' is not installed, using stdlib json")
+        name = "json"
+    codec = CODECS[name]
+    logging.debug(f"JSON backend: {codec.name}")
+    return codec
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    return codec.loads(data)
+
+
+def dumps(obj: Any, indent: Optional[int] = None) -> str:
+    return codec.dumps(obj, indent)
+
+
+def benchmark(text: Union[str, bytes], repeat: int = 3) -> List[Dict[str, Any]]:
+    """ best of `repeat` decode and encode times of map json for every installed codec
+
+    Encoding is done like map writing does it, entity by entity, and its output is compared to stdlib's.
+    """
+    results = []
+    reference = None
+    for name, candidate in CODECS.items():
+        decode = encode = float("inf")
+        for _ in range(repeat):
+            start = perf_counter()
+            data = candidate.loads(text)
+            decode = min(decode, perf_counter() - start)
+            start = perf_counter()
+            encoded = [candidate.dumps(value, indent=4) for key, value in data.items() if key != "Entities"]
+            encoded.extend(candidate.dumps(entity, indent=4) for entity in data.get("Entities", []))
+            encode = min(encode, perf_counter() - start)
+        if reference is None:
+            reference = encoded
+        results.append({"codec": name, "decode": decode, "encode": encode, "identical": encoded == reference})
+    return results
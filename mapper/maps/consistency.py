@@ -0,0 +1,151 @@
+#   ___             _    _
+#  / __|___ _ _  __(_)__| |_ ___ _ _  __ _  _
+# | (__/ _ \ ' \(_-< (_-<  _/ -_) ' \/ _| || |
+#  \___\___/_||_/__/_/__/\__\___|_||_\__|\_, |
+#                                        |__/
+# Consistency
+import logging
+from array import array
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Collection, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+Coordinates = Tuple[int, int, int]
+
+
+def get_coordinates(entity: dict) -> Optional[Coordinates]:
+    try:
+        coordinates = entity["Components"]["BlockObject"]["Coordinates"]
+        return (int(coordinates["X"]), int(coordinates["Y"]), int(coordinates["Z"]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class EntityGridIndex:
+    """ Grid hash of entities by tile, built once over all BlockObject coordinates
+
+    Only tiles that have entities are stored, lookups by tile or small neighbourhood are O(1).
+    """
+
+    def __init__(self, entities: Sequence[dict]):
+        self.cells: Dict[Tuple[int, int], List[int]] = {}
+        # coordinates as parallel columns, entities without coordinates are not indexed
+        self.indexes = array("i")
+        self.xs = array("i")
+        self.ys = array("i")
+        self.zs = array("i")
+        for index, entity in enumerate(entities):
+            coordinates = get_coordinates(entity)
+            if coordinates is None:
+                continue
+            x, y, z = coordinates
+            self.indexes.append(index)
+            self.xs.append(x)
+            self.ys.append(y)
+            self.zs.append(z)
+            self.cells.setdefault((x, y), []).append(index)
+
+    def at(self, x: int, y: int) -> List[int]:
+        """ indexes of entities standing on tile """
+        return self.cells.get((x, y), [])
+
+    def near(self, x: int, y: int, radius: int = 1) -> Iterator[int]:
+        for ny in range(y - radius, y + radius + 1):
+            for nx in range(x - radius, x + radius + 1):
+                yield from self.at(nx, ny)
+
+    def occupied(self) -> Iterator[Tuple[Tuple[int, int], List[int]]]:
+        return iter(self.cells.items())
+
+
+@dataclass
+class EntityReport:
+    out_of_bounds: List[int] = field(default_factory=list)
+    floating: List[int] = field(default_factory=list)
+    buried: List[int] = field(default_factory=list)
+    duplicate_ids: List[int] = field(default_factory=list)  # every occurrence after the first one
+    stacked: List[int] = field(default_factory=list)  # ground objects sharing a tile with an earlier one
+    # index -> terrain height at entity's tile, for floating and buried entities
+    terrain_z: Dict[int, int] = field(default_factory=dict)
+
+    @property
+    def is_clean(self) -> bool:
+        return not (self.out_of_bounds or self.floating or self.buried or self.duplicate_ids or self.stacked)
+
+    def report(self, entities: Sequence[dict]) -> None:
+        if self.is_clean:
+            logging.info("Entity consistency: no problems found")
+            return
+        logging.warning("Entity consistency problems:")
+        for title, indexes in (
+            ("outside of map", self.out_of_bounds),
+            ("floating above terrain", self.floating),
+            ("buried in terrain", self.buried),
+            ("duplicate Id", self.duplicate_ids),
+            ("stacked on one tile", self.stacked),
+        ):
+            if not indexes:
+                continue
+            templates = Counter(str(entities[i].get("TemplateName") or entities[i].get("Template")) for i in indexes)
+            details = ", ".join(f"{template}: {count}" for template, count in templates.most_common())
+            logging.warning(f"{title: >24}: {len(indexes): >6} ({details})")
+
+    def fixed(self, entities: Sequence[dict]) -> List[dict]:
+        """ entities with Z snapped to terrain, duplicates and out of bounds ones dropped
+
+        Snapped entity dicts are changed in place.
+        """
+        for index in self.floating + self.buried:
+            entities[index]["Components"]["BlockObject"]["Coordinates"]["Z"] = self.terrain_z[index]
+        dropped = set(self.out_of_bounds) | set(self.duplicate_ids) | set(self.stacked)
+        logging.info(f"Snapped {len(self.floating) + len(self.buried)} entities to terrain, dropped {len(dropped)}")
+        return [entity for index, entity in enumerate(entities) if index not in dropped]
+
+
+def check_entities(
+    entities: Sequence[dict],
+    heights: Sequence[int],
+    map_size: Tuple[int, int],
+    ground_templates: Collection[str],
+) -> EntityReport:
+    """ check entities against terrain and each other
+
+    Ground templates (trees, plants) must stand right on terrain and only one per tile. Other objects may be
+    placed on top of something or underground (ruins), so they are only checked for being inside the map.
+    """
+    width, height = map_size
+    report = EntityReport()
+    index = EntityGridIndex(entities)
+    templates = [entity.get("TemplateName") or entity.get("Template") for entity in entities]
+    is_ground: Set[int] = {i for i, template in enumerate(templates) if template in ground_templates}
+
+    for i, x, y, z in zip(index.indexes, index.xs, index.ys, index.zs):
+        if not (0 <= x < width and 0 <= y < height):
+            report.out_of_bounds.append(i)
+            continue
+        if i not in is_ground:
+            continue
+        terrain = heights[x + y * width]
+        if z < terrain:
+            report.buried.append(i)
+            report.terrain_z[i] = terrain
+        elif z > terrain:
+            report.floating.append(i)
+            report.terrain_z[i] = terrain
+
+    seen_ids = set()
+    for i, entity in enumerate(entities):
+        entity_id = entity.get("Id")
+        if entity_id is None:
+            continue
+        if entity_id in seen_ids:
+            report.duplicate_ids.append(i)
+        seen_ids.add(entity_id)
+
+    out_of_bounds = set(report.out_of_bounds)
+    duplicates = set(report.duplicate_ids)
+    for _, tile_entities in index.occupied():
+        ground = [i for i in tile_entities if i in is_ground and i not in out_of_bounds and i not in duplicates]
+        report.stacked.extend(ground[1:])
+    report.stacked.sort()
+    return report
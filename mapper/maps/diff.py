@@ -0,0 +1,347 @@
+#  __  __           ___  _  __  __
+# |  \/  |__ _ _ __|   \(_)/ _|/ _|
+# | |\/| / _` | '_ \ |) | |  _|  _|
+# |_|  |_\__,_| .__/___/|_|_| |_|
+#             |_|
+# Map Diff
+import copy
+import logging
+from array import array
+from collections import Counter
+from dataclasses import dataclass, field
+from hashlib import sha1
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..output import write_atomic
+from . import codec
+from .format import TimberbornMap
+from .gamemap import load_map_file
+
+PATCH_VERSION = 1
+
+# (layer name, singleton, array key, typecode to compare values with, None compares tokens as is)
+ARRAY_LAYERS = (
+    ("TerrainMap", "TerrainMap", "Heights", "i"),
+    ("WaterMap", "WaterMap", "WaterDepths", "d"),
+    ("Outflows", "WaterMap", "Outflows", None),
+    ("SoilMoisture", "SoilMoistureSimulator", "MoistureLevels", "d"),
+)
+
+EntityKey = Tuple[Optional[str], Optional[str], Optional[Tuple[int, int, int]]]
+
+
+def get_array_tokens(singletons: dict, singleton: str, key: str) -> List[str]:
+    try:
+        return singletons[singleton][key]["Array"].split()
+    except (KeyError, AttributeError):
+        return []
+
+
+def get_map_size(data: dict) -> Tuple[int, int]:
+    size = data["Singletons"]["MapSize"]["Size"]
+    return (int(size["X"]), int(size["Y"]))
+
+
+def typed_array(tokens: List[str], typecode: str) -> array:
+    coerce = int if typecode in "bBhHiIlLqQ" else float
+    return array(typecode, map(coerce, tokens))
+
+
+def terrain_hash(data: dict) -> str:
+    heights = data["Singletons"]["TerrainMap"]["Heights"]["Array"]
+    return sha1(heights.encode("utf-8")).hexdigest()
+
+
+def entity_key(entity: dict) -> EntityKey:
+    template = entity.get("TemplateName") or entity.get("Template")
+    coordinates = entity.get("Components", {}).get("BlockObject", {}).get("Coordinates")
+    if coordinates:
+        coordinates = (coordinates.get("X"), coordinates.get("Y"), coordinates.get("Z"))
+    return (entity.get("Id"), template, coordinates)
+
+
+def pack_key(key: EntityKey) -> list:
+    return [key[0], key[1], list(key[2]) if key[2] else None]
+
+
+def unpack_key(packed: list) -> EntityKey:
+    return (packed[0], packed[1], tuple(packed[2]) if packed[2] else None)
+
+
+@dataclass
+class LayerDiff:
+    name: str
+    width: int
+    changed: List[int] = field(default_factory=list)
+    # consecutive changed cells as (start index, new value tokens)
+    runs: List[Tuple[int, List[str]]] = field(default_factory=list)
+    replaced: Optional[List[str]] = None  # whole array, if sizes don't match
+
+    @property
+    def count(self) -> int:
+        if self.replaced is not None:
+            return len(self.replaced)
+        return len(self.changed)
+
+    @property
+    def bbox(self) -> Optional[Tuple[int, int, int, int]]:
+        """ (min x, min y, max x, max y) of changed cells """
+        if not self.changed:
+            return None
+        xs = [i % self.width for i in self.changed]
+        return (min(xs), self.changed[0] // self.width, max(xs), self.changed[-1] // self.width)
+
+
+def diff_layer(name: str, old_tokens: List[str], new_tokens: List[str], typecode: Optional[str], width: int) -> LayerDiff:
+    layer = LayerDiff(name, width)
+    if old_tokens == new_tokens:
+        return layer
+    if len(old_tokens) != len(new_tokens):
+        layer.replaced = new_tokens
+        return layer
+
+    if typecode:
+        old_values = typed_array(old_tokens, typecode)
+        new_values = typed_array(new_tokens, typecode)
+    else:
+        old_values, new_values = old_tokens, new_tokens
+
+    layer.changed = [i for i, (a, b) in enumerate(zip(old_values, new_values)) if a != b]
+
+    run_start = None
+    previous = None
+    for i in layer.changed + [None]:
+        if run_start is not None and i != previous + 1:
+            layer.runs.append((run_start, new_tokens[run_start:previous + 1]))
+            run_start = None
+        if run_start is None:
+            run_start = i
+        previous = i
+    return layer
+
+
+@dataclass
+class EntityDiff:
+    """ Entities are matched by key, entities sharing a key (duplicates) are matched in order of occurrence
+
+    Old entities that are left unmatched are always the last occurrences of their key, so `removed` lists a key
+    once per removed occurrence.
+    """
+    added: List[dict] = field(default_factory=list)
+    removed: List[EntityKey] = field(default_factory=list)
+    # (key in old map, occurrence of that key in old map from 0, entity as in new map)
+    modified: List[Tuple[EntityKey, int, dict]] = field(default_factory=list)
+
+    @property
+    def is_empty(self) -> bool:
+        return not (self.added or self.removed or self.modified)
+
+
+def diff_entities(old_entities: List[dict], new_entities: List[dict]) -> EntityDiff:
+    result = EntityDiff()
+    # (occurrence, entity) of every key not matched yet, in order
+    old_index: Dict[EntityKey, List[Tuple[int, dict]]] = {}
+    for entity in old_entities:
+        occurrences = old_index.setdefault(entity_key(entity), [])
+        occurrences.append((len(occurrences), entity))
+
+    unmatched_new = []
+    for entity in new_entities:
+        key = entity_key(entity)
+        occurrences = old_index.get(key)
+        if not occurrences:
+            unmatched_new.append(entity)
+            continue
+        occurrence, old_entity = occurrences.pop(0)
+        if old_entity != entity:
+            result.modified.append((key, occurrence, entity))
+
+    # entities that kept Id but were moved or changed template
+    old_by_id: Dict[str, List[EntityKey]] = {}
+    for key, occurrences in old_index.items():
+        if key[0] is not None:
+            old_by_id.setdefault(key[0], []).extend([key] * len(occurrences))
+    for entity in unmatched_new:
+        old_keys = old_by_id.get(entity.get("Id"))
+        if not old_keys:
+            result.added.append(entity)
+        else:
+            old_key = old_keys.pop(0)
+            occurrence, _ = old_index[old_key].pop(0)
+            result.modified.append((old_key, occurrence, entity))
+
+    result.removed = [key for key, occurrences in old_index.items() for _ in occurrences]
+    return result
+
+
+@dataclass
+class MapDiff:
+    old_size: Tuple[int, int]
+    new_size: Tuple[int, int]
+    base_hash: str
+    game_version: Any
+    layers: List[LayerDiff]
+    entities: EntityDiff
+
+    @property
+    def is_empty(self) -> bool:
+        return self.old_size == self.new_size and self.entities.is_empty and not any(layer.count for layer in self.layers)
+
+    def report(self) -> None:
+        if self.old_size != self.new_size:
+            old_x, old_y = self.old_size
+            logging.info(f"Map size changed: {old_x} x {old_y} -> {self.new_size[0]} x {self.new_size[1]}")
+        for layer in self.layers:
+            if layer.replaced is not None:
+                logging.info(f"{layer.name: >14}: replaced ({layer.count} cells)")
+            elif layer.count:
+                logging.info(f"{layer.name: >14}: {layer.count: >7} cells changed, bounding box {layer.bbox}")
+            else:
+                logging.info(f"{layer.name: >14}: no changes")
+
+        counts = {}
+        for title, entities in (
+            ("added", [entity_key(e) for e in self.entities.added]),
+            ("removed", self.entities.removed),
+            ("modified", [key for key, _, _ in self.entities.modified]),
+        ):
+            logging.info(f"Entities {title}: {len(entities)}")
+            counts.clear()
+            for key in entities:
+                counts[key[1]] = counts.get(key[1], 0) + 1
+            for template, count in sorted(counts.items(), key=lambda item: str(item[0])):
+                logging.info(f"{template: >18}: {count: >6}")
+
+    def as_patch(self) -> dict:
+        layers = {}
+        for layer in self.layers:
+            if layer.replaced is not None:
+                layers[layer.name] = {"Array": " ".join(layer.replaced)}
+            elif layer.runs:
+                layers[layer.name] = {"Runs": [[start, " ".join(tokens)] for start, tokens in layer.runs]}
+        return {
+            "PatchVersion": PATCH_VERSION,
+            "BaseTerrainHash": self.base_hash,
+            "GameVersion": self.game_version,
+            "MapSize": {"X": self.new_size[0], "Y": self.new_size[1]},
+            "Layers": layers,
+            "Entities": {
+                "Removed": [pack_key(key) for key in self.entities.removed],
+                "Modified": [
+                    {"Key": pack_key(key), "Occurrence": occurrence, "Entity": entity}
+                    for key, occurrence, entity in self.entities.modified
+                ],
+                "Added": self.entities.added,
+            },
+        }
+
+
+def diff_maps(old_data: dict, new_data: dict) -> MapDiff:
+    old_size = get_map_size(old_data)
+    new_size = get_map_size(new_data)
+    layers = []
+    for name, singleton, key, typecode in ARRAY_LAYERS:
+        layers.append(diff_layer(
+            name,
+            get_array_tokens(old_data["Singletons"], singleton, key),
+            get_array_tokens(new_data["Singletons"], singleton, key),
+            typecode,
+            new_size[0],
+        ))
+
+    return MapDiff(
+        old_size=old_size,
+        new_size=new_size,
+        base_hash=terrain_hash(old_data),
+        game_version=new_data.get("GameVersion"),
+        layers=layers,
+        entities=diff_entities(old_data.get("Entities", []), new_data.get("Entities", [])),
+    )
+
+
+def apply_patch(data: dict, patch: dict, check_base: bool = True) -> dict:
+    """ apply patch made by MapDiff.as_patch() to map data, returns patched copy """
+    if patch.get("PatchVersion") != PATCH_VERSION:
+        raise ValueError(f"Unsupported patch version: {patch.get('PatchVersion')}")
+    if check_base and terrain_hash(data) != patch["BaseTerrainHash"]:
+        raise ValueError("Patch was made against a different map (terrain hash doesn't match)")
+
+    singletons = copy.deepcopy(data["Singletons"])
+    singletons["MapSize"]["Size"] = dict(patch["MapSize"])
+    for name, singleton, key, _ in ARRAY_LAYERS:
+        layer_patch = patch["Layers"].get(name)
+        if not layer_patch:
+            continue
+        if "Array" in layer_patch:
+            singletons[singleton][key]["Array"] = layer_patch["Array"]
+        else:
+            tokens = get_array_tokens(singletons, singleton, key)
+            for start, values in layer_patch["Runs"]:
+                values = values.split()
+                tokens[start:start + len(values)] = values
+            singletons[singleton][key]["Array"] = " ".join(tokens)
+
+    entity_patch = patch["Entities"]
+    old_entities = data.get("Entities", [])
+    keys = [entity_key(entity) for entity in old_entities]
+    # removed occurrences are the last ones of their key, see EntityDiff
+    kept = Counter(keys)
+    kept.subtract(unpack_key(key) for key in entity_patch["Removed"])
+    # patches made before duplicates were told apart have no occurrence, it's the first one
+    modified = {(unpack_key(item["Key"]), item.get("Occurrence", 0)): item["Entity"] for item in entity_patch["Modified"]}
+    entities = []
+    seen: Counter = Counter()
+    for entity, key in zip(old_entities, keys):
+        occurrence = seen[key]
+        seen[key] += 1
+        if occurrence >= kept[key]:
+            continue
+        entities.append(modified.pop((key, occurrence), entity))
+    if modified:
+        logging.warning(f"{len(modified)} modified entities were not found in the map, adding them as new")
+        entities.extend(modified.values())
+    entities.extend(entity_patch["Added"])
+
+    patched = {key: value for key, value in data.items() if key not in ("Singletons", "Entities")}
+    patched["GameVersion"] = patch.get("GameVersion", data.get("GameVersion"))
+    patched["Singletons"] = singletons
+    patched["Entities"] = entities
+    return patched
+
+
+def diff_map(data: dict, config: Any, output_path: Optional[Path] = None) -> MapDiff:
+    """ compare `data` (treated as newer map) with map from `config.compare` """
+    logging.info(f"Comparing with '{config.compare}'")
+    old_data = load_map_file(Path(config.compare))
+    result = diff_maps(old_data, data)
+    result.report()
+
+    if result.is_empty:
+        logging.info("Maps are identical")
+    elif output_path and config.write_patch:
+        output_path = output_path.with_suffix(".patch.json")
+        write_atomic(output_path, codec.dumps(result.as_patch()))
+        print(f"\nPatch saved to '{output_path}'")
+    return result
+
+
+def patch_map(data: dict, config: Any, output_path: Optional[Path] = None) -> Optional[Path]:
+    """ apply patch file from `config.patch` to `data` and write the result """
+    with open(config.patch, "rb") as f:
+        patch = codec.loads(f.read())
+    patched = apply_patch(data, patch)
+    logging.info(f"Applied patch '{config.patch}'")
+
+    timber_map = TimberbornMap(
+        patched.pop("GameVersion"),
+        patched.pop("Singletons"),
+        patched.pop("Entities"),
+        patched.pop("TimeStamp", None),
+        MapperVersion=config._mapper_version,
+    )
+    if output_path:
+        timber_path = timber_map.write(output_path, config)
+        print(f"\nSaved to '{timber_path}'")
+        return timber_path
+    return None
@@ -0,0 +1,256 @@
+#  ___     _   _ _          ___ _
+# | __|_ _| |_(_) |_ _  _  / __| |_ ___ _ _ ___
+# | _|| ' \  _| |  _| || | \__ \  _/ _ \ '_/ -_)
+# |___|_||_\__|_|\__|\_, | |___/\__\___/_| \___|
+#                    |__/
+# Entity Store
+from array import array
+from itertools import repeat
+from math import copysign
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+from uuid import UUID
+
+# nested keys of an entity dict, None marks a leaf value: (("Id", None), ("Components", (("BlockObject", ...), ...)))
+Shape = Tuple[Tuple[str, Any], ...]
+# typed array storage by value type, bool goes first as it's also int
+ARRAY_TYPECODES = ((bool, "b"), (int, "i"), (float, "d"))
+# text values of a column with more distinct values than that are kept as they are
+MAX_CATEGORIES = 1 << 16
+
+
+def flatten(node: dict, leaves: List[Any]) -> Shape:
+    """ shape of nested dicts, leaf values are appended to `leaves` in the same order
+
+    Empty dicts and lists are leaves, so constant ones like BuilderJob become shared values.
+    """
+    shape = []
+    add_leaf = leaves.append
+    for key, value in node.items():
+        if value and isinstance(value, dict):
+            shape.append((key, flatten(value, leaves)))
+        else:
+            add_leaf(value)
+            shape.append((key, None))
+    return tuple(shape)
+
+
+def build(shape: Shape, values: Iterator[Any]) -> dict:
+    """ nested dicts of `shape` with leaves taken from `values`, inverse of flatten() """
+    return {key: next(values) if sub is None else build(sub, values) for key, sub in shape}
+
+
+def same_value(a: Any, b: Any) -> bool:
+    """ equal values of the same types, so they are encoded to the same json (1, 1.0 and True are not) """
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(same_value(a[key], b[key]) for key in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(map(same_value, a, b))
+    if isinstance(a, float):
+        return a == b and copysign(1, a) == copysign(1, b)  # -0.0 == 0.0
+    return a == b
+
+
+def is_uuid(value: str) -> bool:
+    try:
+        return len(value) == 36 and str(UUID(value)) == value
+    except ValueError:
+        return False
+
+
+class Column:
+    """ Values of one leaf across rows of a table
+
+    Column holds a single shared value while all rows have it, like `{}` of BuilderJob or 'Normal' priority.
+    After the first different value, bools, ints and floats go into typed arrays, UUID strings into 16 bytes
+    each, other strings into an array of codes of distinct values. Anything else is kept as a list.
+    """
+    __slots__ = ("kind", "constant", "count", "values", "value_type", "categories", "codes")
+
+    def __init__(self, value: Any):
+        self.kind = "constant"
+        self.constant = value
+        self.count = 1
+        self.values: Any = None
+        self.value_type: Any = None  # type of values in typed array
+        self.categories: List[str] = []
+        self.codes: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return self.count
+
+    @staticmethod
+    def kind_of(value: Any) -> str:
+        for value_type, typecode in ARRAY_TYPECODES:
+            if type(value) is value_type:
+                if typecode == "i" and not -(1 << 31) <= value < (1 << 31):
+                    return "q" if -(1 << 63) <= value < (1 << 63) else "list"
+                return typecode
+        if type(value) is str:
+            return "uuid" if is_uuid(value) else "text"
+        return "list"
+
+    def _convert(self, kind: str) -> None:
+        """ move values into storage of `kind` """
+        values = list(self)
+        self.kind = kind
+        self.categories, self.codes = [], {}
+        self.value_type = None
+        if kind in ("b", "i", "q", "d"):
+            self.values = array(kind)
+            self.value_type = bool if kind == "b" else float if kind == "d" else int
+        elif kind == "uuid":
+            self.values = bytearray()
+        elif kind == "text":
+            self.values = array("H")
+        else:
+            self.values = []
+        self.count = 0
+        for value in values:
+            self._store(value)
+
+    def _store(self, value: Any) -> None:
+        kind = self.kind
+        if kind == "list":
+            self.values.append(value)
+        elif kind == "uuid":
+            self.values += UUID(value).bytes
+        elif kind == "text":
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.categories)
+                self.categories.append(value)
+            self.values.append(code)
+        else:
+            self.values.append(value)
+        self.count += 1
+
+    def append(self, value: Any) -> None:
+        kind = self.kind
+        if kind == "constant":
+            constant = self.constant
+            if type(value) is type(constant) and value == constant and (
+                not isinstance(value, (dict, list, float)) or same_value(value, constant)
+            ):
+                self.count += 1
+                return
+            kind = self.kind_of(constant)
+            self._convert(kind)
+        elif type(value) is self.value_type:
+            try:
+                self.values.append(value)
+            except OverflowError:
+                pass  # int that doesn't fit, column is converted below
+            else:
+                self.count += 1
+                return
+        new_kind = self.kind_of(value)
+        if new_kind != kind:
+            if kind == "i" and new_kind == "q":
+                self._convert("q")
+            elif not (kind == "q" and new_kind == "i") and not (kind == "text" and new_kind == "uuid"):
+                self._convert("list")
+        elif kind == "text" and value not in self.codes and len(self.categories) >= MAX_CATEGORIES:
+            self._convert("list")
+        self._store(value)
+
+    def __iter__(self) -> Iterator[Any]:
+        kind = self.kind
+        if kind == "constant":
+            return repeat(self.constant, self.count)
+        if kind == "b":
+            return map(bool, self.values)
+        if kind == "uuid":
+            data = self.values
+            return (str(UUID(bytes=bytes(data[offset:offset + 16]))) for offset in range(0, len(data), 16))
+        if kind == "text":
+            return map(self.categories.__getitem__, self.values)
+        return iter(self.values)
+
+    @property
+    def nbytes(self) -> int:
+        """ size of stored values, shared and list values are not counted """
+        if self.kind in ("b", "i", "q", "d", "text"):
+            return self.values.itemsize * len(self.values)
+        if self.kind == "uuid":
+            return len(self.values)
+        if self.kind == "list":
+            return 8 * len(self.values)
+        return 0
+
+
+class EntityTable:
+    """ entities of one template with the same nested layout, one column per leaf """
+    __slots__ = ("template", "shape", "columns", "size")
+
+    def __init__(self, template: str, shape: Shape, leaves: List[Any]):
+        self.template = template
+        self.shape = shape
+        self.columns = [Column(value) for value in leaves]
+        self.size = 1
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, leaves: List[Any]) -> None:
+        for column, value in zip(self.columns, leaves):
+            column.append(value)
+        self.size += 1
+
+    def rows(self) -> Iterator[dict]:
+        """ entity dicts made again from columns, shared constant leaves must not be changed """
+        columns = [iter(column) for column in self.columns]
+        for _ in range(len(self)):
+            yield build(self.shape, map(next, columns))
+
+
+class EntityStore:
+    """ Entities grouped into columnar tables by template and layout, in place of a list of entity dicts
+
+    Entities of a template mostly share layout, so their Ids, coordinates, growth and yields end up in typed
+    arrays and components that are the same everywhere are stored once. Rare layouts get small tables of
+    their own. Iterating gives entity dicts in the order they were added, so the store can be written as
+    map Entities any number of times.
+    """
+
+    def __init__(self, entities: Iterable[dict] = ()):
+        self.tables: List[EntityTable] = []
+        self._table_index: Dict[Tuple[str, Shape], int] = {}
+        self.order = array("I")  # table of every entity
+        for entity in entities:
+            self.append(entity)
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def append(self, entity: dict) -> None:
+        leaves: List[Any] = []
+        shape = flatten(entity, leaves)
+        template = entity.get("TemplateName") or entity.get("Template")
+        key = (template, shape)
+        index = self._table_index.get(key)
+        if index is None:
+            index = self._table_index[key] = len(self.tables)
+            self.tables.append(EntityTable(template, shape, leaves))
+        else:
+            self.tables[index].append(leaves)
+        self.order.append(index)
+
+    def __iter__(self) -> Iterator[dict]:
+        rows = [table.rows() for table in self.tables]
+        for index in self.order:
+            yield next(rows[index])
+
+    def counts(self) -> Dict[str, int]:
+        """ number of entities of every template """
+        counts: Dict[str, int] = {}
+        for table in self.tables:
+            counts[table.template] = counts.get(table.template, 0) + len(table)
+        return counts
+
+    @property
+    def nbytes(self) -> int:
+        return self.order.itemsize * len(self.order) + sum(
+            column.nbytes for table in self.tables for column in table.columns
+        )
@@ -4,19 +4,59 @@
 # |_|  |_\__,_| .__/_|\___/_| |_|_|_\__,_|\__|
 #             |_|
 # Map Format
-import json
+import io
 import logging
-import uuid
+from contextlib import ExitStack
 from hashlib import sha1
-from random import random as pyrandom
-from typing import Any, List, Optional, Union
-from zipfile import ZIP_DEFLATED, ZipFile
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, List, Optional, TextIO, Union
 
+from ..output import FINGERPRINT_PREFIX, atomic_output, maybe_locked
+from . import codec
+from .archive import REPRODUCIBLE_DATE_TIME, CompressionProfile, TimberArchiveWriter
+from .entities import EntityStore
+from .randomness import MapperRandom, default_random
 from .validation import Validator
 
 INTERNAL_ARC_NAME = "world.json"
 
 
+def tee_chunks(chunks: Iterable[str], f: TextIO) -> Iterator[str]:
+    """ pass chunks through while also writing them into text file """
+    for chunk in chunks:
+        f.write(chunk)
+        yield chunk
+
+
+def indent_json(text: str, level: int, indent: int = 4) -> str:
+    """ shift multiline json text by `level` indents, encoded strings never contain raw newlines """
+    return text.replace("\n", "\n" + " " * (indent * level))
+
+
+def iter_map_json(data: dict, indent: int = 4) -> Iterator[str]:
+    """ Same text as `json.dump(data, indent=indent)` in chunks
+
+    Values that are iterators (like generated entities) or entity stores are encoded item by item, so the whole
+    list of entity dicts doesn't have to exist at once. Encoding is done by the selected `codec` backend.
+    """
+    if not data:
+        yield "{}"
+        return
+    key_prefix = "\n" + " " * indent
+    item_prefix = key_prefix + " " * indent
+    yield "{"
+    for index, (key, value) in enumerate(data.items()):
+        yield ("," if index else "") + key_prefix + codec.dumps(key) + ": "
+        if isinstance(value, (Iterator, EntityStore)):
+            empty = True
+            for item in value:
+                yield ("," if not empty else "[") + item_prefix + indent_json(codec.dumps(item, indent=indent), 2, indent)
+                empty = False
+            yield "[]" if empty else key_prefix + "]"
+        else:
+            yield indent_json(codec.dumps(value, indent=indent), 1, indent)
+    yield "\n}"
+
+
 def trunc_float(value: Union[int, float, str], prec=6):
     return round(float(value), prec)
 
@@ -99,10 +139,10 @@ class TimberbornArray(dict):
     """ string-encoded array with a given delimeter """
     delimeter = " "
 
-    def __init__(self, Array: List[object]):
+    def __init__(self, Array: List[object], element_str: Callable[[Any], str] = str):
 
         self.array_list = Array
-        array_str = self.delimeter.join([str(x) for x in Array])
+        array_str = self.delimeter.join([element_str(x) for x in Array])
         dict.__init__(self, Array=array_str)
 
     @classmethod
@@ -177,9 +217,9 @@ class TimberbornSingletons(dict):
 
 class TimberbornEntity(dict):
     """ Enitity consists of Id, Template or TemplateName and Components """
-    def __init__(self, TemplateName: str, Id: Optional[str] = None):
+    def __init__(self, TemplateName: str, Id: Optional[str] = None, rng: MapperRandom = default_random):
         if Id is None:
-            Id = f"{uuid.uuid4()}"
+            Id = rng.uuid()
         dict.__init__(self, Id=Id, TemplateName=TemplateName)
 
     @property
@@ -244,8 +284,8 @@ class TimberbornCoordinatesOffseter(dict):
         dict.__init__(self, CoordinatesOffset=CoordinatesOffset)
 
     @classmethod
-    def random(cls) -> "TimberbornCoordinatesOffseter":
-        return cls(TimberbornCoordinatesOffset(pyrandom() * 0.25, pyrandom() * 0.25))
+    def random(cls, rng: MapperRandom = default_random) -> "TimberbornCoordinatesOffseter":
+        return cls(TimberbornCoordinatesOffset(rng.random() * 0.25, rng.random() * 0.25))
 
 
 class TimberbornNaturalResourceModelRandomizer(dict):
@@ -258,9 +298,9 @@ class TimberbornNaturalResourceModelRandomizer(dict):
         dict.__init__(self, Rotation=Rotation, DiameterScale=DiameterScale, HeightScale=HeightScale)
 
     @classmethod
-    def random(cls) -> "TimberbornNaturalResourceModelRandomizer":
-        scale = (pyrandom() * 0.75) + 0.5
-        return TimberbornNaturalResourceModelRandomizer(pyrandom() * 360, scale, scale)
+    def random(cls, rng: MapperRandom = default_random) -> "TimberbornNaturalResourceModelRandomizer":
+        scale = (rng.random() * 0.75) + 0.5
+        return TimberbornNaturalResourceModelRandomizer(rng.random() * 360, scale, scale)
 
 
 class TimberbornYielderCuttable(LoadMixin, dict):
@@ -286,9 +326,9 @@ class TimberbornYielderCuttable(LoadMixin, dict):
 
 # New Gatherable Objects
 class TimberbornGatherableYieldGrower(dict):
-    def __init__(self, GrowthProgress: float = -1.0, round_to: int = 2):
+    def __init__(self, GrowthProgress: float = -1.0, round_to: int = 2, rng: MapperRandom = default_random):
         if GrowthProgress < 0.0:
-            GrowthProgress = pyrandom()
+            GrowthProgress = rng.random()
         if round_to:
             GrowthProgress = round(GrowthProgress, round_to)
         dict.__init__(self, GrowthProgress=GrowthProgress)
@@ -457,8 +497,8 @@ class TimberbornTreeComponents(TimberbornPlantComponents):
 
 
 class TimberbornTree(TimberbornEntity):
-    def __init__(self, species: str, Components: TimberbornTreeComponents):
-        TimberbornEntity.__init__(self, species)
+    def __init__(self, species: str, Components: TimberbornTreeComponents, rng: MapperRandom = default_random):
+        TimberbornEntity.__init__(self, species, rng=rng)
         self["Components"] = Components
 
 
@@ -467,7 +507,7 @@ class TimberbornMap(dict):
         self,
         GameVersion: str,
         Singletons: TimberbornSingletons,
-        Entities: List[TimberbornEntity],
+        Entities: Union[List[TimberbornEntity], Iterator[TimberbornEntity], EntityStore],
         TimeStamp: Optional[str] = None,
         MapperVersion: Optional[str] = None,
     ):
@@ -477,33 +517,68 @@ class TimberbornMap(dict):
         if MapperVersion:
             self['MapperVersion'] = MapperVersion
 
-    def write(self, output_path, config):
+    def pack(
+        self,
+        timber_file: BinaryIO,
+        config,
+        json_file: Optional[TextIO] = None,
+        fingerprint: Optional[str] = None,
+    ) -> TimberArchiveWriter:
+        """ write map as `.timber` archive into binary file object, map json is also copied into `json_file`
+
+        `fingerprint` of inputs is kept as archive comment, see output.is_up_to_date().
+        """
+        profile = CompressionProfile.get(config.compression)
+        chunks = iter_map_json(self, indent=4)
+        if json_file is not None:
+            chunks = tee_chunks(chunks, json_file)
+        logging.debug(f"Packing '{INTERNAL_ARC_NAME}' with compression profile '{profile.name}'")
+        writer = TimberArchiveWriter(
+            timber_file,
+            INTERNAL_ARC_NAME,
+            profile,
+            workers=config.compression_workers,
+            # seeded maps are expected to be byte-identical, so don't stamp current time
+            date_time=REPRODUCIBLE_DATE_TIME if config.seed is not None else None,
+            comment=f"{FINGERPRINT_PREFIX}{fingerprint}".encode() if fingerprint else b"",
+        )
+        writer.write_stream(chunks)
+        logging.debug(f"Packed {writer.file_size} bytes into {writer.compress_size}")
+        return writer
 
-        data = json.dumps(self["Singletons"]["TerrainMap"])
+    def to_bytes(self, config) -> bytes:
+        """ `.timber` archive contents, nothing is written to disk """
+        buffer = io.BytesIO()
+        self.pack(buffer, config)
+        return buffer.getvalue()
+
+    def write(self, output_path, config, fingerprint: Optional[str] = None):
+        """ write `.timber` archive next to `output_path`
+
+        Archive is written into a unique temporary file and renamed into place when complete, so concurrent runs
+        and the game reading maps directory never see a half-written map. With `config.lock_output` runs writing
+        the same map also wait for each other.
+        """
+        data = codec.dumps(self["Singletons"]["TerrainMap"])
 
         maphash = sha1(data.encode('utf-8')).hexdigest()
         logging.debug(f"Terrain data hash: sha1 {maphash}")
 
+        timber_path = output_path.with_suffix(".timber")
         try:
-            with open(output_path, "w") as f:
-                json.dump(self, f, indent=4)
+            with ExitStack() as stack:
+                stack.enter_context(maybe_locked(timber_path, config.lock_output))
+                timber_file = stack.enter_context(atomic_output(timber_path))
+                json_file = None
+                if config.keep_json:
+                    target = output_path.parent / f"{output_path.stem}-mapper{maphash[:8]}.json"
+                    json_file = stack.enter_context(atomic_output(target, "w"))
+                    logging.debug(f"Unzipped file store as '{target}'")
+                self.pack(timber_file, config, json_file, fingerprint)
         except (OSError, PermissionError) as exc:
             logging.error(
                 " ! Couldn't write to output path due to following error:"
                 "(Perhaps output path is incorrect or has permission denied)"
             )
             raise exc
-        else:
-            logging.debug(output_path)
-            timber_path = output_path.with_suffix(".timber")
-            arcname = INTERNAL_ARC_NAME
-            logging.debug(f"Zipping '{arcname}'")
-            with ZipFile(timber_path, "w", compression=ZIP_DEFLATED, compresslevel=8) as timberzip:
-                timberzip.write(output_path, arcname=arcname)
-            if config.keep_json:
-                target = output_path.parent / f"{output_path.stem}-mapper{maphash[:8]}.json"
-                output_path.rename(target)
-                logging.debug(f"Unzipped file store as '{target}'")
-            else:
-                output_path.unlink()
         return timber_path
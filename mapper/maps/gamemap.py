@@ -1,19 +1,36 @@
+import io
 import logging
+import shutil
 from datetime import datetime
 from enum import Enum
-from PIL import Image
+from pathlib import Path
+from typing import List, Optional, Tuple
+from zipfile import ZipFile
 
-from image_utils import build_image, prepare_color_matrix
+from PIL import Image
 
-from .format import (TimberbornEntity, TimberbornMap, TimberbornMapSize, TimberbornPlantComponents, TimberbornRuinComponents,
-                     TimberbornSingletons, TimberbornSoilMoistureSimulator, TimberbornTerrainMap, TimberbornTreeComponents,
-                     TimberbornWaterMap, TimberbornWaterSourceComponents, TimberbornBlockObject)
+from ..base import GameDefs
+from ..image_utils import build_image
+from ..memory import format_size
+from ..output import atomic_output
+from ..progress import progress
+from . import codec
+from .consistency import EntityReport, check_entities
+from .entities import EntityStore
+from .format import (INTERNAL_ARC_NAME, TimberbornBlockObject, TimberbornEntity, TimberbornMap, TimberbornMapSize,
+                     TimberbornPlantComponents, TimberbornRuinComponents, TimberbornSingletons,
+                     TimberbornSoilMoistureSimulator, TimberbornTerrainMap, TimberbornTreeComponents, TimberbornWaterMap,
+                     TimberbornWaterSourceComponents)
 # TimberbornSimpleComponents
+from .pyramid import get_pyramid
+from .randomness import MapperRandom, default_random
 from .treemap import PlantSpecies, TreeSpecies, Tree  # Goods
 from .validation import BlockValidator, OrientableValidator, PlantValidator, RuinValidator, TreeValidator, WaterSourceValidator
 
 MAP_FORMAT_ELEMENTS = {"GameVersion": (str, int), "Singletons": dict, "Entities": list}
 SAVE_FORMAT_ELEMENTS = {"WeatherDurationService": dict, "WeatherService": dict, "FactionService": dict}
+# local file header signature, `.timber` archives start with it
+ZIP_SIGNATURE = b"PK\x03\x04"
 SINGLETONS = {
     "MapSize": {"type": dict, "mandatory": True, "class": TimberbornMapSize},
     "TerrainMap": {"type": dict, "mandatory": True, "class": TimberbornTerrainMap},
@@ -72,18 +89,60 @@ ENTITY_TEMPLATES.update(
 )
 
 
-def replace_tree(components_dict: dict, replace_template: dict) -> dict:
+def replace_tree(components_dict: dict, replace_template: dict, rng: MapperRandom = default_random) -> dict:
     # print(type(components_dict))
     block_object = TimberbornBlockObject(**components_dict["BlockObject"])
     tree = Tree(species=replace_template["species"],
                 alive=not components_dict.get('WateredObject', {'IsDry': False})['IsDry'],
                 **block_object.get_coords())
-    entity = tree.as_entity(components_dict)
+    entity = tree.as_entity(components_dict, rng=rng)
     # from pprint import pprint
     # pprint(entity)
     return dict(entity)
 
 
+def read_world_json(timber_zip: ZipFile, name: str) -> bytes:
+    """ map json from opened `.timber` archive, `name` is only used in messages """
+    namelist = timber_zip.namelist()
+    if INTERNAL_ARC_NAME in namelist:
+        world_file_name = INTERNAL_ARC_NAME
+    else:
+        world_file_name = ""
+        logging.warning(
+            f'"{name}" doesn\'t include "{INTERNAL_ARC_NAME}"! Will use first ".json" file'
+        )
+        for arc_name in namelist:
+            if arc_name.endswith(".json"):
+                world_file_name = arc_name
+        if not world_file_name:
+            logging.error("No suitable file found!")
+            raise RuntimeError("Input file doesn't contain expected data")
+    return timber_zip.read(world_file_name)
+
+
+def read_map_bytes(path: Path) -> bytes:
+    """ raw map json from `.timber` archive or plain `.json` file """
+    if path.suffix.lower() == GameDefs.MAP_SUFFIX.value:
+        with ZipFile(path) as timber_zip:
+            return read_world_json(timber_zip, path.name)
+    else:
+        with open(path, "rb") as f:
+            return f.read()
+
+
+def load_map_file(path: Path) -> dict:
+    """ read map data from `.timber` archive or plain `.json` file """
+    return codec.loads(read_map_bytes(path))
+
+
+def load_map_data(data: bytes) -> dict:
+    """ map data from `.timber` archive contents or plain map json """
+    if data[:4] == ZIP_SIGNATURE:
+        with ZipFile(io.BytesIO(data)) as timber_zip:
+            data = read_world_json(timber_zip, "<in-memory map>")
+    return codec.loads(data)
+
+
 def is_game_map(data):
     flags = []
     for key, type_check in MAP_FORMAT_ELEMENTS.items():
@@ -132,29 +191,36 @@ def load_singletons(singletons_data) -> TimberbornSingletons:
     return TimberbornSingletons(**loaded_singletons)
 
 
-def ascii_preview(data, config, resize_to_max=40):
-    loaded_singletons = load_singletons(data["Singletons"])
-    terrain_map = loaded_singletons['TerrainMap']
-    map_size = loaded_singletons['MapSize']['Size'].value
-    heights_array = terrain_map['Heights'].array_list
+Terrain = Tuple[List[int], Tuple[int, int]]
+
+
+def load_terrain(data: dict) -> Terrain:
+    """ only heights and map size, without parsing other singletons """
+    singletons_data = data["Singletons"]
+    map_size = TimberbornMapSize.load(singletons_data["MapSize"])['Size'].value
+    terrain_map = TimberbornTerrainMap.load(singletons_data["TerrainMap"])
+    return terrain_map['Heights'].array_list, map_size
+
+
+def ascii_preview(data, config, resize_to_max=None, terrain: Optional[Terrain] = None):
+    heights_array, map_size = terrain or load_terrain(data)
     logging.info(f"Map size: {map_size}")
 
     height_grades = ["█", "▓", "▒", "░", " "]
     height_grades.reverse()
 
-    color_matrix = prepare_color_matrix(heights_array, map_size, grades=len(height_grades)-1)
-
-    image = Image.new(size=map_size, mode="L")
-    range_x = range(0, len(color_matrix[0]))
-    range_y = range(0, len(color_matrix))
-    for x in range_x:
-        for y in range_y:
-            image.putpixel((x, y), color_matrix[x][y])
+    if resize_to_max is None:
+        resize_to_max = config.preview_size
+    if resize_to_max > 0:
+        max_size = (resize_to_max, resize_to_max)
+    else:
+        terminal_size = shutil.get_terminal_size()
+        max_size = (max(terminal_size.columns // 2, 1), max(terminal_size.lines - 2, 1))
 
-    # from PIL import ImageFilter
-    # image = image.filter(ImageFilter.SMOOTH)
-    # image.show()
-    image.thumbnail((resize_to_max, resize_to_max))
+    # preview is transposed relative to map arrays, so requested width is map height
+    pyramid = get_pyramid(heights_array, *map_size)
+    image = pyramid.image(max_size[1], max_size[0], grades=len(height_grades)-1)
+    image = image.transpose(Image.TRANSPOSE)
     logging.debug(f"Resized preview to {image.size}")
 
     for y in range(0, image.size[1]):
@@ -166,67 +232,96 @@ def ascii_preview(data, config, resize_to_max=40):
         print("".join(row))
 
 
-def read_terrain(data, config, output_path=None):
-    loaded_singletons = load_singletons(data["Singletons"])
-    terrain_map = loaded_singletons['TerrainMap']
-    map_size = loaded_singletons['MapSize']['Size'].value
-    heights_array = terrain_map['Heights'].array_list
+def terrain_thumbnail(data: dict, size: Tuple[int, int]) -> Image.Image:
+    """ grayscale image of terrain, fitted into `size` """
+    heights_array, map_size = load_terrain(data)
+    return get_pyramid(heights_array, *map_size).image(*size)
+
+
+def read_terrain(data, config, output_path=None, terrain: Optional[Terrain] = None):
+    heights_array, map_size = terrain or load_terrain(data)
     logging.info(f"Map size: {map_size}")
 
     image = build_image(heights_array, map_size)
 
     if output_path:
         output_path = output_path.with_suffix('.png')
-        image.save(output_path, "PNG")
+        with atomic_output(output_path) as png_file:
+            image.save(png_file, "PNG")
         logging.info(f"Exported terrain map as '{output_path}'")
     else:
         image.show()
 
 
-def read_game_map(data, config, output_path=None):
+def ground_templates() -> set:
+    """ templates of trees and plants, they have to stand right on terrain """
+    return {
+        name for name, template in ENTITY_TEMPLATES.items() if template["category"] in (Categories.tree, Categories.plant)
+    }
+
 
-    loaded_singletons = load_singletons(data["Singletons"])
+def upgrade_game_map(
+    data: dict,
+    config,
+    singletons: Optional[TimberbornSingletons] = None,
+    consistency: Optional[EntityReport] = None,
+) -> TimberbornMap:
+    """ map data loaded, checked and updated to `config.game_version`
+
+    Singletons loaded and entities checked before for the same data can be passed to skip doing it again.
+    Entities are moved from `data` into an EntityStore one by one, parsed entity dicts are freed as it grows.
+    """
+    loaded_singletons = singletons or load_singletons(data["Singletons"])
+    rng = MapperRandom(config.seed)
 
     map_size = loaded_singletons['MapSize']['Size'].value
     logging.info(f"Map size: {map_size[0]} x {map_size[1]}")
 
     entity_data = data['Entities']
-    loaded_entities = []
+    if consistency is None:
+        heights = loaded_singletons['TerrainMap']['Heights'].array_list
+        consistency = check_entities(entity_data, heights, map_size, ground_templates())
+    consistency.report(entity_data)
+    if config.fix_entities and not consistency.is_clean:
+        entity_data = consistency.fixed(entity_data)
+
+    data['Entities'] = []
+    loaded_entities = EntityStore()
     unknown_entity_templates = []
     ignored_entity_templates = set()
     remove_templates = []
-    removed_entity_counts = {}
-    entity_counts = {}
+    skipped_entity_counts = {}  # removed, kept entities are counted by the store
     replaced_entity_counts = {}
     initial_entity_count = len(entity_data)
-    counter = 0
+    entities_progress = progress("Processing entities", initial_entity_count)
 
-    for entity_dict in entity_data:
-        counter += 1
-        if counter % 100 == 0:
-            logging.info(f" Processing Entities: {counter: >3}/{initial_entity_count}")
+    for counter in range(1, initial_entity_count + 1):
+        entities_progress.update(counter)
+        entity_dict, entity_data[counter - 1] = entity_data[counter - 1], None
 
         entity = TimberbornEntity.load(entity_dict)
 
-        inc_dict_counter(entity_counts, entity.template)
-
         if entity.template in remove_templates:
-            inc_dict_counter(removed_entity_counts, entity.template)
-            continue
-
-        if entity.template in ignored_entity_templates:
+            inc_dict_counter(skipped_entity_counts, entity.template)
             continue
 
         if entity.template in ENTITY_TEMPLATES.keys():
             template = ENTITY_TEMPLATES[entity.template]
             # logging.debug(f" *** Entity #{counter} '{entity.template}' is known")
+        elif entity.template in ignored_entity_templates:
+            template = None  # kept as it is, without validation
         else:
             template = None
             unknown_entity_templates.append(entity.template)
             logging.warning(f"Entity '{entity.template}' is unknown!")
-            answer = input("Remove entities with this template from the map? (Y/n 1/0)\n").strip().lower()
-            if answer in ('y', '1'):
+            if config.unknown_entities == "ask" and not config.non_interactive:
+                answer = input("Remove entities with this template from the map? (Y/n 1/0)\n").strip().lower()
+                remove = answer in ('y', '1')
+            else:
+                remove = config.unknown_entities == "remove"
+            if remove:
                 remove_templates.append(entity.template)
+                inc_dict_counter(skipped_entity_counts, entity.template)
                 continue
             else:
                 ignored_entity_templates.add(entity.template)
@@ -250,7 +345,7 @@ def read_game_map(data, config, output_path=None):
                     # logging.debug(f"Replace params: {template.get('params')}")
                     if not template["category"] == Categories.tree:
                         raise NotImplementedError(f"Can replace onyl trees, tried Category {template['category']}")
-                    entity['Components'] = replace_tree(entity['Components'], template)
+                    entity['Components'] = replace_tree(entity['Components'], template, rng)
 
             category = template['category']
 
@@ -279,6 +374,9 @@ def read_game_map(data, config, output_path=None):
                 raise ex
 
         loaded_entities.append(entity)
+    entities_progress.close()
+    logging.debug(f"Entity store: {len(loaded_entities)} entities in {len(loaded_entities.tables)} tables,"
+                  f" {format_size(loaded_entities.nbytes)} of values")
 
     updated_game_version = config.game_version
     updated_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -292,6 +390,9 @@ def read_game_map(data, config, output_path=None):
     else:
         logging.info("No unknown entities found")
 
+    entity_counts = loaded_entities.counts()
+    for key, val in skipped_entity_counts.items():
+        inc_dict_counter(entity_counts, key, val)
     if entity_counts:
         logging.info("Processed entities")
         for key, val in entity_counts.items():
@@ -307,13 +408,17 @@ def read_game_map(data, config, output_path=None):
     if remove_templates:
         logging.info(f"Removed entities with templates: {', '.join(remove_templates)}")
 
-    timber_map = TimberbornMap(
+    return TimberbornMap(
         updated_game_version,
         loaded_singletons,
         loaded_entities,
         updated_timestamp,
         MapperVersion=config._mapper_version,
     )
+
+
+def read_game_map(data, config, output_path=None):
+    timber_map = upgrade_game_map(data, config)
     if output_path:
         timber_path = timber_map.write(output_path, config)
         print(f"\nSaved to '{timber_path}'\nIt's HIGHLY recommended you open map in in-game editor and re-save it.")
@@ -4,13 +4,18 @@
 # |_||_\___|_\__, |_||_\__|_|_|_\__,_| .__/
 #            |___/                   |_|
 # Heightmap
+import logging
 import math
+from array import array
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, List, Optional, Tuple, Union
+from typing import Any, List, Optional, Sequence, Tuple, Union
 
-from image_utils import MapImage
-from maps.format import TimberbornArray, TimberbornMapSize, TimberbornSize, TimberbornTerrainMap
+from ..image_utils import MapImage, load_map_image
+from ..memory import compact_int_array
+from .format import TimberbornArray, TimberbornMapSize, TimberbornSize, TimberbornTerrainMap
+from .preprocess import TerrainPreprocessingSpec, preprocess_terrain
+from .pyramid import HeightPyramid, get_pyramid
 
 
 @dataclass
@@ -19,12 +24,16 @@ class Heightmap:
     max_height: int
     width: int
     height: int
-    data: List[int]
+    data: Sequence[int]  # typed array, see compact_int_array()
 
     @property
     def map_size(self) -> TimberbornMapSize:
         return TimberbornMapSize(TimberbornSize(self.width, self.height))
 
+    @property
+    def pyramid(self) -> HeightPyramid:
+        return get_pyramid(self.data, self.width, self.height)
+
     @property
     def terrain_map(self) -> TimberbornTerrainMap:
         return TimberbornTerrainMap(TimberbornArray(self.data))
@@ -72,9 +81,14 @@ class ImageToTimberbornHeightmapSpec:
         filename: str,
         linear_conversion: Union[Optional[ImageToTimberbornHeightmapLinearConversionSpec], dict] = None,
         bucketized_conversion: Union[Optional[ImageToTimberbornHeightmapBucketizedConversionSpec], dict] = None,
+        preprocessing: Union[Optional[TerrainPreprocessingSpec], dict] = None,
     ):
         self.filename = filename
 
+        if isinstance(preprocessing, dict):
+            preprocessing = TerrainPreprocessingSpec(**preprocessing)
+        self.preprocessing = preprocessing
+
         if isinstance(linear_conversion, dict):
             linear_conversion = ImageToTimberbornHeightmapLinearConversionSpec(**linear_conversion)
         self.linear_conversion = linear_conversion
@@ -93,6 +107,7 @@ class ImageToTimberbornHeightmapSpec:
     filename: str
     linear_conversion: Optional[ImageToTimberbornHeightmapLinearConversionSpec]
     bucketized_conversion: Optional[ImageToTimberbornHeightmapBucketizedConversionSpec]
+    preprocessing: Optional[TerrainPreprocessingSpec]
 
 
 def bucketize_data(data: List[float], bucket_weights: List[float]) -> List[int]:
@@ -100,7 +115,7 @@ def bucketize_data(data: List[float], bucket_weights: List[float]) -> List[int]:
         math.ceil(sum(bucket_weights[:i]) / sum(bucket_weights) * len(data)) for i in range(1, len(bucket_weights) + 1)
     ]
     bucket_cutoffs[-1] += 1
-    print(bucket_cutoffs)
+    logging.debug(f"Bucket cutoffs: {bucket_cutoffs}")
 
     sortable: List[Tuple[int, float]] = [(i, v) for i, v in enumerate(data)]
     sortable.sort(key=lambda t: t[1])
@@ -117,30 +132,48 @@ def bucketize_data(data: List[float], bucket_weights: List[float]) -> List[int]:
     return result
 
 
-def read_heightmap(width: int, height: int, path: Path, spec: ImageToTimberbornHeightmapSpec, args: Any) -> Heightmap:
-    print("\nReading Heightmap")
+def read_heightmap(
+    width: int,
+    height: int,
+    path: Path,
+    spec: ImageToTimberbornHeightmapSpec,
+    args: Any,
+    map_image: Optional[MapImage] = None,
+) -> Heightmap:
+    logging.info("Reading Heightmap")
 
-    filepath = path / spec.filename
+    if map_image is None:
+        map_image = load_map_image(path / spec.filename, width, height)
 
-    map_image = MapImage(filepath, width, height)
+    def normalized_data() -> Sequence[float]:
+        if spec.preprocessing is not None:
+            return preprocess_terrain(map_image.normalized_data, *map_image.size, spec.preprocessing)
+        return map_image.normalized_data
 
     if spec.linear_conversion is not None:
-        print("Converting image to heightmap data with method: linear")
+        logging.info("Converting image to heightmap data with method: linear")
         output_range = spec.linear_conversion.max_height - spec.linear_conversion.min_height
-        height_data = []
-        for pixel in map_image.normalized_data:
-            height = round(pixel * output_range + spec.linear_conversion.min_height)
-            height_data.append(height)
+        min_height = spec.linear_conversion.min_height
+
+        def elevation(pixel: float) -> int:
+            return round(pixel * output_range + min_height)
+
+        # without preprocessing, image intensities map straight to elevations
+        levels = map_image.lookup(elevation) if spec.preprocessing is None else None
+        if levels is not None:
+            height_data = array("B", levels)
+        else:
+            height_data = compact_int_array(map(elevation, normalized_data()))
     elif spec.bucketized_conversion is not None:
-        print("Converting image to heightmap data with method: bucketized")
-        height_data = [b for b in bucketize_data(map_image.normalized_data, spec.bucketized_conversion.weights)]
+        logging.info("Converting image to heightmap data with method: bucketized")
+        height_data = compact_int_array(bucketize_data(normalized_data(), spec.bucketized_conversion.weights))
     else:
         assert False, "Must specify a conversion method for heightmap data."
 
     return Heightmap(
         min_height=min(height_data),
         max_height=max(height_data),
-        width=map_image.image.size[0],
-        height=map_image.image.size[1],
+        width=map_image.size[0],
+        height=map_image.size[1],
         data=height_data,
     )
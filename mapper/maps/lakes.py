@@ -0,0 +1,106 @@
+#  _         _
+# | |   __ _| |_____ ___
+# | |__/ _` | / / -_|_-<
+# |____\__,_|_\_\___/__/
+# Lakes
+import logging
+from array import array
+from collections import deque
+from dataclasses import dataclass
+from heapq import heapify, heappop, heappush
+from typing import List, Sequence
+
+
+@dataclass
+class LakeSpec:
+    min_basin_size: int = 4  # basins with fewer cells stay dry
+    water_level: float = 1.0  # part of basin depth filled, 1.0 fills up to the spill point
+
+
+def neighbours4(i: int, width: int, height: int) -> List[int]:
+    y, x = divmod(i, width)
+    cells = []
+    if x > 0:
+        cells.append(i - 1)
+    if x < width - 1:
+        cells.append(i + 1)
+    if y > 0:
+        cells.append(i - width)
+    if y < height - 1:
+        cells.append(i + width)
+    return cells
+
+
+def priority_flood(heights: Sequence[int], width: int, height: int) -> array:
+    """ level every cell would be filled to before water spills off the map edge
+
+    Priority-flood: cells are processed from the map edge inwards, lowest first. A neighbour that is not higher
+    than the current level is in a depression, it takes that level and goes into a plain FIFO queue instead of
+    the heap (improved variant by Barnes et al.), so flat and flooded areas don't pay for heap operations.
+    Heap keys are packed as `level * size + index` ints, which compare faster than tuples.
+    """
+    size = width * height
+    level = array("i", heights)
+    closed = bytearray(size)
+    edge = [i for i in range(size) if i < width or i >= size - width or i % width in (0, width - 1)]
+    heap = []
+    for i in edge:
+        closed[i] = 1
+        heap.append(heights[i] * size + i)
+    heapify(heap)
+    pit = deque()
+
+    while heap or pit:
+        if pit:
+            i = pit.popleft()
+            z = level[i]
+        else:
+            z, i = divmod(heappop(heap), size)
+        for j in neighbours4(i, width, height):
+            if closed[j]:
+                continue
+            closed[j] = 1
+            if heights[j] <= z:
+                level[j] = z
+                pit.append(j)
+            else:
+                heappush(heap, heights[j] * size + j)
+    return level
+
+
+def lake_depths(heights: Sequence[int], width: int, height: int, spec: LakeSpec) -> array:
+    """ water depth of every cell after filling depressions of the terrain
+
+    Flooded cells that touch each other share the same filled level, so each connected group is one basin.
+    Basin surface is set between its lowest cell and spill level according to `spec.water_level`.
+    """
+    level = priority_flood(heights, width, height)
+    depths = array("f", bytes(4 * width * height))
+    seen = bytearray(width * height)
+    basins = 0
+    for start in range(width * height):
+        if seen[start] or level[start] <= heights[start]:
+            continue
+        seen[start] = 1
+        cells = [start]
+        queue = deque(cells)
+        while queue:
+            for j in neighbours4(queue.popleft(), width, height):
+                if not seen[j] and level[j] > heights[j]:
+                    seen[j] = 1
+                    cells.append(j)
+                    queue.append(j)
+        if len(cells) < spec.min_basin_size:
+            continue
+
+        bottom = min(heights[i] for i in cells)
+        surface = bottom + spec.water_level * (level[start] - bottom)
+        filled = False
+        for i in cells:
+            if surface > heights[i]:
+                depths[i] = surface - heights[i]
+                filled = True
+        basins += filled
+
+    logging.info(f"Filled {basins} lakes")
+    return depths
@@ -0,0 +1,246 @@
+#  _
+# | |   __ _ _  _ ___ _ _ ___
+# | |__/ _` | || / -_) '_(_-<
+# |____\__,_|\_, \___|_| /__/
+#            |__/
+# Layers
+import io
+import logging
+import os
+import sys
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from ..base import GameDefs
+from ..output import write_atomic
+from ..progress import progress
+from . import codec
+from .consistency import get_coordinates
+from .format import TimberbornMapSize
+from .gamemap import load_map_file
+from .treemap import TreeSpecies
+
+# 16-bit pixel = value * scale, 1/256 of a block is finer than the game's float32 values carry on maps
+DEPTH_SCALE = 256
+MOISTURE_SCALE = 256
+# tree image grey of species that pixel tree placement makes, others are exported as nearest of them
+TREE_GREYS = {TreeSpecies.birch: 64, TreeSpecies.pine: 128, TreeSpecies.oak: 255}
+TREE_EXPORT_SPECIES = {
+    TreeSpecies.birch: TreeSpecies.birch,
+    TreeSpecies.pine: TreeSpecies.pine,
+    TreeSpecies.chestnut: TreeSpecies.pine,
+    TreeSpecies.maple: TreeSpecies.oak,
+    TreeSpecies.oak: TreeSpecies.oak,
+}
+TREE_TEMPLATES = {species.value[0]: species for species in TreeSpecies}
+# below this many maps batch export runs in the main process
+PARALLEL_MIN_MAPS = 4
+
+
+@dataclass
+class MapLayers:
+    """ Per-cell layers of a map, cell of (x, y) is at `x + y * width` like in map arrays """
+    width: int
+    height: int
+    heights: array  # "H"
+    depths: array  # "f"
+    moisture: array  # "f"
+    trees: bytearray  # tree grey per cell, 0 without tree
+    replaced: Counter = field(default_factory=Counter)  # tree templates exported as another species
+    skipped: Counter = field(default_factory=Counter)  # templates of entities that layers can't describe
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return (self.width, self.height)
+
+
+def parse_array(singleton: dict, key: str, typecode: str) -> array:
+    values = singleton[key]["Array"].split()
+    return array(typecode, map(int, values) if typecode == "H" else map(float, values))
+
+
+def extract_layers(data: dict) -> MapLayers:
+    """ all layers of loaded map data, each singleton array and entity is visited once """
+    singletons = data["Singletons"]
+    width, height = TimberbornMapSize.load(singletons["MapSize"])["Size"].value
+    cells = width * height
+    layers = MapLayers(
+        width=width,
+        height=height,
+        heights=parse_array(singletons["TerrainMap"], "Heights", "H"),
+        depths=parse_array(singletons["WaterMap"], "WaterDepths", "f"),
+        moisture=parse_array(singletons["SoilMoistureSimulator"], "MoistureLevels", "f"),
+        trees=bytearray(cells),
+    )
+    for name in ("heights", "depths", "moisture"):
+        if len(getattr(layers, name)) != cells:
+            raise ValueError(f"Map has {len(getattr(layers, name))} {name} values, expected {width} x {height}")
+
+    for entity in data.get("Entities", []):
+        template = entity.get("TemplateName") or entity.get("Template")
+        species = TREE_TEMPLATES.get(template)
+        coordinates = get_coordinates(entity) if species else None
+        if coordinates is None or not (0 <= coordinates[0] < width and 0 <= coordinates[1] < height):
+            layers.skipped[str(template)] += 1
+            continue
+        export_species = TREE_EXPORT_SPECIES[species]
+        if export_species is not species:
+            layers.replaced[template] += 1
+        layers.trees[coordinates[0] + coordinates[1] * width] = TREE_GREYS[export_species]
+    return layers
+
+
+def gray16_image(values: Iterable[int], size: Tuple[int, int]) -> Image.Image:
+    pixels = array("H", values)
+    if sys.byteorder != "little":
+        pixels.byteswap()
+    return Image.frombytes("I;16", size, pixels.tobytes())
+
+
+def scaled(values: array, scale: int) -> Iterable[int]:
+    return (min(max(round(value * scale), 0), 0xFFFF) for value in values)
+
+
+def layer_images(layers: MapLayers) -> Dict[str, Image.Image]:
+    """ layer name -> image, mirrored the way images are read by conversion
+
+    'heights' are heights as is, 'water' is water mask and 'trees' are species as tree image greys, those make up
+    the spec. 'depths' and 'moisture' keep exact values as 16-bit fixed point, see DEPTH_SCALE and MOISTURE_SCALE.
+    """
+    size = layers.size
+    images = {
+        "heights": gray16_image(layers.heights, size),
+        "water": Image.frombytes("L", size, bytes(255 if depth > 0 else 0 for depth in layers.depths)),
+        "depths": gray16_image(scaled(layers.depths, DEPTH_SCALE), size),
+        "moisture": gray16_image(scaled(layers.moisture, MOISTURE_SCALE), size),
+        "trees": Image.frombytes("L", size, bytes(layers.trees)),
+    }
+    return {name: ImageOps.mirror(image) for name, image in images.items()}
+
+
+def tree_cutoffs(greys: Iterable[int]) -> Optional[Dict[str, float]]:
+    """ treemap cutoffs that give back exported species, None if image can't be normalized
+
+    Tree images are normalized by their own range, so cutoffs lie halfway between normalized greys.
+    """
+    present = set(greys)
+    low, high = min(present), max(present)
+    if low == high:
+        return None
+    levels = [(grey - low) / (high - low) for grey in (0, *sorted(TREE_GREYS.values()))]
+    halfway = [round((a + b) / 2, 4) for a, b in zip(levels, levels[1:])]
+    return {
+        "treeline_cutoff": halfway[0],
+        "birch_cutoff": halfway[1],
+        "pine_cutoff": halfway[2],
+        "chestnut_cutoff": halfway[2],
+    }
+
+
+def layers_spec(layers: MapLayers, filenames: Dict[str, str]) -> dict:
+    """ spec that makes the map back from 'heights', 'water' and 'trees' images
+
+    Terrain and species of trees on tiles come back as they are. Water comes back as mask, deeper water
+    and all entities other than trees are lost.
+    """
+    min_height, max_height = min(layers.heights), max(layers.heights)
+    if min_height == max_height:
+        logging.warning("Map terrain is flat, conversion can't normalize its height image")
+    spec = {
+        "heightmap": {
+            "filename": filenames["heights"],
+            "linear_conversion": {"min_height": min_height, "max_height": max_height},
+        }
+    }
+    if any(depth > 1 for depth in layers.depths):
+        logging.warning("Map has water deeper than 1, spec only keeps where water is, see depths image")
+    if all(layers.depths):
+        logging.warning("Every tile has water, conversion can't normalize water image, spec leaves it out")
+    elif any(layers.depths):
+        spec["watermap"] = {"filename": filenames["water"]}
+    if any(layers.trees):
+        cutoffs = tree_cutoffs(layers.trees)
+        if cutoffs is None:
+            logging.warning("Every tile has a tree of one species, conversion can't normalize tree image")
+        else:
+            spec["treemap"] = {"filename": filenames["trees"], **cutoffs}
+    return spec
+
+
+def encode_layers(layers: MapLayers, name: str) -> Dict[str, bytes]:
+    """ file name -> file contents of layer PNGs and `<name>_spec.json` referring to them """
+    files = {}
+    filenames = {}
+    for layer, image in layer_images(layers).items():
+        filenames[layer] = f"{name}_{layer}.png"
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        files[filenames[layer]] = buffer.getvalue()
+    files[f"{name}_spec.json"] = codec.dumps(layers_spec(layers, filenames), indent=4).encode()
+    return files
+
+
+def report_lost_entities(layers: MapLayers, name: str) -> None:
+    for template, count in layers.replaced.items():
+        logging.info(f"'{name}': {count} {template} exported as {TREE_EXPORT_SPECIES[TREE_TEMPLATES[template]].value[0]}")
+    if layers.skipped:
+        details = ", ".join(f"{template}: {count}" for template, count in layers.skipped.most_common())
+        logging.info(f"'{name}': {sum(layers.skipped.values())} entities not in layers ({details})")
+
+
+def write_layers(data: dict, spec_path: Path) -> List[Path]:
+    """ write layer images and spec file of loaded map data, images are named after spec and put next to it """
+    name = spec_path.stem[:-len("_spec")] if spec_path.stem.endswith("_spec") else spec_path.stem
+    layers = extract_layers(data)
+    report_lost_entities(layers, name)
+    paths = []
+    for filename, contents in encode_layers(layers, name).items():
+        path = spec_path if filename.endswith("_spec.json") else spec_path.with_name(filename)
+        write_atomic(path, contents)
+        paths.append(path)
+    logging.info(f"Exported layers of {layers.width} x {layers.height} map, spec: '{spec_path}'")
+    return paths
+
+
+def export_map_file(path: str, spec_path: str) -> Optional[str]:
+    """ batch job, returns error message instead of raising so one broken map doesn't stop the batch """
+    try:
+        write_layers(load_map_file(Path(path)), Path(spec_path))
+    except Exception as exc:
+        return f"{type(exc).__name__}: {exc}"
+    return None
+
+
+def _export_maps(jobs: List[Tuple[str, str]], workers: int) -> Iterator[Optional[str]]:
+    workers = workers if workers > 0 else (os.cpu_count() or 1)
+    if workers == 1 or len(jobs) < PARALLEL_MIN_MAPS:
+        for job in jobs:
+            yield export_map_file(*job)
+        return
+
+    logging.info(f"Exporting {len(jobs)} maps using {workers} processes")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(export_map_file, *zip(*jobs), chunksize=max(1, len(jobs) // (workers * 4)))
+
+
+def export_library(directory: Path, output_dir: Path, workers: int = 0) -> Tuple[int, int]:
+    """ export layers of every map in `directory` into `output_dir`, returns counts of exported and failed maps """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    paths = sorted(directory.glob(f"*{GameDefs.MAP_SUFFIX.value}"))
+    jobs = [(str(path), str(output_dir / f"{path.stem}_spec.json")) for path in paths]
+
+    failed = 0
+    with progress("Exporting maps", len(jobs)) as maps_progress:
+        for done, (path, error) in enumerate(zip(paths, _export_maps(jobs, workers)), start=1):
+            maps_progress.update(done)
+            if error:
+                failed += 1
+                logging.warning(f"Can't export '{path.name}': {error}")
+    logging.info(f"Exported {len(jobs) - failed} of {len(jobs)} maps from '{directory}' into '{output_dir}'")
+    return len(jobs) - failed, failed
@@ -0,0 +1,333 @@
+#  _    _ _
+# | |  (_) |__ _ _ __ _ _ _ _  _
+# | |__| | '_ \ '_/ _` | '_| || |
+# |____|_|_.__/_| \__,_|_|  \_, |
+#                           |__/
+# Library
+import io
+import logging
+import os
+import re
+import sqlite3
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from hashlib import sha1
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+from zipfile import BadZipFile, ZipFile
+
+from ..base import GameDefs
+from ..progress import progress
+from . import codec
+from .format import INTERNAL_ARC_NAME
+from .pyramid import HeightPyramid
+
+LIBRARY_SCHEMA_VERSION = 1
+THUMBNAIL_SIZE = (64, 64)
+# below this many new or changed maps indexing runs in the main process
+PARALLEL_MIN_MAPS = 8
+
+# top-level values are written before singletons or after entities, so they are searched near the ends only
+HEAD_SIZE = 4096
+GAME_VERSION_RE = re.compile(r'"GameVersion"\s*:\s*"([^"]*)"')
+MAPPER_VERSION_RE = re.compile(r'"MapperVersion"\s*:\s*"([^"]*)"')
+MAP_SIZE_RE = re.compile(r'"MapSize"\s*:\s*\{\s*"Size"\s*:\s*\{\s*"X"\s*:\s*(\d+)\s*,\s*"Y"\s*:\s*(\d+)')
+HEIGHTS_RE = re.compile(r'"TerrainMap"\s*:\s*\{\s*"Heights"\s*:\s*\{\s*"Array"\s*:\s*"([^"]*)"')
+ENTITIES_RE = re.compile(r'"Entities"\s*:\s*\[')
+TEMPLATE_RE = re.compile(r'"Template(?:Name)?"\s*:\s*"([^"]*)"')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS maps (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    file_size INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    game_version TEXT,
+    game_version_key TEXT,
+    mapper_version TEXT,
+    terrain_hash TEXT,
+    entity_count INTEGER,
+    thumbnail BLOB,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS maps_directory ON maps (directory);
+CREATE INDEX IF NOT EXISTS maps_size ON maps (width, height);
+CREATE INDEX IF NOT EXISTS maps_game_version ON maps (game_version_key);
+CREATE TABLE IF NOT EXISTS entity_counts (
+    path TEXT NOT NULL REFERENCES maps (path) ON DELETE CASCADE,
+    template TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (path, template)
+);
+CREATE INDEX IF NOT EXISTS entity_counts_template ON entity_counts (template);
+"""
+
+
+def version_key(version: Optional[str]) -> Optional[str]:
+    """ '0.4.9.3-6c7fb02-sw' -> sortable text, numeric parts zero padded """
+    if not version:
+        return None
+    numeric = version.split("-")[0]
+    return ".".join(part.zfill(8) if part.isdigit() else part for part in numeric.split("."))
+
+
+@dataclass
+class MapRecord:
+    path: str
+    mtime_ns: int
+    file_size: int
+    width: Optional[int] = None
+    height: Optional[int] = None
+    game_version: Optional[str] = None
+    mapper_version: Optional[str] = None
+    terrain_hash: Optional[str] = None
+    templates: Dict[str, int] = field(default_factory=dict)
+    thumbnail: Optional[bytes] = None
+    error: Optional[str] = None
+
+    @property
+    def entity_count(self) -> int:
+        return sum(self.templates.values())
+
+
+def read_map_text(path: Path) -> str:
+    with ZipFile(path) as timber_zip:
+        namelist = timber_zip.namelist()
+        if INTERNAL_ARC_NAME in namelist:
+            name = INTERNAL_ARC_NAME
+        else:
+            name = next((n for n in namelist if n.endswith(".json")), None)
+            if name is None:
+                raise ValueError("archive doesn't contain a .json file")
+        return timber_zip.read(name).decode("utf-8")
+
+
+def scan_map_text(record: MapRecord, text: str) -> None:
+    """ fill record from map text without decoding the whole JSON document
+
+    Values are picked by patterns, as they are laid out by the game and by this tool.
+    Documents with other layout are fully decoded as a fallback.
+    """
+    ends = text[:HEAD_SIZE] + text[-HEAD_SIZE:]
+    game_version = GAME_VERSION_RE.search(ends)
+    map_size = MAP_SIZE_RE.search(text)
+    heights = HEIGHTS_RE.search(text)
+    entities = ENTITIES_RE.search(text)
+    if not (map_size and heights and entities):
+        scan_map_data(record, codec.loads(text))
+        return
+
+    mapper_version = MAPPER_VERSION_RE.search(ends)
+    record.game_version = game_version.group(1) if game_version else None
+    record.mapper_version = mapper_version.group(1) if mapper_version else None
+    record.width, record.height = int(map_size.group(1)), int(map_size.group(2))
+    set_terrain(record, heights.group(1))
+    record.templates = dict(Counter(match.group(1) for match in TEMPLATE_RE.finditer(text, entities.end())))
+
+
+def text_value(data: dict, key: str) -> Optional[str]:
+    """ optional text of a map document, other types are malformed maps """
+    value = data.get(key)
+    if value is not None and not isinstance(value, str):
+        raise TypeError(f"{key} is {type(value).__name__}, expected text")
+    return value
+
+
+def scan_map_data(record: MapRecord, data: dict) -> None:
+    size = data["Singletons"]["MapSize"]["Size"]
+    record.game_version = text_value(data, "GameVersion")
+    record.mapper_version = text_value(data, "MapperVersion")
+    record.width, record.height = int(size["X"]), int(size["Y"])
+    set_terrain(record, data["Singletons"]["TerrainMap"]["Heights"]["Array"])
+    record.templates = dict(Counter(
+        str(entity.get("TemplateName") or entity.get("Template")) for entity in data.get("Entities", [])
+    ))
+
+
+def set_terrain(record: MapRecord, heights_text: str) -> None:
+    # same hash as maps.diff.terrain_hash()
+    record.terrain_hash = sha1(heights_text.encode("utf-8")).hexdigest()
+    heights = [int(value) for value in heights_text.split()]
+    if len(heights) != record.width * record.height:
+        raise ValueError(f"terrain has {len(heights)} cells, expected {record.width} x {record.height}")
+    image = HeightPyramid(heights, record.width, record.height).image(*THUMBNAIL_SIZE)
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    record.thumbnail = buffer.getvalue()
+
+
+def index_map(path: str, mtime_ns: int, file_size: int) -> MapRecord:
+    """ read metadata of one map, errors are stored in record so broken files are not retried until changed """
+    record = MapRecord(path, mtime_ns, file_size)
+    try:
+        scan_map_text(record, read_map_text(Path(path)))
+    # zlib.error is a broken deflate stream, RuntimeError an encrypted entry
+    except (OSError, BadZipFile, ValueError, KeyError, TypeError, UnicodeDecodeError, zlib.error, RuntimeError) as exc:
+        record.error = f"{type(exc).__name__}: {exc}"
+    return record
+
+
+@dataclass
+class RefreshStats:
+    total: int = 0
+    indexed: int = 0
+    removed: int = 0
+    failed: int = 0
+
+
+class MapLibrary:
+    """ SQLite index of maps in directories, refreshed incrementally by file mtime and size """
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(str(db_path))
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self._prepare_schema()
+
+    def _prepare_schema(self) -> None:
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != LIBRARY_SCHEMA_VERSION:
+            if version:
+                logging.info("Library index was made by other version, rebuilding it")
+            self.connection.executescript("DROP TABLE IF EXISTS entity_counts; DROP TABLE IF EXISTS maps;")
+            self.connection.execute(f"PRAGMA user_version = {LIBRARY_SCHEMA_VERSION}")
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "MapLibrary":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def refresh(self, directory: Path, workers: int = 0) -> RefreshStats:
+        directory = directory.resolve()
+        stats = RefreshStats()
+        known = {
+            row["path"]: (row["mtime_ns"], row["file_size"])
+            for row in self.connection.execute("SELECT path, mtime_ns, file_size FROM maps WHERE directory = ?",
+                                               (str(directory),))
+        }
+
+        pending: List[Tuple[str, int, int]] = []
+        for path in sorted(directory.glob(f"*{GameDefs.MAP_SUFFIX.value}")):
+            stat = path.stat()
+            stats.total += 1
+            key = str(path)
+            if known.pop(key, None) != (stat.st_mtime_ns, stat.st_size):
+                pending.append((key, stat.st_mtime_ns, stat.st_size))
+
+        with self.connection:
+            for key in known:
+                self.connection.execute("DELETE FROM maps WHERE path = ?", (key,))
+            stats.removed = len(known)
+
+            with progress("Indexing maps", len(pending)) as maps_progress:
+                for record in self._index_maps(pending, workers):
+                    self._store(directory, record)
+                    stats.indexed += 1
+                    maps_progress.update(stats.indexed)
+                    if record.error:
+                        stats.failed += 1
+                        logging.warning(f"Can't index '{Path(record.path).name}': {record.error}")
+        return stats
+
+    def _index_maps(self, pending: List[Tuple[str, int, int]], workers: int) -> Iterable[MapRecord]:
+        if not pending:
+            return
+        workers = workers if workers > 0 else (os.cpu_count() or 1)
+        if workers == 1 or len(pending) < PARALLEL_MIN_MAPS:
+            for args in pending:
+                yield index_map(*args)
+            return
+
+        logging.info(f"Indexing {len(pending)} maps using {workers} processes")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(index_map, *zip(*pending), chunksize=max(1, len(pending) // (workers * 4)))
+
+    def _store(self, directory: Path, record: MapRecord) -> None:
+        self.connection.execute("DELETE FROM maps WHERE path = ?", (record.path,))
+        self.connection.execute(
+            "INSERT INTO maps (path, directory, mtime_ns, file_size, width, height, game_version, game_version_key,"
+            " mapper_version, terrain_hash, entity_count, thumbnail, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (record.path, str(directory), record.mtime_ns, record.file_size, record.width, record.height,
+             record.game_version, version_key(record.game_version), record.mapper_version, record.terrain_hash,
+             record.entity_count, record.thumbnail, record.error)
+        )
+        self.connection.executemany(
+            "INSERT INTO entity_counts (path, template, count) VALUES (?, ?, ?)",
+            ((record.path, template, count) for template, count in record.templates.items())
+        )
+
+    def query(
+        self,
+        directory: Optional[Path] = None,
+        size: Optional[Tuple[int, int]] = None,
+        version_below: Optional[str] = None,
+        template: Optional[str] = None,
+    ) -> List[sqlite3.Row]:
+        """ maps matching all given filters, sorted by path """
+        conditions = ["error IS NULL"]
+        params: list = []
+        if directory is not None:
+            conditions.append("directory = ?")
+            params.append(str(directory.resolve()))
+        if size is not None:
+            conditions.append("width = ? AND height = ?")
+            params.extend(size)
+        if version_below is not None:
+            conditions.append("game_version_key < ?")
+            params.append(version_key(version_below))
+        if template is not None:
+            conditions.append("path IN (SELECT path FROM entity_counts WHERE template = ?)")
+            params.append(template)
+        return self.connection.execute(
+            f"SELECT * FROM maps WHERE {' AND '.join(conditions)} ORDER BY path", params
+        ).fetchall()
+
+    def entity_counts(self, path: str) -> Dict[str, int]:
+        rows = self.connection.execute("SELECT template, count FROM entity_counts WHERE path = ? ORDER BY template", (path,))
+        return {row["template"]: row["count"] for row in rows}
+
+    def thumbnail(self, path: str) -> Optional[bytes]:
+        row = self.connection.execute("SELECT thumbnail FROM maps WHERE path = ?", (path,)).fetchone()
+        return row["thumbnail"] if row else None
+
+
+def parse_map_size(value: str) -> Tuple[int, int]:
+    """ '256x256' -> (256, 256) """
+    match = re.fullmatch(r"\s*(\d+)\s*[xX*]\s*(\d+)\s*", value)
+    if not match:
+        raise ValueError(f"Can't parse map size '{value}', expected WIDTHxHEIGHT like 256x256")
+    return int(match.group(1)), int(match.group(2))
+
+
+def index_library(directory: Path, config, db_path: Path) -> List[sqlite3.Row]:
+    """ refresh index of maps in `directory` and print maps matching query options from `config` """
+    with MapLibrary(db_path) as library:
+        stats = library.refresh(directory, workers=config.index_workers)
+        logging.info(
+            f"Library '{directory}': {stats.total} maps, {stats.indexed} (re)indexed, {stats.removed} removed,"
+            f" {stats.failed} failed"
+        )
+        rows = library.query(
+            directory,
+            size=parse_map_size(config.query_size) if config.query_size else None,
+            version_below=config.query_version_below or None,
+            template=config.query_template or None,
+        )
+
+    print(f"\n{'Map': <40} {'Size': >9} {'Game version': <22} {'Mapper': <10} {'Entities': >8}")
+    for row in rows:
+        size = f"{row['width']}x{row['height']}"
+        print(f"{Path(row['path']).name: <40} {size: >9} {row['game_version'] or '-': <22}"
+              f" {row['mapper_version'] or '-': <10} {row['entity_count']: >8}")
+    print(f"{len(rows)} maps found")
+    return rows
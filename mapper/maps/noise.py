@@ -0,0 +1,187 @@
+#  _  _     _
+# | \| |___(_)___ ___
+# | .` / _ \ (_-</ -_)
+# |_|\_\___/_/__/\___|
+# Procedural terrain
+import logging
+from array import array
+from dataclasses import dataclass, fields, replace
+from functools import lru_cache
+from time import time
+from typing import Dict, Tuple
+
+from ..image_utils import ImageSource, MapImage, load_map_image, predict_image_size
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    NUMPY_AVAILABLE = False
+else:
+    NUMPY_AVAILABLE = True
+
+# layer file names starting with it are generated, like 'noise:seed=7,octaves=6,falloff=0.8,layer=water'
+NOISE_PREFIX = "noise:"
+NOISE_LAYERS = ("height", "water", "trees")
+# size of generated layers when spec has no width and height
+DEFAULT_NOISE_SIZE = 256
+
+
+@dataclass(frozen=True)
+class NoiseSpec:
+    """ Fractal gradient noise, layers of one spec that only differ in `layer` match each other
+
+    'height' is normalized terrain, 'water' is 1 below `sea` level, 'trees' is density of forest noise,
+    0 under water, so each can stand in for an image in a map spec.
+    """
+    seed: int = 0
+    octaves: int = 5
+    frequency: float = 4.0  # features of the first octave across the longer side of the map
+    persistence: float = 0.5  # amplitude multiplier of each next octave
+    lacunarity: float = 2.0  # frequency multiplier of each next octave
+    ridge: float = 0.0  # 0 - rolling hills, 1 - sharp ridges, in between is a blend
+    falloff: float = 0.0  # 0 - none, 1 - edges of the map drop to the lowest level, makes islands
+    sea: float = 0.2  # normalized height below which 'water' layer is set
+    forest: float = 1.0  # multiplier of 'trees' layer
+    layer: str = "height"
+
+
+def is_noise_source(source: ImageSource) -> bool:
+    return isinstance(source, str) and source.startswith(NOISE_PREFIX)
+
+
+def parse_noise_source(source: str) -> NoiseSpec:
+    """ 'noise:seed=7,octaves=6,ridge=0.5,layer=trees' -> NoiseSpec, omitted parameters keep defaults """
+    defaults = NoiseSpec()
+    types = {field.name: type(getattr(defaults, field.name)) for field in fields(NoiseSpec)}
+    values = {}
+    for item in filter(str.strip, source[len(NOISE_PREFIX):].split(",")):
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if key not in types or not value.strip():
+            raise ValueError(f"Can't parse '{item.strip()}' of '{source}', expected key=value with keys: {', '.join(types)}")
+        values[key] = types[key](value.strip())
+    spec = replace(defaults, **values)
+    if spec.layer not in NOISE_LAYERS:
+        raise ValueError(f"Unknown noise layer '{spec.layer}', expected one of: {', '.join(NOISE_LAYERS)}")
+    if spec.octaves < 1:
+        raise ValueError(f"Noise needs at least one octave, got {spec.octaves}")
+    return spec
+
+
+def _gradient_noise(x: "np.ndarray", y: "np.ndarray", permutation: "np.ndarray") -> "np.ndarray":
+    """ 2D gradient (Perlin) noise in -1..1, `x` is an increasing row of coordinates and `y` a column of them
+
+    Gradients are looked up for lattice corners only and repeated over cells between them, noise repeats every
+    256 lattice cells.
+    """
+    x0, y0 = np.floor(x), np.floor(y)
+    dx, dy = (x - x0).astype(np.float32), (y - y0).astype(np.float32)
+    u, v = dx * dx * dx * (dx * (dx * 6 - 15) + 10), dy * dy * dy * (dy * (dy * 6 - 15) + 10)
+    lattice_x, count_x = np.unique(x0.astype(np.int64), return_counts=True)
+    lattice_y, count_y = np.unique(y0.astype(np.int64), return_counts=True)
+    lattice_x, lattice_y = np.append(lattice_x, lattice_x[-1] + 1), np.append(lattice_y, lattice_y[-1] + 1)
+
+    # gradient of lattice corner (x, y) is picked by permutation[permutation[x] + y]
+    angles = permutation.astype(np.float32) * np.float32(2 * np.pi / 256)
+    gradients = np.exp(1j * angles).astype(np.complex64)
+    lattice = gradients[permutation[(permutation[lattice_x & 255][None, :] + lattice_y[:, None]) & 255]]
+
+    def corner(ox: int, oy: int) -> "np.ndarray":
+        rows = lattice[oy:len(lattice_y) - 1 + oy, ox:len(lattice_x) - 1 + ox]
+        gradient = np.repeat(np.repeat(rows, count_y, axis=0), count_x, axis=1)
+        return gradient.real * (dx - ox) + gradient.imag * (dy - oy)
+
+    top_left, bottom_left = corner(0, 0), corner(0, 1)
+    top = top_left + u * (corner(1, 0) - top_left)
+    bottom = bottom_left + u * (corner(1, 1) - bottom_left)
+    return (top + v * (bottom - top)) * np.float32(np.sqrt(2))
+
+
+def fractal_noise(width: int, height: int, spec: NoiseSpec, seed: int) -> "np.ndarray":
+    """ (height, width) grid of octaves summed up and normalized to 0..1 """
+    rng = np.random.default_rng(seed)
+    scale = spec.frequency / max(width, height)
+    xs, ys = np.arange(width, dtype=np.float64) * scale, np.arange(height, dtype=np.float64)[:, None] * scale
+    grid = np.zeros((height, width))
+    amplitude, frequency = 1.0, 1.0
+    for _ in range(spec.octaves):
+        permutation = rng.permutation(256)
+        shift_x, shift_y = rng.random(2) * 256
+        octave = _gradient_noise(xs * frequency + shift_x, ys * frequency + shift_y, permutation)
+        if spec.ridge:
+            octave = (1 - spec.ridge) * octave + spec.ridge * (1 - 2 * np.abs(octave))
+        grid += amplitude * octave
+        amplitude *= spec.persistence
+        frequency *= spec.lacunarity
+    if spec.falloff:
+        # distance from center, 1 at the middle of edges
+        distance = np.hypot(np.linspace(-1, 1, width), np.linspace(-1, 1, height)[:, None])
+        edge = np.clip(distance, 0, 1) ** 2 * (3 - 2 * np.clip(distance, 0, 1))
+        grid = (grid - grid.min()) * (1 - spec.falloff * edge)
+    low, high = grid.min(), grid.max()
+    return (grid - low) / (high - low) if high > low else np.zeros_like(grid)
+
+
+@lru_cache(maxsize=4)
+def noise_layers(spec: NoiseSpec, width: int, height: int) -> Dict[str, array]:
+    """ normalized values of all layers, row by row, spec layer is ignored
+
+    Layers are made together and cached, so height, water and trees stages of one map generate noise once.
+    """
+    if not NUMPY_AVAILABLE:
+        raise ModuleNotFoundError("numpy is required for procedural terrain, install it or use images")
+    t = -time()
+    heights = fractal_noise(width, height, spec, spec.seed)
+    water = heights < spec.sea
+    forest = fractal_noise(width, height, replace(spec, octaves=min(spec.octaves, 3), ridge=0.0, falloff=0.0), spec.seed + 1)
+    trees = np.where(water, 0.0, np.clip(forest * spec.forest, 0.0, 1.0))
+    layers = {
+        "height": array("d", heights.tobytes()),
+        "water": array("d", water.astype(np.float64).tobytes()),
+        "trees": array("d", trees.tobytes()),
+    }
+    logging.info(f"Generated {width} x {height} noise layers in {t + time():.2f} sec.")
+    return layers
+
+
+class NoiseImage(MapImage):
+    """ MapImage of generated layer, it has no decoded image and its data is normalized already """
+
+    def __init__(self, data: array, size: Tuple[int, int]):
+        self._size = size
+        self._normalized_data = data
+
+
+def noise_size(width: int, height: int) -> Tuple[int, int]:
+    return (width if width > 0 else DEFAULT_NOISE_SIZE, height if height > 0 else DEFAULT_NOISE_SIZE)
+
+
+def predict_layer_size(source: ImageSource, width: int, height: int) -> Tuple[int, int]:
+    """ predict_image_size() that also knows noise sources """
+    if is_noise_source(source):
+        return noise_size(width, height)
+    return predict_image_size(source, width, height)
+
+
+def load_layer_image(source: ImageSource, width: int, height: int) -> MapImage:
+    """ load_map_image() that generates noise sources """
+    if is_noise_source(source):
+        spec = parse_noise_source(source)
+        size = noise_size(width, height)
+        return NoiseImage(noise_layers(replace(spec, layer="height"), *size)[spec.layer], size)
+    return load_map_image(source, width, height)
+
+
+def noise_map_spec(width: int, height: int, seed: int = 0, **noise: object) -> dict:
+    """ map spec of height, water and trees noise layers, `noise` overrides NoiseSpec parameters """
+    params = ",".join(f"{key}={value}" for key, value in {"seed": seed, **noise}.items())
+    return {
+        "width": width,
+        "height": height,
+        "heightmap": {
+            "filename": f"{NOISE_PREFIX}{params}",
+            "linear_conversion": {"min_height": 3, "max_height": 16},
+        },
+        "watermap": {"filename": f"{NOISE_PREFIX}{params},layer=water"},
+        "treemap": {"filename": f"{NOISE_PREFIX}{params},layer=trees", "treeline_cutoff": 0.5},
+    }
@@ -0,0 +1,172 @@
+#  ___
+# | _ \_ _ ___ _ __ _ _ ___  __ ___ ______
+# |  _/ '_/ -_) '_ \ '_/ _ \/ _/ -_|_-<_-<
+# |_| |_| \___| .__/_| \___/\__\___/__/__/
+#             |_|
+# Terrain preprocessing
+import logging
+from array import array
+from dataclasses import dataclass
+from time import time
+from typing import Sequence, Tuple
+
+from ..progress import progress
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    NUMPY_AVAILABLE = False
+else:
+    NUMPY_AVAILABLE = True
+
+
+@dataclass
+class TerrainPreprocessingSpec:
+    """ Kernels applied to normalized heights (0..1) before they are quantized, in order of fields
+
+    Thresholds and slopes are in the same 0..1 units, e.g. 0.05 is 5% of the image height range.
+    Each kernel is disabled by zero iterations or threshold.
+    """
+    spike_threshold: float = 0.0  # cells further than that from the median of their neighbours are replaced by it
+    thermal_iterations: int = 0
+    talus: float = 0.02  # steepest slope between neighbours that thermal erosion leaves as is
+    thermal_rate: float = 0.5  # part of excess slope moved per iteration
+    hydraulic_iterations: int = 0
+    rain: float = 0.01  # water added to every cell per iteration
+    capacity: float = 0.05  # sediment that water can carry per unit of flow
+    erosion_rate: float = 0.3
+    deposition_rate: float = 0.3
+    evaporation: float = 0.1
+    smoothing_iterations: int = 0
+    smoothing_edge: float = 0.03  # neighbours that differ more are kept out of the average, so cliffs stay sharp
+
+    @property
+    def is_enabled(self) -> bool:
+        return bool(self.spike_threshold > 0 or self.thermal_iterations or self.hydraulic_iterations
+                    or self.smoothing_iterations)
+
+
+def _padded(grid: "np.ndarray") -> "np.ndarray":
+    # map edge repeats outwards, so nothing flows off the map and edge cells have no artificial slopes
+    return np.pad(grid, 1, mode="edge")
+
+
+def _neighbours4(padded: "np.ndarray") -> Tuple["np.ndarray", ...]:
+    """ views of left, right, up and down neighbour of every cell """
+    return (padded[1:-1, :-2], padded[1:-1, 2:], padded[:-2, 1:-1], padded[2:, 1:-1])
+
+
+def _neighbours8(padded: "np.ndarray") -> Tuple["np.ndarray", ...]:
+    height, width = padded.shape[0] - 2, padded.shape[1] - 2
+    return tuple(
+        padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+        for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy
+    )
+
+
+def _scatter4(flows: Sequence["np.ndarray"]) -> "np.ndarray":
+    """ amount every cell receives, when each cell sends flows[k] to its k-th neighbour as in _neighbours4() """
+    received = np.zeros((flows[0].shape[0] + 2, flows[0].shape[1] + 2))
+    received[1:-1, :-2] += flows[0]
+    received[1:-1, 2:] += flows[1]
+    received[:-2, 1:-1] += flows[2]
+    received[2:, 1:-1] += flows[3]
+    # flows into padding are reflected back, edge cells keep what they tried to send outside
+    received[1:-1, 1] += received[1:-1, 0]
+    received[1:-1, -2] += received[1:-1, -1]
+    received[1, 1:-1] += received[0, 1:-1]
+    received[-2, 1:-1] += received[-1, 1:-1]
+    return received[1:-1, 1:-1]
+
+
+def remove_spikes(grid: "np.ndarray", threshold: float) -> "np.ndarray":
+    median = np.median(np.stack(_neighbours8(_padded(grid))), axis=0)
+    spikes = np.abs(grid - median) > threshold
+    logging.debug(f"Removed {int(spikes.sum())} spikes")
+    return np.where(spikes, median, grid)
+
+
+def thermal_erosion(grid: "np.ndarray", iterations: int, talus: float, rate: float) -> "np.ndarray":
+    """ material slides from slopes steeper than `talus` to lower neighbours, proportionally to their drop """
+    with progress("Thermal erosion", iterations) as iterations_progress:
+        for iteration in range(iterations):
+            drops = [np.maximum(grid - neighbour, 0.0) for neighbour in _neighbours4(_padded(grid))]
+            max_drop = np.maximum.reduce(drops)
+            steep = [np.where(drop > talus, drop, 0.0) for drop in drops]
+            total = np.add.reduce(steep)
+            moved = np.where(max_drop > talus, rate * (max_drop - talus) / 2, 0.0)
+            share = np.divide(moved, total, out=np.zeros_like(moved), where=total > 0)
+            flows = [share * drop for drop in steep]
+            grid = grid - np.add.reduce(flows) + _scatter4(flows)
+            iterations_progress.update(iteration + 1)
+    return grid
+
+
+def hydraulic_erosion(grid: "np.ndarray", spec: TerrainPreprocessingSpec) -> "np.ndarray":
+    """ rain water runs down the water surface, carrying sediment it erodes and dropping it where it slows down """
+    water = np.zeros_like(grid)
+    sediment = np.zeros_like(grid)
+    with progress("Hydraulic erosion", spec.hydraulic_iterations) as iterations_progress:
+        for iteration in range(spec.hydraulic_iterations):
+            water += spec.rain
+            surface = grid + water
+            drops = [np.maximum(surface - neighbour, 0.0) for neighbour in _neighbours4(_padded(surface))]
+            total = np.add.reduce(drops)
+            outflow = np.minimum(water, np.maximum.reduce(drops) / 2)
+            share = np.divide(outflow, total, out=np.zeros_like(outflow), where=total > 0)
+
+            capacity = spec.capacity * outflow
+            difference = capacity - sediment
+            change = np.where(difference > 0, spec.erosion_rate * difference, spec.deposition_rate * difference)
+            grid = grid - change
+            sediment = sediment + change
+
+            carried = np.divide(sediment, water, out=np.zeros_like(sediment), where=water > 0)
+            water_flows = [share * drop for drop in drops]
+            sediment_flows = [flow * carried for flow in water_flows]
+            water = water - outflow + _scatter4(water_flows)
+            sediment = sediment - np.add.reduce(sediment_flows) + _scatter4(sediment_flows)
+            water *= 1 - spec.evaporation
+            iterations_progress.update(iteration + 1)
+    return grid + sediment
+
+
+def smooth(grid: "np.ndarray", iterations: int, edge: float) -> "np.ndarray":
+    """ average with neighbours of similar height only, edges steeper than `edge` are preserved """
+    with progress("Smoothing", iterations) as iterations_progress:
+        for iteration in range(iterations):
+            total = grid.copy()
+            count = np.ones_like(grid)
+            for neighbour in _neighbours8(_padded(grid)):
+                similar = np.abs(neighbour - grid) <= edge
+                total += np.where(similar, neighbour, 0.0)
+                count += similar
+            grid = total / count
+            iterations_progress.update(iteration + 1)
+    return grid
+
+
+def preprocess_terrain(data: Sequence[float], width: int, height: int, spec: TerrainPreprocessingSpec) -> Sequence[float]:
+    """ normalized heights -> processed normalized heights, enabled kernels need numpy
+
+    Spec that enables kernels fails without numpy, skipping them would make a different map from the same spec.
+    """
+    if not spec.is_enabled:
+        return data
+    if not NUMPY_AVAILABLE:
+        raise ModuleNotFoundError("numpy is required for terrain preprocessing set in the spec, install it"
+                                  " or remove 'preprocessing' from the heightmap spec")
+
+    t = -time()
+    grid = np.frombuffer(array("d", data), dtype=np.float64).reshape(height, width)
+    if spec.spike_threshold > 0:
+        grid = remove_spikes(grid, spec.spike_threshold)
+    if spec.thermal_iterations:
+        grid = thermal_erosion(grid, spec.thermal_iterations, spec.talus, spec.thermal_rate)
+    if spec.hydraulic_iterations:
+        grid = hydraulic_erosion(grid, spec)
+    if spec.smoothing_iterations:
+        grid = smooth(grid, spec.smoothing_iterations, spec.smoothing_edge)
+    grid = np.clip(grid, 0.0, 1.0)
+    logging.info(f"Preprocessed terrain in {t + time():.2f} sec.")
+    return array("d", grid.tobytes())
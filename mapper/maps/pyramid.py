@@ -0,0 +1,122 @@
+#  ___                     _    _
+# | _ \_  _ _ _ __ _ _ __ (_)__| |
+# |  _/ || | '_/ _` | '  \| / _` |
+# |_|  \_, |_| \__,_|_|_|_|_\__,_|
+#      |__/
+# Pyramid
+import logging
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from hashlib import sha1
+from math import floor
+from typing import List, Sequence, Tuple
+
+from PIL import Image
+
+# number of pyramids of loaded maps kept in memory
+PYRAMID_CACHE_SIZE = 8
+
+
+@dataclass
+class PyramidLevel:
+    """ heights reduced 2^n times, each cell keeps min, max and mean of the cells it covers """
+    width: int
+    height: int
+    minimum: Sequence[int]
+    maximum: Sequence[int]
+    mean: Sequence[float]
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return (self.width, self.height)
+
+    def reduce(self) -> "PyramidLevel":
+        """ next level, 2x smaller. Odd last row / column is paired with itself, so edge means stay exact """
+        width = (self.width + 1) // 2
+        height = (self.height + 1) // 2
+        minimum = array("i")
+        maximum = array("i")
+        mean = array("d")
+        for y in range(height):
+            top = y * 2 * self.width
+            bottom = min(y * 2 + 1, self.height - 1) * self.width
+            for source, target, combine in (
+                (self.minimum, minimum, min),
+                (self.maximum, maximum, max),
+                (self.mean, mean, _mean4),
+            ):
+                target.extend(map(combine, *_quads(source, top, bottom, self.width)))
+        return PyramidLevel(width, height, minimum, maximum, mean)
+
+
+def _mean4(a: float, b: float, c: float, d: float) -> float:
+    return (a + b + c + d) / 4
+
+
+def _quads(source: Sequence, top: int, bottom: int, width: int) -> List[Sequence]:
+    rows = []
+    for start in (top, bottom):
+        row = source[start:start + width]
+        even = row[0::2]
+        odd = row[1::2]
+        if len(odd) < len(even):
+            odd = odd + row[-1:]
+        rows.extend((even, odd))
+    return rows
+
+
+class HeightPyramid:
+    """ Multi-resolution view of a heightmap, levels are built on first request """
+
+    def __init__(self, heights: Sequence[int], width: int, height: int):
+        heights = array("i", heights)
+        self.lowest = min(heights) if heights else 0
+        self.highest = max(heights) if heights else 0
+        self.levels = [PyramidLevel(width, height, heights, heights, array("d", heights))]
+
+    def level(self, index: int) -> PyramidLevel:
+        while len(self.levels) <= index:
+            last = self.levels[-1]
+            if last.width == 1 and last.height == 1:
+                return last
+            self.levels.append(last.reduce())
+        return self.levels[index]
+
+    def nearest_level(self, max_width: int, max_height: int) -> PyramidLevel:
+        """ smallest level that is still at least as big as requested size """
+        index = 0
+        while True:
+            current = self.level(index)
+            following = self.level(index + 1)
+            if following is current or following.width < max_width or following.height < max_height:
+                return current
+            index += 1
+
+    def image(self, max_width: int, max_height: int, grades: int = 255) -> Image.Image:
+        """ mean heights fitted into given size (keeping aspect), scaled to 0..grades """
+        level = self.nearest_level(max_width, max_height)
+        height_range = self.highest - self.lowest
+        step = grades / height_range if height_range else 0
+        values = bytes(min(floor(step * (value - self.lowest)), grades) for value in level.mean)
+        image = Image.frombytes("L", level.size, values)
+        image.thumbnail((max_width, max_height))
+        return image
+
+
+_pyramid_cache: "OrderedDict[Tuple[str, int, int], HeightPyramid]" = OrderedDict()
+
+
+def get_pyramid(heights: Sequence[int], width: int, height: int) -> HeightPyramid:
+    """ pyramid of given heights, reused while the same terrain stays in cache """
+    key = (sha1(array("i", heights).tobytes()).hexdigest(), width, height)
+    pyramid = _pyramid_cache.get(key)
+    if pyramid is None:
+        logging.debug(f"Building height pyramid for {width} x {height} map")
+        pyramid = HeightPyramid(heights, width, height)
+        _pyramid_cache[key] = pyramid
+        if len(_pyramid_cache) > PYRAMID_CACHE_SIZE:
+            _pyramid_cache.popitem(last=False)
+    else:
+        _pyramid_cache.move_to_end(key)
+    return pyramid
@@ -0,0 +1,76 @@
+#  ___              _
+# | _ \__ _ _ _  __| |___ _ __  _ _  ___ ______
+# |   / _` | ' \/ _` / _ \ '  \| ' \/ -_|_-<_-<
+# |_|_\__,_|_||_\__,_\___/_|_|_|_||_\___/__/__/
+# Randomness
+import random
+from array import array
+from itertools import repeat
+from typing import List, Optional
+
+BULK_SIZE = 4096
+
+
+class MapperRandom:
+    """ Single random source for entity generation: offsets, rotations, scales, growth and Ids
+
+    Values are drawn in bulk from one `random.Random` instance, so the same seed gives the same map
+    and entity Ids don't cost an os.urandom call each (as uuid.uuid4() does).
+    Without a seed generator is seeded once from system entropy.
+    """
+
+    def __init__(self, seed: Optional[int] = None, bulk_size: int = BULK_SIZE):
+        self.seed = seed
+        self.bulk_size = bulk_size
+        self._random = random.Random(seed)
+        self._floats = array("d")
+        self._float_index = 0
+        self._uuids: List[str] = []
+        self._uuid_index = 0
+
+    @property
+    def is_seeded(self) -> bool:
+        return self.seed is not None
+
+    def random(self) -> float:
+        """ next float in [0.0, 1.0) """
+        if self._float_index >= len(self._floats):
+            self._floats = self.random_array(self.bulk_size)
+            self._float_index = 0
+        value = self._floats[self._float_index]
+        self._float_index += 1
+        return value
+
+    def random_array(self, count: int) -> array:
+        """ `count` floats in [0.0, 1.0) as typed array """
+        rand = self._random.random
+        return array("d", [rand() for _ in repeat(None, count)])
+
+    def shuffle(self, items: list) -> None:
+        """ shuffle list in place (Fisher-Yates), drawing from the same bulk floats """
+        for i in range(len(items) - 1, 0, -1):
+            j = int(self.random() * (i + 1))
+            items[i], items[j] = items[j], items[i]
+
+    def uuid(self) -> str:
+        """ next version 4 UUID string """
+        if self._uuid_index >= len(self._uuids):
+            self._uuids = self.uuid_list(self.bulk_size)
+            self._uuid_index = 0
+        value = self._uuids[self._uuid_index]
+        self._uuid_index += 1
+        return value
+
+    def uuid_list(self, count: int) -> List[str]:
+        """ `count` version 4 UUID strings made from one bulk draw of random bytes """
+        hex_data = self._random.randbytes(16 * count).hex()
+        uuids = []
+        for offset in range(0, 32 * count, 32):
+            h = hex_data[offset:offset + 32]
+            variant = "89ab"[int(h[16], 16) & 3]
+            uuids.append(f"{h[:8]}-{h[8:12]}-4{h[13:16]}-{variant}{h[17:20]}-{h[20:]}")
+        return uuids
+
+
+# used when caller doesn't provide its own generator
+default_random = MapperRandom()
@@ -0,0 +1,195 @@
+#  ___            _   _         _   _
+# / __|_  _ _ _  | |_| |_  ___ | |_(_)__
+# \__ \ || | ' \ |  _| ' \/ -_)|  _| / _|
+# |___/\_, |_||_| \__|_||_\___| \__|_\__|
+#      |__/
+# Synthetic
+import io
+import math
+from array import array
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Tuple
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from ..base import GameDefs
+from ..output import write_atomic
+from .format import INTERNAL_ARC_NAME, iter_map_json
+from .randomness import MapperRandom
+from .treemap import PlantSpecies, TreeSpecies
+
+# maps made before chestnuts and maple syrup were removed, upgrade has most to do on them
+LEGACY_GAME_VERSION = "0.2.8.3-0000000-sw"
+# relative share of templates among entities on dry land, ChestnutTree and Maple need replacement on upgrade
+DEFAULT_TEMPLATE_MIX = {
+    "Birch": 30,
+    "Pine": 20,
+    "Oak": 10,
+    "Maple": 8,
+    "ChestnutTree": 8,
+    "Dandelion": 6,
+    "BlueberryBush": 6,
+    **{f"RuinColumnH{i}": 1 for i in range(1, 9)},
+}
+# chance of a water source on a water tile
+WATER_SOURCE_DENSITY = 0.01
+MIN_HEIGHT = 3
+MAX_HEIGHT = 16
+
+TREES = {species.value[0]: species for species in TreeSpecies}
+PLANTS = {species.value[0]: species for species in PlantSpecies}
+
+
+def synthetic_heights(width: int, height: int, rng: MapperRandom) -> array:
+    """ rolling hills of a few overlapping waves, lowest cells become water """
+    waves = [
+        (rng.random() * 2 * math.pi, rng.random() * 2 * math.pi, 2 + rng.random() * 4, 2 + rng.random() * 4)
+        for _ in range(3)
+    ]
+    heights = array("H")
+    for y in range(height):
+        for x in range(width):
+            value = sum(
+                math.sin(phase_x + frequency_x * x / width * 2 * math.pi)
+                * math.cos(phase_y + frequency_y * y / height * 2 * math.pi)
+                for phase_x, phase_y, frequency_x, frequency_y in waves
+            ) / len(waves)
+            heights.append(round(MIN_HEIGHT + (value + 1) / 2 * (MAX_HEIGHT - MIN_HEIGHT)))
+    return heights
+
+
+def natural_resource(rng: MapperRandom, x: int, y: int, z: int) -> dict:
+    """ components trees and plants share """
+    scale = round(rng.random() * 0.75 + 0.5, 6)
+    return {
+        "BlockObject": {"Coordinates": {"X": x, "Y": y, "Z": z}, "Orientation": {"Value": "Cw0"}},
+        "BuilderJob": {},
+        "CoordinatesOffseter": {"CoordinatesOffset": {"X": rng.random() * 0.25, "Y": rng.random() * 0.25}},
+        "Demolishable": {},
+        "Growable": {"GrowthProgress": 1.0},
+        "NaturalResourceModelRandomizer": {
+            "Rotation": round(rng.random() * 360, 6), "DiameterScale": scale, "HeightScale": scale
+        },
+        "Prioritizable": {"Priority": {"Value": "Normal"}},
+        "LivingNaturalResource": {"IsDead": False},
+        "WateredObject": {"IsDry": False},
+    }
+
+
+def gatherable(components: dict, params: dict, rng: MapperRandom) -> None:
+    if params.get("gth_good"):
+        components["GatherableYieldGrower"] = {"GrowthProgress": round(rng.random(), 2)}
+        components["Yielder:Gatherable"] = {
+            "Yield": {"Good": {"Id": params["gth_good"].value}, "Amount": params["gth_amount"]}
+        }
+
+
+def synthetic_entity(template: str, x: int, y: int, z: int, rng: MapperRandom) -> dict:
+    if template in TREES:
+        params = TREES[template].value[1]
+        components = natural_resource(rng, x, y, z)
+        components["Yielder:Cuttable"] = {"Yield": {"Good": {"Id": "Log"}, "Amount": params["logs"]}}
+        components["Inventory:GoodStack"] = {"Storage": {"Goods": []}}
+        gatherable(components, params, rng)
+    elif template in PLANTS:
+        components = natural_resource(rng, x, y, z)
+        gatherable(components, PLANTS[template].value[1], rng)
+    elif template.startswith("RuinColumnH"):
+        components = {
+            "BlockObject": {"Coordinates": {"X": x, "Y": y, "Z": z}, "Orientation": {"Value": "Cw0"}},
+            "Yielder:Ruin": {"Yield": {"Good": {"Id": "ScrapMetal"}, "Amount": 15 * int(template[len("RuinColumnH"):])}},
+            "DryObject": {"IsDry": True},
+            "RuinModels": {"VariantId": "ABC"[int(rng.random() * 3)]},
+        }
+    elif template == "WaterSource":
+        components = {
+            "BlockObject": {"Coordinates": {"X": x, "Y": y, "Z": z}, "Orientation": {"Value": "Cw0"}},
+            "WaterSource": {"SpecifiedStrength": 1.5, "CurrentStrength": 1.5},
+        }
+    else:
+        components = {"BlockObject": {"Coordinates": {"X": x, "Y": y, "Z": z}}}
+    return {"Id": rng.uuid(), "TemplateName": template, "Components": components}
+
+
+def synthetic_map(
+    width: int,
+    height: int,
+    density: float = 0.3,
+    seed: Optional[int] = None,
+    template_mix: Optional[Mapping[str, float]] = None,
+    game_version: str = LEGACY_GAME_VERSION,
+) -> dict:
+    """ map data like old maps people upgrade: hills, water in the lowest cells and entities of mixed templates
+
+    `density` is the chance of an entity on a dry tile, its template is picked by `template_mix` weights.
+    Water tiles get water sources. The same seed gives the same map.
+    """
+    rng = MapperRandom(seed)
+    heights = synthetic_heights(width, height, rng)
+    water_level = min(heights)
+    depths = [1 if z <= water_level else 0 for z in heights]
+
+    mix = list((template_mix or DEFAULT_TEMPLATE_MIX).items())
+    total_weight = sum(weight for _, weight in mix)
+    cumulative: List[Tuple[float, str]] = []
+    running = 0.0
+    for template, weight in mix:
+        running += weight / total_weight
+        cumulative.append((running, template))
+
+    entities = []
+    for i, z in enumerate(heights):
+        y, x = divmod(i, width)
+        if depths[i]:
+            if rng.random() < WATER_SOURCE_DENSITY:
+                entities.append(synthetic_entity("WaterSource", x, y, z, rng))
+            continue
+        if rng.random() >= density:
+            continue
+        pick = rng.random()
+        template = next((name for bound, name in cumulative if pick < bound), cumulative[-1][1])
+        entities.append(synthetic_entity(template, x, y, z, rng))
+
+    return {
+        "GameVersion": game_version,
+        "Singletons": {
+            "MapSize": {"Size": {"X": width, "Y": height}},
+            "TerrainMap": {"Heights": {"Array": " ".join(map(str, heights))}},
+            "WaterMap": {
+                "WaterDepths": {"Array": " ".join(map(str, depths))},
+                "Outflows": {"Array": " ".join(["0:0:0:0"] * len(heights))},
+            },
+            "SoilMoistureSimulator": {"MoistureLevels": {"Array": " ".join(["0"] * len(heights))}},
+        },
+        "Entities": entities,
+    }
+
+
+def encode_map(data: dict, suffix: str = GameDefs.MAP_SUFFIX.value) -> bytes:
+    """ map data as `.timber` archive or, with '.json' suffix, plain map json """
+    text = "".join(iter_map_json(data)).encode()
+    if suffix.lower() == ".json":
+        return text
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w", ZIP_DEFLATED) as timber_zip:
+        timber_zip.writestr(INTERNAL_ARC_NAME, text)
+    return buffer.getvalue()
+
+
+def write_synthetic_maps(
+    directory: Path,
+    sizes: List[int],
+    densities: List[float],
+    seed: int = 0,
+    suffix: str = GameDefs.MAP_SUFFIX.value,
+) -> Dict[Tuple[int, float], Path]:
+    """ square map of every size and density, named like `synthetic_256_0.3.timber`, existing files are reused """
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = {}
+    for size in sizes:
+        for density in densities:
+            path = directory / f"synthetic_{size}_{density}{suffix}"
+            if not path.exists():
+                # written atomically, so a broken run doesn't leave a half-written map to be reused
+                write_atomic(path, encode_map(synthetic_map(size, size, density, seed), suffix))
+            paths[(size, density)] = path
+    return paths
@@ -0,0 +1,178 @@
+#  _____                   _
+# |_   _|__ _ _ _ _ __ _(_)_ _
+#   | |/ -_) '_| '_/ _` | | ' \
+#   |_|\___|_| |_| \__,_|_|_||_|
+# Terrain Patch
+import logging
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, List, Optional, Sequence, Set, Tuple
+
+from ..conversion import ImageToTimberbornSpec
+from ..image_utils import predict_image_size
+from ..memory import format_float32
+from . import codec
+from .consistency import get_coordinates
+from .format import TimberbornMap, TimberbornMapSize
+from .gamemap import ENTITY_TEMPLATES, Categories
+from .heightmap import (ImageToTimberbornHeightmapLinearConversionSpec, ImageToTimberbornHeightmapSpec, Heightmap,
+                        read_heightmap)
+from .lakes import LakeSpec
+from .noise import is_noise_source, load_layer_image
+from .watermap import solve_moisture_near, water_depths
+
+GROUND_CATEGORIES = (Categories.tree, Categories.plant)
+
+
+@dataclass
+class TerrainPatchReport:
+    changed_heights: int = 0
+    changed_water: int = 0
+    changed_moisture: int = 0
+    snapped: int = 0
+    dropped: int = 0
+
+    def report(self) -> None:
+        logging.info(
+            f"Terrain patch: {self.changed_heights} heights, {self.changed_water} water depths and"
+            f" {self.changed_moisture} moisture levels changed, {self.snapped} entities snapped to new terrain,"
+            f" {self.dropped} dropped"
+        )
+
+
+def layer_path(directory: Path, filename: str) -> str:
+    return filename if is_noise_source(filename) else str(directory / filename)
+
+
+def terrain_source(terrain: Path, config: Any) -> Tuple[ImageToTimberbornHeightmapSpec, Optional[str], Optional[LakeSpec]]:
+    """ heightmap spec, water image and lakes from a spec file, or from height image and CLI options """
+    if terrain.suffix.lower() == ".json":
+        spec = ImageToTimberbornSpec(**codec.loads(terrain.read_bytes()))
+        heightmap_spec = spec.heightmap
+        heightmap_spec.filename = layer_path(terrain.parent, heightmap_spec.filename)
+        water = layer_path(terrain.parent, spec.watermap.filename) if spec.watermap else None
+        return heightmap_spec, water, spec.lakes
+
+    heightmap_spec = ImageToTimberbornHeightmapSpec(
+        filename=str(terrain),
+        linear_conversion=ImageToTimberbornHeightmapLinearConversionSpec(
+            min_height=config.min_elevation, max_height=config.max_elevation
+        ),
+    )
+    lakes = LakeSpec(min_basin_size=config.lake_min_size, water_level=config.lake_level) if config.lakes else None
+    return heightmap_spec, config.water_map, lakes
+
+
+def replace_values(array_dict: dict, indexes: Sequence[int], values: Sequence[str]) -> None:
+    """ set values of string-encoded array at indexes, other values keep their text """
+    tokens = array_dict["Array"].split()
+    for i, value in zip(indexes, values):
+        tokens[i] = value
+    array_dict["Array"] = " ".join(tokens)
+
+
+def patch_terrain_data(data: dict, terrain: Path, config: Any) -> TerrainPatchReport:
+    """ apply new heights (and water if given) to loaded map data in place
+
+    Moisture is solved again only around changed cells. Entities on tiles whose height changed are snapped to
+    the new height if they stood on terrain, trees and plants on tiles that became water are dropped.
+    Everything else, including other entities and their order, is left as it was.
+    """
+    singletons = data["Singletons"]
+    width, height = TimberbornMapSize.load(singletons["MapSize"])["Size"].value
+    report = TerrainPatchReport()
+
+    heightmap_spec, water_filename, lakes = terrain_source(terrain, config)
+    image_size = (width, height) if is_noise_source(heightmap_spec.filename) else \
+        predict_image_size(heightmap_spec.filename, -1, -1)
+    if image_size != (width, height):
+        logging.warning(f"Height image is {image_size[0]} x {image_size[1]}, resizing to map size {width} x {height}")
+    heightmap = read_heightmap(width, height, None, heightmap_spec, config,
+                               map_image=load_layer_image(heightmap_spec.filename, width, height))
+
+    old_heights = array("i", map(int, singletons["TerrainMap"]["Heights"]["Array"].split()))
+    changed = [i for i, (old, new) in enumerate(zip(old_heights, heightmap.data)) if old != new]
+    report.changed_heights = len(changed)
+    replace_values(singletons["TerrainMap"]["Heights"], changed, [str(heightmap.data[i]) for i in changed])
+
+    old_depths = array("f", map(float, singletons["WaterMap"]["WaterDepths"]["Array"].split()))
+    depths: Sequence[float] = old_depths
+    dirty = set(changed)
+    water_image = load_layer_image(water_filename, width, height) if water_filename else None
+    new_depths = water_depths(heightmap, water_filename, Path(), water_image, lakes) if water_filename or lakes else None
+    if new_depths is not None:
+        depths = array("f", new_depths)
+        changed_water = [i for i, (old, new) in enumerate(zip(old_depths, depths)) if old != new]
+        report.changed_water = len(changed_water)
+        replace_values(singletons["WaterMap"]["WaterDepths"], changed_water,
+                       [format_float32(depths[i]) for i in changed_water])
+        dirty.update(changed_water)
+
+    if dirty:
+        water = bytes(1 if depth > 0 else 0 for depth in depths)
+        solved = solve_moisture_near(heightmap.data, water, width, height, dirty)
+        moisture_dict = singletons["SoilMoistureSimulator"]["MoistureLevels"]
+        old_moisture = moisture_dict["Array"].split()
+        indexes = sorted(solved)
+        levels = array("f", [solved[i] for i in indexes])
+        old_levels = array("f", [float(old_moisture[i]) for i in indexes])
+        changed_moisture = [(i, level) for i, level, old in zip(indexes, levels, old_levels) if old != level]
+        report.changed_moisture = len(changed_moisture)
+        replace_values(moisture_dict, [i for i, _ in changed_moisture],
+                       [format_float32(level) for _, level in changed_moisture])
+
+    if dirty:
+        data["Entities"] = snap_entities(data["Entities"], old_heights, heightmap, old_depths, depths, dirty, report)
+    report.report()
+    return report
+
+
+def snap_entities(
+    entities: List[dict],
+    old_heights: Sequence[int],
+    heightmap: Heightmap,
+    old_depths: Sequence[float],
+    depths: Sequence[float],
+    changed: Set[int],
+    report: TerrainPatchReport,
+) -> List[dict]:
+    """ entities on changed tiles snapped to new heights, trees and plants that ended up in water are dropped """
+    width, height = heightmap.width, heightmap.height
+    ground = {name for name, template in ENTITY_TEMPLATES.items() if template["category"] in GROUND_CATEGORIES}
+    dropped = set()
+    for index, entity in enumerate(entities):
+        coordinates = get_coordinates(entity)
+        if coordinates is None:
+            continue
+        x, y, z = coordinates
+        i = x + y * width
+        if not (0 <= x < width and 0 <= y < height) or i not in changed:
+            continue
+        template = entity.get("TemplateName") or entity.get("Template")
+        if template in ground and depths[i] > 0 and not old_depths[i] > 0:
+            dropped.add(index)
+        elif old_heights[i] != heightmap.data[i] and (template in ground or z == old_heights[i]):
+            entity["Components"]["BlockObject"]["Coordinates"]["Z"] = heightmap.data[i]
+            report.snapped += 1
+    report.dropped = len(dropped)
+    if not dropped:
+        return entities
+    return [entity for index, entity in enumerate(entities) if index not in dropped]
+
+
+def patch_terrain(data: dict, config: Any, output_path: Optional[Path] = None) -> Optional[Path]:
+    """ apply height image or spec file from `config.terrain` to `data` and write the result """
+    patch_terrain_data(data, Path(config.terrain), config)
+    timber_map = TimberbornMap(
+        data.pop("GameVersion"),
+        data.pop("Singletons"),
+        data.pop("Entities"),
+        data.pop("TimeStamp", None),
+        MapperVersion=config._mapper_version,
+    )
+    if output_path:
+        timber_path = timber_map.write(output_path, config)
+        print(f"\nSaved to '{timber_path}'")
+        return timber_path
+    return None
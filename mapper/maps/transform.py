@@ -0,0 +1,286 @@
+#  _____                  __
+# |_   _| _ __ _ _ _  ___/ _|___ _ _ _ __
+#   | || '_/ _` | ' \(_-<  _/ _ \ '_| '  \
+#   |_||_| \__,_|_||_/__/_| \___/_| |_|_|_|
+# Transform
+import logging
+import re
+from array import array
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
+
+from .consistency import get_coordinates
+from .format import TimberbornMap, TimberbornMapSize
+
+# values of TimberbornOrientation, clockwise
+ORIENTATIONS = ("Cw0", "Cw90", "Cw180", "Cw270")
+# WaterMap Outflows of a cell with no flow, the game computes flows again from water depths
+NO_OUTFLOW = "0:0:0:0"
+Point = Tuple[int, int]
+
+
+class MapTransform:
+    """ One geometric step, works on cell indexes and coordinates only
+
+    `gather()` gives index of source cell for every cell of the result, row by row, so steps compose into one
+    index array and map arrays are rearranged once. `point()` maps entity tile forward, None drops entity.
+    """
+
+    def size(self, width: int, height: int) -> Tuple[int, int]:
+        return width, height
+
+    def gather(self, width: int, height: int) -> Iterator[int]:
+        raise NotImplementedError
+
+    def point(self, x: int, y: int, width: int, height: int) -> Optional[Point]:
+        raise NotImplementedError
+
+    def orientation(self, value: str) -> str:
+        return value
+
+
+class Crop(MapTransform):
+    def __init__(self, x: int, y: int, width: int, height: int):
+        self.x, self.y, self.width, self.height = x, y, width, height
+
+    def size(self, width: int, height: int) -> Tuple[int, int]:
+        if self.x < 0 or self.y < 0 or self.x + self.width > width or self.y + self.height > height or \
+                self.width < 1 or self.height < 1:
+            raise ValueError(f"Crop {self.width} x {self.height} at ({self.x}, {self.y}) is outside of {width} x {height} map")
+        return self.width, self.height
+
+    def gather(self, width: int, height: int) -> Iterator[int]:
+        for y in range(self.y, self.y + self.height):
+            yield from range(y * width + self.x, y * width + self.x + self.width)
+
+    def point(self, x: int, y: int, width: int, height: int) -> Optional[Point]:
+        x, y = x - self.x, y - self.y
+        return (x, y) if 0 <= x < self.width and 0 <= y < self.height else None
+
+
+class Flip(MapTransform):
+    """ mirror along x (left-right) or y axis """
+
+    def __init__(self, axis: str):
+        if axis not in ("x", "y"):
+            raise ValueError(f"Flip axis must be 'x' or 'y', got '{axis}'")
+        self.axis = axis
+
+    def gather(self, width: int, height: int) -> Iterator[int]:
+        for y in range(height):
+            row = (height - 1 - y if self.axis == "y" else y) * width
+            yield from (range(row + width - 1, row - 1, -1) if self.axis == "x" else range(row, row + width))
+
+    def point(self, x: int, y: int, width: int, height: int) -> Optional[Point]:
+        return (width - 1 - x, y) if self.axis == "x" else (x, height - 1 - y)
+
+    def orientation(self, value: str) -> str:
+        if value not in ORIENTATIONS:
+            return value
+        turns = ORIENTATIONS.index(value)
+        # mirroring negates the angle, along y it's also turned by half
+        return ORIENTATIONS[-turns % 4] if self.axis == "x" else ORIENTATIONS[(2 - turns) % 4]
+
+
+class Rotate(MapTransform):
+    """ clockwise by multiple of 90 degrees, with y axis pointing up like map coordinates """
+
+    def __init__(self, degrees: int):
+        if degrees % 90:
+            raise ValueError(f"Rotation must be a multiple of 90 degrees, got {degrees}")
+        self.turns = degrees // 90 % 4
+
+    def size(self, width: int, height: int) -> Tuple[int, int]:
+        return (height, width) if self.turns % 2 else (width, height)
+
+    def gather(self, width: int, height: int) -> Iterator[int]:
+        new_width, new_height = self.size(width, height)
+        for y in range(new_height):
+            if self.turns == 0:
+                yield from range(y * width, (y + 1) * width)
+            elif self.turns == 1:  # (x, y) -> (y, width - 1 - x)
+                yield from range((width - 1 - y), (width - 1 - y) + width * new_width, width)
+            elif self.turns == 2:
+                row = (height - 1 - y) * width
+                yield from range(row + width - 1, row - 1, -1)
+            else:  # (x, y) -> (height - 1 - y, x)
+                yield from range(y + (height - 1) * width, y - width, -width)
+
+    def point(self, x: int, y: int, width: int, height: int) -> Optional[Point]:
+        if self.turns == 1:
+            return (y, width - 1 - x)
+        if self.turns == 2:
+            return (width - 1 - x, height - 1 - y)
+        if self.turns == 3:
+            return (height - 1 - y, x)
+        return (x, y)
+
+    def orientation(self, value: str) -> str:
+        if value not in ORIENTATIONS:
+            return value
+        return ORIENTATIONS[(ORIENTATIONS.index(value) + self.turns) % 4]
+
+
+class Resample(MapTransform):
+    """ nearest-neighbour scaling, every result cell takes the source cell under its center
+
+    Entities are kept only on source cells that were taken, once, so density of trees stays the same.
+    Heights are not scaled.
+    """
+
+    def __init__(self, width: int, height: int):
+        if width < 1 or height < 1:
+            raise ValueError(f"Can't resample to {width} x {height}")
+        self.width, self.height = width, height
+        self._tables = {}
+
+    def size(self, width: int, height: int) -> Tuple[int, int]:
+        return self.width, self.height
+
+    @staticmethod
+    def samples(source: int, target: int) -> List[int]:
+        return [min(int((i + 0.5) * source / target), source - 1) for i in range(target)]
+
+    def tables(self, width: int, height: int) -> Tuple[List[int], List[int], List[int], List[int]]:
+        """ sampled source column and row of every result one, and first result column and row of source ones """
+        if (width, height) not in self._tables:
+            columns, rows = self.samples(width, self.width), self.samples(height, self.height)
+            first_column, first_row = [-1] * width, [-1] * height
+            for target, source in reversed(list(enumerate(columns))):
+                first_column[source] = target
+            for target, source in reversed(list(enumerate(rows))):
+                first_row[source] = target
+            self._tables[(width, height)] = (columns, rows, first_column, first_row)
+        return self._tables[(width, height)]
+
+    def gather(self, width: int, height: int) -> Iterator[int]:
+        columns, rows, _, _ = self.tables(width, height)
+        for row in rows:
+            base = row * width
+            yield from (base + column for column in columns)
+
+    def point(self, x: int, y: int, width: int, height: int) -> Optional[Point]:
+        _, _, first_column, first_row = self.tables(width, height)
+        new_x, new_y = first_column[x], first_row[y]
+        return (new_x, new_y) if new_x >= 0 and new_y >= 0 else None
+
+
+TRANSFORM_RE = re.compile(r"\s*(crop|flip|rotate|resample)\s*:\s*([^;]+)")
+
+
+def parse_transforms(text: str) -> List[MapTransform]:
+    """ 'crop:0,0,128,128; rotate:90; flip:x; resample:64x64' -> transforms, applied in that order """
+    transforms: List[MapTransform] = []
+    for part in filter(str.strip, text.split(";")):
+        error = ValueError(f"Can't parse transform '{part.strip()}', expected crop:X,Y,W,H, flip:x|y, rotate:DEG"
+                           f" or resample:WxH")
+        match = TRANSFORM_RE.fullmatch(part.strip().lower())
+        if not match:
+            raise error
+        name, args = match.group(1), match.group(2).strip()
+        if name == "crop":
+            values = [int(value) for value in args.split(",")]
+            if len(values) != 4:
+                raise error
+            transforms.append(Crop(*values))
+        elif name == "flip":
+            transforms.append(Flip(args))
+        elif name == "rotate":
+            transforms.append(Rotate(int(args)))
+        else:
+            width, _, height = args.partition("x")
+            transforms.append(Resample(int(width), int(height or width)))
+    return transforms
+
+
+def transform_index(width: int, height: int, transforms: Sequence[MapTransform]) -> Tuple[array, int, int]:
+    """ index of original cell for every cell of the transformed map and its size """
+    index = None
+    for transform in transforms:
+        new_size = transform.size(width, height)  # checks that transform fits the map
+        gathered = array("i", transform.gather(width, height))
+        index = gathered if index is None else array("i", [index[i] for i in gathered])
+        width, height = new_size
+    if index is None:
+        index = array("i", range(width * height))
+    return index, width, height
+
+
+def transform_arrays(node: Any, cells: int, index: array) -> int:
+    """ rearrange every string-encoded array of `cells` values found in singleton data, values keep their text """
+    count = 0
+    if isinstance(node, dict):
+        text = node.get("Array")
+        if isinstance(text, str) and len(node) == 1:
+            tokens = text.split()
+            if len(tokens) == cells:
+                node["Array"] = " ".join([tokens[i] for i in index])
+                return 1
+        for value in node.values():
+            count += transform_arrays(value, cells, index)
+    return count
+
+
+def transform_map_data(data: dict, transforms: Sequence[MapTransform]) -> dict:
+    """ apply transforms to loaded map data in place: per-cell arrays, MapSize and entities
+
+    Entity dicts are only changed in Coordinates and Orientation, entities that end up outside of the map
+    are dropped. Footprint of multi-tile objects is not known, so they are moved by their anchor tile.
+    WaterMap Outflows are flows towards neighbours, they are reset to no flow when the map is turned or
+    mirrored, as directions would be wrong otherwise.
+    """
+    singletons = data["Singletons"]
+    width, height = TimberbornMapSize.load(singletons["MapSize"])["Size"].value
+    index, new_width, new_height = transform_index(width, height, transforms)
+    arrays = transform_arrays(singletons, width * height, index)
+    if any(transform.orientation(value) != value for transform in transforms for value in ORIENTATIONS):
+        outflows = singletons.get("WaterMap", {}).get("Outflows")
+        if isinstance(outflows, dict) and isinstance(outflows.get("Array"), str):
+            outflows["Array"] = " ".join([NO_OUTFLOW] * (new_width * new_height))
+    singletons["MapSize"]["Size"]["X"] = new_width
+    singletons["MapSize"]["Size"]["Y"] = new_height
+
+    entities = []
+    for entity in data["Entities"]:
+        coordinates = get_coordinates(entity)
+        if coordinates is None:
+            entities.append(entity)
+            continue
+        x, y, _ = coordinates
+        point: Optional[Point] = (x, y) if 0 <= x < width and 0 <= y < height else None
+        step_width, step_height = width, height
+        for transform in transforms:
+            if point is None:
+                break
+            point = transform.point(*point, step_width, step_height)
+            step_width, step_height = transform.size(step_width, step_height)
+        if point is None:
+            continue
+        block_object = entity["Components"]["BlockObject"]
+        block_object["Coordinates"]["X"], block_object["Coordinates"]["Y"] = point
+        orientation = block_object.get("Orientation")
+        if isinstance(orientation, dict) and "Value" in orientation:
+            for transform in transforms:
+                orientation["Value"] = transform.orientation(orientation["Value"])
+        entities.append(entity)
+
+    logging.info(f"Transformed {width} x {height} map into {new_width} x {new_height}, {arrays} arrays,"
+                 f" {len(entities)} of {len(data['Entities'])} entities kept")
+    data["Entities"] = entities
+    return data
+
+
+def transform_map(data: dict, config: Any, output_path=None):
+    """ apply transforms from `config.transform` to `data` and write the result """
+    transform_map_data(data, parse_transforms(config.transform))
+    timber_map = TimberbornMap(
+        data.pop("GameVersion"),
+        data.pop("Singletons"),
+        data.pop("Entities"),
+        data.pop("TimeStamp", None),
+        MapperVersion=config._mapper_version,
+    )
+    if output_path:
+        timber_path = timber_map.write(output_path, config)
+        print(f"\nSaved to '{timber_path}'")
+        return timber_path
+    return None
@@ -6,19 +6,20 @@
 # Tree Map
 import logging
 import math
+from array import array
 from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
-from typing import List, Optional
-
-from image_utils import MapImage
-from maps.format import (TimberbornBlockObject, TimberbornCoordinates, TimberbornCoordinatesOffseter, TimberbornEntity,
-                         TimberbornGatherableYieldGrower, TimberbornGrowable, TimberbornLivingNaturalResource,
-                         TimberbornNaturalResourceModelRandomizer, TimberbornOrientation, TimberbornTree,
-                         TimberbornTreeComponents, TimberbornWateredObject, TimberbornYielderCuttable,
-                         TimberbornYielderGatherable)
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
+from ..image_utils import MapImage, load_map_image
+from .format import (TimberbornBlockObject, TimberbornCoordinates, TimberbornCoordinatesOffseter, TimberbornEntity,
+                     TimberbornGatherableYieldGrower, TimberbornGrowable, TimberbornLivingNaturalResource,
+                     TimberbornNaturalResourceModelRandomizer, TimberbornOrientation, TimberbornTree,
+                     TimberbornTreeComponents, TimberbornWateredObject, TimberbornYielderCuttable,
+                     TimberbornYielderGatherable)
 from .heightmap import Heightmap
+from .randomness import MapperRandom, default_random
 from .watermap import WaterMap
 
 
@@ -53,7 +54,7 @@ class Tree:
     alive: bool
     _entity: TimberbornTree = field(default=None, repr=False)
 
-    def as_entity(self, components: dict = {}):
+    def as_entity(self, components: dict = {}, rng: MapperRandom = default_random):
         if not self._entity:
             species_dict = self.species.value[1]
             components_kwargs = {
@@ -61,12 +62,12 @@ class Tree:
                             Coordinates=TimberbornCoordinates(X=self.x, Y=self.y, Z=self.z),
                             Orientation=TimberbornOrientation(),
                         ),
-                "CoordinatesOffseter": components.get("CoordinatesOffseter") or TimberbornCoordinatesOffseter.random(),
+                "CoordinatesOffseter": components.get("CoordinatesOffseter") or TimberbornCoordinatesOffseter.random(rng),
                 "Growable": components.get("Growable") or TimberbornGrowable(1.0),
                 "LivingNaturalResource": TimberbornLivingNaturalResource(IsDead=not self.alive),
                 "NaturalResourceModelRandomizer": (
                     components.get("NaturalResourceModelRandomizer")
-                    or TimberbornNaturalResourceModelRandomizer.random()
+                    or TimberbornNaturalResourceModelRandomizer.random(rng)
                 ),
                 "WateredObject": TimberbornWateredObject(IsDry=not self.alive),
                 "YielderCuttable": TimberbornYielderCuttable(Id=Goods.Log.value, Amount=species_dict['logs']),
@@ -75,7 +76,7 @@ class Tree:
             gatherable_good = species_dict.get('gth_good', None)
             if gatherable_good:
                 components_kwargs.update({
-                    "GatherableYieldGrower": TimberbornGatherableYieldGrower(),  # TODO add growth randomization
+                    "GatherableYieldGrower": TimberbornGatherableYieldGrower(rng=rng),
                     "YielderGatherable": TimberbornYielderGatherable(
                                             Id=gatherable_good.value,
                                             Amount=species_dict.get("gth_amount", 1)
@@ -85,19 +86,63 @@ class Tree:
             self._entity = TimberbornTree(
                 species=self.species.value[0],
                 Components=TimberbornTreeComponents(**components_kwargs),
+                rng=rng,
             )
         # print(repr(self))  # WARNING DEBUG
         return self._entity
 
 
-@dataclass
 class TreeMap:
-    trees: List[Tree]
+    """ Trees kept as typed columns, Tree objects and entities are made on demand """
+    species_list = list(TreeSpecies)
+
+    def __init__(self, trees: Iterable[Tree] = (), rng: MapperRandom = default_random):
+        self.rng = rng
+        self.xs = array("H")
+        self.ys = array("H")
+        self.zs = array("h")
+        self.species_index = bytearray()
+        self.alive = bytearray()
+        for tree in trees:
+            self.add(tree.species, tree.x, tree.y, tree.z, tree.alive)
+
+    def __len__(self) -> int:
+        return len(self.xs)
+
+    def add(self, species: TreeSpecies, x: int, y: int, z: int, alive: bool) -> None:
+        self.xs.append(x)
+        self.ys.append(y)
+        self.zs.append(z)
+        self.species_index.append(self.species_list.index(species))
+        self.alive.append(alive)
+
+    def iter_trees(self) -> Iterator[Tree]:
+        species_list = self.species_list
+        for x, y, z, species, alive in zip(self.xs, self.ys, self.zs, self.species_index, self.alive):
+            yield Tree(species_list[species], x, y, z, bool(alive))
+
+    @property
+    def trees(self) -> List[Tree]:
+        return list(self.iter_trees())
+
+    def iter_entities(self) -> Iterator[TimberbornEntity]:
+        """ entities one by one, nothing is kept after it's consumed """
+        for tree in self.iter_trees():
+            yield tree.as_entity(rng=self.rng)
 
     @property
     def entities(self) -> List[TimberbornEntity]:
-        entities: List[TimberbornEntity] = [tree.as_entity() for tree in self.trees]
-        return entities
+        return list(self.iter_entities())
+
+
+# minimum distance in tiles from other trees in "poisson" placement
+DEFAULT_TREE_SPACING = {
+    TreeSpecies.birch: 1.5,
+    TreeSpecies.pine: 2.0,
+    TreeSpecies.maple: 2.5,
+    TreeSpecies.chestnut: 2.5,
+    TreeSpecies.oak: 3.0,
+}
 
 
 @dataclass
@@ -107,47 +152,140 @@ class ImageToTimberbornTreemapSpec:
     birch_cutoff: float = 0.3
     pine_cutoff: float = 0.45
     chestnut_cutoff: float = 0.6
+    placement: str = "pixel"  # "pixel" - tree on every pixel over treeline, "poisson" - image is density, trees keep spacing
+    spacing: Union[float, Dict[str, float], None] = None  # one value for all or by species name ("Birch", "Oak"...)
+    density: float = 1.0  # multiplier of tree image as probability to place a tree
+    max_slope: int = 2  # poisson placement skips tiles with bigger height difference to a neighbour
 
+    def species_spacing(self, species: TreeSpecies) -> float:
+        if isinstance(self.spacing, (int, float)):
+            return float(self.spacing)
+        if self.spacing and species.value[0] in self.spacing:
+            return float(self.spacing[species.value[0]])
+        return DEFAULT_TREE_SPACING[species]
 
-def read_tree_map(heightmap: Heightmap, water_map: WaterMap, path: Path, spec: Optional[ImageToTimberbornTreemapSpec]):
-    if spec is None:
-        return TreeMap([])
 
-    print("\nReading Treemap")
-    tree_counts = {}
-    filepath = path / spec.filename
+def species_for_pixel(pixel: float, spec: ImageToTimberbornTreemapSpec) -> TreeSpecies:
+    if pixel < spec.birch_cutoff:
+        return TreeSpecies.birch
+    elif pixel < spec.pine_cutoff:
+        return TreeSpecies.pine
+    elif pixel < spec.chestnut_cutoff:  # TODO check specs
+        return TreeSpecies.pine
+    else:
+        return TreeSpecies.oak
+
+
+def pixel_tree_cells(map_image: MapImage, spec: ImageToTimberbornTreemapSpec) -> Iterator[Tuple[int, TreeSpecies]]:
+    """ tree on every pixel above treeline, species by intensity """
+    species = list(TreeSpecies)
+    # 0 is no tree, others are species index + 1, picked once per image intensity
+    classes = map_image.lookup(
+        lambda pixel: species.index(species_for_pixel(pixel, spec)) + 1 if pixel >= spec.treeline_cutoff else 0
+    )
+    if classes is None:
+        return ((i, species_for_pixel(pixel, spec)) for i, pixel in enumerate(map_image.normalized_data)
+                if pixel >= spec.treeline_cutoff)
+    return ((i, species[tree_class - 1]) for i, tree_class in enumerate(classes) if tree_class)
 
-    map_image = MapImage(filepath, heightmap.width, heightmap.height)
-    image = map_image.image
 
-    trees = []
-    for i, pixel in enumerate(map_image.normalized_data):
-        if pixel < spec.treeline_cutoff:
+def is_steep(heights: Sequence[int], i: int, width: int, height: int, max_slope: int) -> bool:
+    y, x = divmod(i, width)
+    z = heights[i]
+    return (
+        (x > 0 and abs(z - heights[i - 1]) > max_slope)
+        or (x < width - 1 and abs(z - heights[i + 1]) > max_slope)
+        or (y > 0 and abs(z - heights[i - width]) > max_slope)
+        or (y < height - 1 and abs(z - heights[i + width]) > max_slope)
+    )
+
+
+def poisson_tree_cells(
+    data: Sequence[float],
+    heightmap: Heightmap,
+    water_map: WaterMap,
+    spec: ImageToTimberbornTreemapSpec,
+    rng: MapperRandom,
+) -> Iterator[Tuple[int, TreeSpecies]]:
+    """ (cell index, species) of trees sampled with tree image as density and minimum spacing between trees
+
+    Dart throwing in random cell order. Placed trees are kept in a uniform grid with buckets as big as the largest
+    spacing, so each candidate checks 3 x 3 buckets and the whole placement is O(n).
+    Two trees keep the larger of their spacings. Water and steep tiles are skipped.
+    """
+    width, height = heightmap.width, heightmap.height
+    spacings = {species: spec.species_spacing(species) for species in TreeSpecies}
+    bucket_size = max(1, math.ceil(max(spacings.values())))
+    grid_width = width // bucket_size + 1
+    grid_height = height // bucket_size + 1
+    grid: List[List[Tuple[int, int, float]]] = [[] for _ in range(grid_width * grid_height)]
+
+    candidates = [
+        i for i, pixel in enumerate(data)
+        if pixel >= spec.treeline_cutoff and not water_map.depths[i] > 0
+        and not is_steep(heightmap.data, i, width, height, spec.max_slope)
+    ]
+    rng.shuffle(candidates)
+
+    for i in candidates:
+        pixel = data[i]
+        if rng.random() >= spec.density * pixel:
+            continue
+        species = species_for_pixel(pixel, spec)
+        spacing = spacings[species]
+        y, x = divmod(i, width)
+        bx, by = x // bucket_size, y // bucket_size
+        if any(
+            (x - ox) ** 2 + (y - oy) ** 2 < max(spacing, other_spacing) ** 2
+            for gy in range(max(by - 1, 0), min(by + 2, grid_height))
+            for gx in range(max(bx - 1, 0), min(bx + 2, grid_width))
+            for ox, oy, other_spacing in grid[gy * grid_width + gx]
+        ):
             continue
+        grid[by * grid_width + bx].append((x, y, spacing))
+        yield i, species
+
 
+def read_tree_map(
+    heightmap: Heightmap,
+    water_map: WaterMap,
+    path: Path,
+    spec: Optional[ImageToTimberbornTreemapSpec],
+    rng: MapperRandom = default_random,
+    map_image: Optional[MapImage] = None,
+):
+    if spec is None:
+        return TreeMap([], rng)
+
+    tree_counts = {}
+    if map_image is None:
+        logging.info("Reading Treemap")
+        map_image = load_map_image(path / spec.filename, heightmap.width, heightmap.height)
+    width, height = map_image.size
+
+    if spec.placement == "poisson":
+        cells = poisson_tree_cells(map_image.normalized_data, heightmap, water_map, spec, rng)
+    else:
+        if spec.placement != "pixel":
+            logging.warning(f"Unknown tree placement '{spec.placement}', using 'pixel'")
+        cells = pixel_tree_cells(map_image, spec)
+
+    tree_map = TreeMap(rng=rng)
+    for i, species in cells:
         z = heightmap.data[i]
-        y = math.floor(i / image.width)
-        x = i - y * image.width
+        y = math.floor(i / width)
+        x = i - y * width
         alive = water_map.moisture[i] > 0
 
-        if pixel < spec.birch_cutoff:
-            species = TreeSpecies.birch
-        elif pixel < spec.pine_cutoff:
-            species = TreeSpecies.pine
-        elif pixel < spec.chestnut_cutoff:  # TODO check specs
-            species = TreeSpecies.pine
-        else:
-            species = TreeSpecies.oak
-
         key = species.value[0]
         if key not in tree_counts.keys():
             tree_counts[key] = 1
         else:
             tree_counts[key] += 1
 
-        trees.append(Tree(species, x, y, z, alive))
+        tree_map.add(species, x, y, z, alive)
 
-    logging.info(f"Made {len(trees)} trees. {100 * len(trees)/(image.width * image.height):.2f}% tree coverage.")
+    logging.info(f"Made {len(tree_map)} trees. {100 * len(tree_map)/(width * height):.2f}% tree coverage.")
     for key, val in tree_counts.items():
         logging.debug(f"- {key: <8}: {val: >6}")
-    return TreeMap(trees)
+    return tree_map
@@ -5,31 +5,74 @@
 #                                      |_|
 # Water Map
 import logging
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dataclasses import dataclass
+from heapq import heapify, heappop, heappush
+from multiprocessing import shared_memory
 from pathlib import Path
 from time import time
-from typing import List, Optional
-
-from image_utils import MapImage
-from maps.format import TimberbornArray, TimberbornSoilMoistureSimulator, TimberbornWaterMap
+from itertools import chain, islice
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
+from ..image_utils import MapImage, load_map_image
+from ..memory import format_float32
+from ..progress import progress
+from .format import TimberbornArray, TimberbornSoilMoistureSimulator, TimberbornWaterMap
 from .heightmap import Heightmap
+from .lakes import LakeSpec, lake_depths
+
+# bits of each byte value, lowest first
+_BYTE_BITS = [tuple((byte >> bit) & 1 for bit in range(8)) for byte in range(256)]
+
+
+class WaterMask:
+    """ Water presence packed as 1 bit per cell, reads as sequence of 0 / 1 depths """
+
+    def __init__(self, values: Iterable[int], size: int):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        for i, value in enumerate(values):
+            if value > 0:
+                self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, index: int) -> int:
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("WaterMask index out of range")
+        return (self.bits[index >> 3] >> (index & 7)) & 1
+
+    def __iter__(self) -> Iterator[int]:
+        return islice(chain.from_iterable(_BYTE_BITS[byte] for byte in self.bits), self.size)
+
+    def to_bytes(self) -> bytes:
+        """ one byte per cell, for kernels that read cells by index """
+        return bytes(self)
 
 
 @dataclass
 class WaterMap:
-    depths: List[float]
-    moisture: List[float]
+    depths: Sequence[float]  # WaterMask when built from an image, float32 array with lakes
+    moisture: Sequence[float]  # float32 array
     width: int
     height: int
 
     @property
     def water_map(self) -> TimberbornWaterMap:
-        return TimberbornWaterMap(TimberbornArray(self.depths), TimberbornArray(["0:0:0:0"] * self.width * self.height))
+        element_str = str if isinstance(self.depths, WaterMask) else format_float32
+        return TimberbornWaterMap(
+            TimberbornArray(self.depths, element_str=element_str),
+            TimberbornArray(["0:0:0:0"] * self.width * self.height),
+        )
 
     @property
     def soil_moisture_simulator(self) -> TimberbornSoilMoistureSimulator:
-        return TimberbornSoilMoistureSimulator(TimberbornArray(self.moisture))
+        return TimberbornSoilMoistureSimulator(TimberbornArray(self.moisture, element_str=format_float32))
 
     def get(self, x: int, y: int) -> int:
         assert x < self.width
@@ -37,79 +80,235 @@ class WaterMap:
         return self.depths[x + y * self.width]
 
 
-def read_water_map(heightmap: Heightmap, filename: Optional[str], path: Optional[Path]) -> Heightmap:
+# cells further than that from water don't get any moisture
+IRRIGATION_REACH = 16
+MOISTURE_TILE_SIZE = 128
+# tiles re-solved around changed cells, small ones keep the solved area close to the change
+PATCH_TILE_SIZE = 32
+# maps smaller than that are solved in-process, starting workers costs more than it saves
+MOISTURE_PARALLEL_MIN_CELLS = 256 * 256
 
-    if filename is None:
-        return WaterMap(
-            [0] * heightmap.width * heightmap.height,
-            [0] * heightmap.width * heightmap.height,
-            heightmap.width,
-            heightmap.height,
-        )
-    else:
-        filepath = path / filename
+# (dx, dy, horizontal distance)
+NEIGHBOURS = tuple(
+    (dx, dy, 1.41 if dx and dy else 1) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy
+)
 
-    print("\nReading Water Map")
-    logging.debug(f"{filepath}")
-    map_image = MapImage(filepath, heightmap.width, heightmap.height)
-    depths = map_image.rounded_normalized_data
-    image = map_image.image
+_worker_shared = {}
+
+
+def irrigation_distances(
+    heights: Sequence[int], water: Sequence[int], width: int, region: Tuple[int, int, int, int]
+) -> Dict[int, float]:
+    """ distances from water for cells of region (x0, y0, x1, y1) that are within irrigation reach
+
+    Multi-source Dijkstra over 8 neighbours. Step cost is 1 (1.41 diagonally) plus 4 per level of height difference,
+    only paths inside region are considered. Values are summed in the same order the original relaxation did it,
+    so results are identical including int/float types.
+    """
+    x0, y0, x1, y1 = region
+    distance = {}
+    for y in range(y0, y1):
+        row = y * width
+        for i in range(row + x0, row + x1):
+            if water[i] > 0:
+                distance[i] = 0
+    queue = [(0, i) for i in distance.keys()]
+    heapify(queue)
+
+    while queue:
+        d, i = heappop(queue)
+        if d > distance[i]:
+            continue  # already reached with a shorter path
+        y, x = divmod(i, width)
+        z = heights[i]
+        for dx, dy, horizontal in NEIGHBOURS:
+            nx = x + dx
+            ny = y + dy
+            if nx < x0 or nx >= x1 or ny < y0 or ny >= y1:
+                continue
+            j = i + dx + dy * width
+            nd = d + horizontal + abs(z - heights[j]) * 4
+            if nd <= IRRIGATION_REACH and nd < distance.get(j, IRRIGATION_REACH + 1):
+                distance[j] = nd
+                heappush(queue, (nd, j))
+    return distance
+
+
+def moisture_from_distance(distance: float) -> float:
+    return max(IRRIGATION_REACH - distance, 0)
+
+
+def empty_moisture(size: int) -> array:
+    return array("f", bytes(4 * size))
 
-    # Generate a soil moisture map from the water map
-    logging.debug("Generating soil moisture map")
-    logging.debug("Make distance array")
-    t = -time()
-    distance: List[List[float]] = []
-    for x in range(image.width):
-        row = []
-        for y in range(image.height):
-            if depths[x + y * image.height] > 0:
-                row.append(0)
-            else:
-                row.append(100)
-        distance.append(row)
-    logging.debug(f"Finished in {t+time():.3} sec.")
 
-    def transfer_value(x: int, y: int, dx: int, dy: int) -> float:
-        if x + dx < 0 or x + dx >= image.height or y + dy < 0 or y + dy >= image.height:
-            return 100
+def solve_moisture(heights: Sequence[int], water: Sequence[int], width: int, height: int) -> array:
+    """ whole-map irrigation solve """
+    distance = irrigation_distances(heights, water, width, (0, 0, width, height))
+    moisture = empty_moisture(width * height)
+    for i, d in distance.items():
+        moisture[i] = moisture_from_distance(d)
+    return moisture
 
-        horizontal = abs(dx) + abs(dy)
-        if horizontal == 2:
-            horizontal = 1.41
 
-        za = heightmap.get(x, y)
-        zb = heightmap.get(x + dx, y + dy)
-        vertical = abs(za - zb) * 4
-        return distance[x + dx][y + dy] + horizontal + vertical
+def solve_moisture_near(
+    heights: Sequence[int], water: Sequence[int], width: int, height: int, cells: Iterable[int],
+    tile_size: int = PATCH_TILE_SIZE,
+) -> Dict[int, float]:
+    """ moisture of every cell whose irrigation may depend on `cells`, for maps changed in a few places
 
-    BAR_LENGHT = 60
-    full_progress = 16 * image.width
-    step = max((full_progress // BAR_LENGHT), 1)
-    current_progress = 0
+    Only paths through a changed cell can change, they are at most IRRIGATION_REACH long, so tiles within that
+    distance of changed cells are solved with a halo like in `solve_moisture_tiled()`. Values are the same as
+    of the whole-map solve, cells of other tiles keep their moisture.
+    """
+    reach = IRRIGATION_REACH
+    columns = (width + tile_size - 1) // tile_size
+    tiles = set()
+    for i in cells:
+        y, x = divmod(i, width)
+        for ty in range(max(y - reach, 0) // tile_size, min(y + reach, height - 1) // tile_size + 1):
+            for tx in range(max(x - reach, 0) // tile_size, min(x + reach, width - 1) // tile_size + 1):
+                tiles.add(ty * columns + tx)
 
+    moisture = {}
+    for tile in sorted(tiles):
+        ty, tx = divmod(tile, columns)
+        x0, y0 = tx * tile_size, ty * tile_size
+        x1, y1 = min(x0 + tile_size, width), min(y0 + tile_size, height)
+        region = (max(x0 - reach, 0), max(y0 - reach, 0), min(x1 + reach, width), min(y1 + reach, height))
+        distance = irrigation_distances(heights, water, width, region)
+        for y in range(y0, y1):
+            for i in range(y * width + x0, y * width + x1):
+                d = distance.get(i)
+                moisture[i] = moisture_from_distance(d) if d is not None else 0
+    logging.debug(f"Solved moisture of {len(tiles)} tiles around {len(moisture)} cells")
+    return moisture
+
+
+def split_tiles(width: int, height: int, tile_size: int = MOISTURE_TILE_SIZE) -> List[Tuple[int, int, int, int]]:
+    return [
+        (x, y, min(x + tile_size, width), min(y + tile_size, height))
+        for y in range(0, height, tile_size) for x in range(0, width, tile_size)
+    ]
+
+
+def _attach_shared(names: Tuple[str, str, str]) -> None:
+    """ worker initializer, attaches to input and output shared buffers once per process """
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    _worker_shared["blocks"] = blocks
+    _worker_shared["heights"] = blocks[0].buf.cast("i")
+    _worker_shared["water"] = blocks[1].buf.cast("B")
+    _worker_shared["distance"] = blocks[2].buf.cast("d")
+
+
+def _solve_tile(tile: Tuple[int, int, int, int], width: int, height: int) -> Tuple[int, int, int, int]:
+    x0, y0, x1, y1 = tile
+    halo = IRRIGATION_REACH
+    region = (max(x0 - halo, 0), max(y0 - halo, 0), min(x1 + halo, width), min(y1 + halo, height))
+    output = _worker_shared["distance"]
+    for i, d in irrigation_distances(_worker_shared["heights"], _worker_shared["water"], width, region).items():
+        y, x = divmod(i, width)
+        if x0 <= x < x1 and y0 <= y < y1:
+            output[i] = d
+    return tile
+
+
+def solve_moisture_tiled(
+    heights: Sequence[int], water: Sequence[int], width: int, height: int, workers: int = 0,
+    tile_size: int = MOISTURE_TILE_SIZE,
+) -> array:
+    """ irrigation solve split into tiles and run by worker processes
+
+    Each tile is solved together with a halo of IRRIGATION_REACH cells, no path that gives moisture can be longer,
+    so stitched result is identical to the whole-map solve. Inputs and output are passed through shared memory.
+    """
+    workers = workers if workers > 0 else (os.cpu_count() or 1)
+    tiles = split_tiles(width, height, tile_size)
+    unreached = float(IRRIGATION_REACH + 1)
+    inputs = (
+        array("i", heights).tobytes(),
+        bytes(1 if depth > 0 else 0 for depth in water),
+        array("d", [unreached]).tobytes() * (width * height),
+    )
+    blocks = []
+    try:
+        for data in inputs:
+            block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+            block.buf[:len(data)] = data
+            blocks.append(block)
+
+        names = tuple(block.name for block in blocks)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_shared, initargs=(names,)) as executor:
+            futures = [executor.submit(_solve_tile, tile, width, height) for tile in tiles]
+            with progress("Solving moisture", len(tiles)) as tiles_progress:
+                for done, future in enumerate(as_completed(futures), 1):
+                    future.result()
+                    tiles_progress.update(done)
+
+        moisture = empty_moisture(width * height)
+        for i, d in enumerate(blocks[2].buf.cast("d")):
+            if d <= IRRIGATION_REACH:
+                moisture[i] = moisture_from_distance(d)
+        return moisture
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def water_depths(
+    heightmap: Heightmap,
+    filename: Optional[str],
+    path: Optional[Path],
+    map_image: Optional[MapImage] = None,
+    lakes: Optional[LakeSpec] = None,
+) -> Optional[Sequence[float]]:
+    """ water from image and lakes, None if there is neither """
+    width, height = heightmap.width, heightmap.height
+    depths: Optional[Sequence[float]] = None
+    if filename is not None:
+        if map_image is None:
+            logging.info("Reading Water Map")
+            filepath = path / filename
+            logging.debug(f"{filepath}")
+            map_image = load_map_image(filepath, width, height)
+        depths = WaterMask(map_image.rounded_normalized_data, width * height)
+
+    if lakes is not None:
+        t = -time()
+        lake_map = lake_depths(heightmap.data, width, height, lakes)
+        logging.debug(f"Filled depressions in {t+time():.3} sec.")
+        if depths is not None:
+            # image marks water 1 deep, lakes may be deeper
+            lake_map = array("f", map(max, lake_map, depths))
+        depths = lake_map
+    return depths
+
+
+def read_water_map(
+    heightmap: Heightmap,
+    filename: Optional[str],
+    path: Optional[Path],
+    workers: int = 1,
+    map_image: Optional[MapImage] = None,
+    lakes: Optional[LakeSpec] = None,
+) -> WaterMap:
+    width, height = heightmap.width, heightmap.height
+    size = width * height
+
+    depths = water_depths(heightmap, filename, path, map_image, lakes)
+    if depths is None:
+        return WaterMap(WaterMask((), size), empty_moisture(size), width, height)
+
+    # Generate a soil moisture map from the water map
     logging.debug("Process irrigation distances")
     t = -time()
-    for i in range(16):
-        for x in range(image.width):
-            for y in range(image.height):
-                min_distance = distance[x][y]
-                for dx in [-1, 0, 1]:
-                    for dy in [-1, 0, 1]:
-                        min_distance = min(min_distance, transfer_value(x, y, dx, dy))
-                distance[x][y] = min_distance
-            if logging.root.level <= logging.INFO:
-                current_progress += 1
-                progress_steps = current_progress // step
-                print(f"\r[{'='*progress_steps:<{BAR_LENGHT}}]", end=' ')
-    if logging.root.level <= logging.INFO:
-        print()  # escape progress bar
+    if workers != 1 and size >= MOISTURE_PARALLEL_MIN_CELLS:
+        logging.debug(f"Solving in tiles of {MOISTURE_TILE_SIZE} with {workers or 'all'} workers")
+        moisture = solve_moisture_tiled(heightmap.data, depths, width, height, workers)
+    else:
+        water = depths.to_bytes() if isinstance(depths, WaterMask) else depths
+        moisture = solve_moisture(heightmap.data, water, width, height)
     logging.debug(f"Finished in {t+time():.3} sec.")
 
-    t = -time()
-    moisture = []
-    for x in range(image.width):
-        for y in range(image.height):
-            moisture.append(max(16 - distance[y][x], 0))
-
-    return WaterMap(depths, moisture, image.size[0], image.size[1])
+    return WaterMap(depths, moisture, width, height)
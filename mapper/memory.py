@@ -0,0 +1,127 @@
+#  __  __
+# |  \/  |___ _ __  ___ _ _ _  _
+# | |\/| / -_) '  \/ _ \ '_| || |
+# |_|  |_\___|_|_|_\___/_|  \_, |
+#                           |__/
+# Memory
+import logging
+import re
+import struct
+import sys
+from array import array
+from typing import Dict, Iterable, Optional
+
+try:
+    import resource
+except ModuleNotFoundError:  # not available on Windows
+    resource = None
+
+# Rough per-unit costs measured on CPython 3.11, used to predict peak usage of the pipeline
+BYTES_PER_IMAGE_PIXEL = 48  # decoded "I" image, resize copy and normalized values of one layer
+BYTES_PER_MOISTURE_CELL = 110  # distance dict and queue entries of irrigation solve
+BYTES_PER_LAYER_CELL = 8  # kept layers: heights, water mask, float32 moisture, tree columns
+BYTES_PER_ENTITY = 5500  # nested component dicts of one generated tree
+BYTES_BASELINE = 40 * 1024 ** 2  # interpreter with Pillow and modules loaded
+
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+class MemoryBudgetError(MemoryError):
+    pass
+
+
+def parse_size(value: str) -> int:
+    """ '512M', '2g', '1048576' -> bytes """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*", str(value), flags=re.I)
+    if not match:
+        raise ValueError(f"Can't parse memory size '{value}', expected number with optional K, M or G suffix")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def format_size(size: int) -> str:
+    return f"{size / 1024 ** 2:.1f} MiB"
+
+
+def peak_rss() -> Optional[int]:
+    """ peak resident memory of this process in bytes, None if platform doesn't tell """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform.startswith("darwin") else usage * 1024  # macOS reports bytes, others KiB
+
+
+class MemoryBudget:
+    """ Predicts memory of pipeline stages and decides if they fit given limit
+
+    Without a limit every check passes, so pipeline can call it unconditionally.
+    """
+
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = limit
+
+    @classmethod
+    def from_config(cls, value) -> "MemoryBudget":
+        if value in (None, "", 0, "0"):
+            return cls()
+        return cls(parse_size(value))
+
+    @property
+    def is_limited(self) -> bool:
+        return self.limit is not None
+
+    def fits(self, estimate: int) -> bool:
+        return self.limit is None or estimate <= self.limit
+
+    def require(self, stage: str, estimate: int) -> None:
+        """ fail fast if stage is expected to exceed the limit """
+        if self.limit is None:
+            return
+        logging.debug(f"Memory estimate for {stage}: {format_size(estimate)} of {format_size(self.limit)}")
+        if estimate > self.limit:
+            raise MemoryBudgetError(
+                f"{stage} is expected to need ~{format_size(estimate)}, which is over the limit of {format_size(self.limit)}."
+                " Reduce map size or raise --max-memory."
+            )
+
+
+def estimate_layers(width: int, height: int) -> int:
+    """ decoding one image layer and solving moisture, with other layers kept in compact form """
+    cells = width * height
+    return BYTES_BASELINE + cells * (BYTES_PER_IMAGE_PIXEL + BYTES_PER_MOISTURE_CELL + BYTES_PER_LAYER_CELL)
+
+
+def estimate_entities(width: int, height: int, entity_count: int, streamed: bool) -> int:
+    cells = width * height
+    entities = BYTES_PER_ENTITY * (1 if streamed else entity_count)
+    return BYTES_BASELINE + cells * BYTES_PER_LAYER_CELL + entities
+
+
+def compact_int_array(values: Iterable[int]) -> array:
+    """ smallest typed array that holds given integers """
+    values = list(values)
+    low = min(values, default=0)
+    high = max(values, default=0)
+    for typecode in ("B", "H", "I") if low >= 0 else ("b", "h", "i"):
+        limit = 1 << (8 * array(typecode).itemsize - (0 if typecode.isupper() else 1))
+        if high < limit and -low <= limit:
+            return array(typecode, values)
+    return array("q", values)
+
+
+_float32_strings: Dict[float, str] = {}
+
+
+def format_float32(value: float) -> str:
+    """ shortest text that reads back as the same float32, integral values are written as int """
+    text = _float32_strings.get(value)
+    if text is None:
+        if value.is_integer():
+            text = str(int(value))
+        else:
+            for precision in range(6, 10):
+                text = f"{value:.{precision}g}"
+                if struct.unpack("f", struct.pack("f", float(text)))[0] == value:
+                    break
+        if len(_float32_strings) < 1 << 16:
+            _float32_strings[value] = text
+    return text
@@ -0,0 +1,173 @@
+#   ___       _             _
+#  / _ \ _  _| |_ _ __ _  _| |_
+# | (_) | || |  _| '_ \ || |  _|
+#  \___/ \_,_|\__| .__/\_,_|\__|
+#                |_|
+# Output
+import hashlib
+import logging
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterable, Iterator, Optional, Union
+from zipfile import BadZipFile, ZipFile
+
+# a lock not touched for that long is left by a killed run, held locks are touched every LOCK_REFRESH_SECONDS
+STALE_LOCK_SECONDS = 600
+LOCK_REFRESH_SECONDS = 60
+LOCK_POLL_SECONDS = 0.2
+# `.timber` archive comment that records what the map was made from
+FINGERPRINT_PREFIX = "mapper-fingerprint:"
+
+
+@contextmanager
+def atomic_output(path: Path, mode: str = "wb") -> Iterator[IO]:
+    """ file object of a unique temporary file next to `path`, renamed over `path` when the block succeeds
+
+    Readers (like the game scanning its maps directory) see either the old file or the complete new one, and
+    concurrent writers never write into the same file. Temporary file is hidden and doesn't end with the suffix
+    of the target, it is removed if the block fails.
+    """
+    while True:
+        temp_name = path.with_name(f".{path.name}.{os.getpid()}-{secrets.token_hex(4)}.part")
+        try:
+            # unlike mkstemp(), permissions of the result follow umask like a plainly written file
+            fd = os.open(temp_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0), 0o666)
+        except FileExistsError:
+            continue
+        break
+    try:
+        with os.fdopen(fd, mode) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_name, path)
+    except BaseException:
+        try:
+            os.unlink(temp_name)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def write_atomic(path: Path, contents: Union[bytes, str]) -> None:
+    with atomic_output(path, "wb" if isinstance(contents, bytes) else "w") as file:
+        file.write(contents)
+
+
+def remove_stale_lock(lock_path: Path) -> None:
+    """ remove lock left by a killed run
+
+    The lock is renamed away first, so of several waiters only one removes it. If it turns out to be fresh,
+    released and taken again after it was found stale, it is put back.
+    """
+    stale_path = lock_path.with_name(f".{lock_path.name}.{os.getpid()}-{secrets.token_hex(4)}.stale")
+    try:
+        os.rename(lock_path, stale_path)
+    except FileNotFoundError:
+        return  # released or taken over by another waiter
+    try:
+        if time.time() - stale_path.stat().st_mtime > STALE_LOCK_SECONDS:
+            logging.warning(f"Taking over stale lock '{lock_path}'")
+        else:
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                pass
+    finally:
+        stale_path.unlink(missing_ok=True)
+
+
+def refresh_lock(lock_path: Path, released: threading.Event) -> None:
+    """ touch held lock until `released`, so a long write isn't taken for a killed run """
+    while not released.wait(LOCK_REFRESH_SECONDS):
+        try:
+            os.utime(lock_path)
+        except FileNotFoundError:
+            logging.warning(f"Lock '{lock_path}' was removed while it was held")
+            return
+
+
+@contextmanager
+def target_lock(path: Path, timeout: Optional[float] = None) -> Iterator[None]:
+    """ hold `<path>.lock` while the block runs, other runs writing the same target wait for it
+
+    Lock file is created exclusively, so it works across processes on any platform. It is touched while held,
+    locks not touched for STALE_LOCK_SECONDS are taken over. `timeout` of None waits without limit.
+    """
+    lock_path = path.with_name(f"{path.name}.lock")
+    deadline = None if timeout is None else time.monotonic() + timeout
+    waiting = False
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                age = time.time() - lock_path.stat().st_mtime
+            except FileNotFoundError:
+                continue  # released in between
+            if age > STALE_LOCK_SECONDS:
+                remove_stale_lock(lock_path)
+                continue
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"'{path}' is locked by another run, lock file: '{lock_path}'")
+            if not waiting:
+                logging.info(f"Waiting for another run writing '{path}'")
+                waiting = True
+            time.sleep(LOCK_POLL_SECONDS)
+            continue
+        with os.fdopen(fd, "w") as file:
+            file.write(str(os.getpid()))
+        break
+    released = threading.Event()
+    refresher = threading.Thread(target=refresh_lock, args=(lock_path, released), daemon=True)
+    refresher.start()
+    try:
+        yield
+    finally:
+        released.set()
+        refresher.join()
+        lock_path.unlink(missing_ok=True)
+
+
+@contextmanager
+def maybe_locked(path: Path, lock: bool, timeout: Optional[float] = None) -> Iterator[None]:
+    if lock:
+        with target_lock(path, timeout):
+            yield
+    else:
+        yield
+
+
+def fingerprint(parts: Iterable[Union[bytes, str]]) -> str:
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 ** 2), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def archive_fingerprint(path: Path) -> Optional[str]:
+    """ fingerprint recorded in `.timber` archive comment, None if there is none or file can't be read """
+    try:
+        with ZipFile(path) as timber_zip:
+            comment = timber_zip.comment.decode("utf-8", "replace")
+    except (OSError, BadZipFile):
+        return None
+    return comment[len(FINGERPRINT_PREFIX):] if comment.startswith(FINGERPRINT_PREFIX) else None
+
+
+def is_up_to_date(path: Path, expected: str) -> bool:
+    """ map at `path` exists and was made from inputs with `expected` fingerprint """
+    return path.exists() and archive_fingerprint(path) == expected
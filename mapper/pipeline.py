@@ -0,0 +1,91 @@
+#  ___ _           _ _
+# | _ (_)_ __  ___| (_)_ _  ___
+# |  _/ | '_ \/ -_) | | ' \/ -_)
+# |_| |_| .__/\___|_|_|_||_\___|
+#       |_|
+# Pipeline
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Sequence
+
+
+@dataclass
+class Stage:
+    name: str
+    function: Callable[..., Any]
+    inputs: Sequence[str] = ()
+    started: float = 0.0
+    finished: float = 0.0
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+
+class StageGraph:
+    """ Small DAG of pipeline stages run on a thread pool
+
+    Each stage function is called with results of its `inputs` stages as positional arguments, as soon
+    as all of them are finished. Image decoding, zlib and worker processes release the GIL, so independent
+    stages overlap. With `workers=1` stages run one by one in the order they were added.
+    """
+
+    def __init__(self, workers: int = 0):
+        self.workers = workers if workers > 0 else min(4, os.cpu_count() or 1)
+        self.stages: Dict[str, Stage] = {}
+        self.results: Dict[str, Any] = {}
+        self._start = 0.0
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.stages
+
+    def add(self, name: str, function: Callable[..., Any], inputs: Sequence[str] = ()) -> None:
+        for input_name in inputs:
+            if input_name not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{input_name}', add stages in dependency order")
+        self.stages[name] = Stage(name, function, tuple(inputs))
+
+    def run(self) -> Dict[str, Any]:
+        """ run all stages, returns results by stage name. First failed stage stops the run and its error is raised """
+        self._start = perf_counter()
+        if self.workers == 1:
+            for stage in self.stages.values():
+                self.results[stage.name] = self._run_stage(stage)
+            return self.results
+
+        waiting: List[Stage] = list(self.stages.values())
+        running: Dict[Future, Stage] = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while waiting or running:
+                for stage in [s for s in waiting if all(i in self.results for i in s.inputs)]:
+                    waiting.remove(stage)
+                    running[executor.submit(self._run_stage, stage)] = stage
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    if future.exception() is not None:
+                        for pending in running:
+                            pending.cancel()
+                        raise future.exception()
+                    self.results[stage.name] = future.result()
+        return self.results
+
+    def _run_stage(self, stage: Stage) -> Any:
+        stage.started = perf_counter() - self._start
+        try:
+            return stage.function(*(self.results[name] for name in stage.inputs))
+        finally:
+            stage.finished = perf_counter() - self._start
+
+    def report_timings(self) -> None:
+        total = sum(stage.duration for stage in self.stages.values())
+        wall = max((stage.finished for stage in self.stages.values()), default=0.0)
+        logging.info("Stage timings (start - end, duration):")
+        for stage in sorted(self.stages.values(), key=lambda s: s.started):
+            logging.info(
+                f"{stage.name: >16}: {stage.started: >6.2f} - {stage.finished: >6.2f} sec. ({stage.duration:.2f} sec.)"
+            )
+        logging.info(f"Stages took {total:.2f} sec. in total, {wall:.2f} sec. of wall time")
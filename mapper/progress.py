@@ -0,0 +1,138 @@
+#  ___
+# | _ \_ _ ___  __ _ _ _ ___ ______
+# |  _/ '_/ _ \/ _` | '_/ -_|_-<_-<
+# |_| |_| \___/\__, |_| \___/__/__/
+#              |___/
+# Progress
+import json
+import sys
+import threading
+from dataclasses import asdict, dataclass
+from time import perf_counter
+from typing import Optional, TextIO
+
+PROGRESS_SINKS = ("bar", "jsonl", "none")
+BAR_LENGTH = 60
+# shortest time between two events of a stage, first and last ones are always sent
+DEFAULT_INTERVAL = 0.2
+# the clock is read at most that many times per stage, other updates are a single comparison
+CHECKS_PER_STAGE = 1000
+
+
+@dataclass
+class ProgressEvent:
+    stage: str
+    done: int
+    total: int
+    elapsed: float
+    finished: bool = False
+
+
+class ProgressSink:
+    """ Receives throttled progress events, this one discards them """
+
+    def emit(self, event: ProgressEvent) -> None:
+        pass
+
+
+class TerminalBar(ProgressSink):
+    """ `[=====     ]` bar redrawn in place, stages running at the same time take turns on the line """
+
+    def __init__(self, stream: Optional[TextIO] = None):
+        self.stream = stream or sys.stderr
+        self.lock = threading.Lock()
+
+    def emit(self, event: ProgressEvent) -> None:
+        filled = BAR_LENGTH * event.done // event.total if event.total else BAR_LENGTH
+        with self.lock:
+            self.stream.write(f"\r{event.stage[:24]: <24} [{'=' * filled:<{BAR_LENGTH}}] {event.done}/{event.total}")
+            if event.finished:
+                self.stream.write("\n")
+            self.stream.flush()
+
+
+class JsonLinesSink(ProgressSink):
+    """ one JSON object per event, like {"stage": "...", "done": 10, "total": 20, "elapsed": 1.5, "finished": false} """
+
+    def __init__(self, stream: Optional[TextIO] = None):
+        self.stream = stream or sys.stderr
+        self.lock = threading.Lock()
+
+    def emit(self, event: ProgressEvent) -> None:
+        line = json.dumps(asdict(event))
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+
+def make_sink(name: str, stream: Optional[TextIO] = None) -> ProgressSink:
+    if name == "bar":
+        return TerminalBar(stream)
+    if name == "jsonl":
+        return JsonLinesSink(stream)
+    return ProgressSink()
+
+
+_sink: ProgressSink = ProgressSink()
+_interval = DEFAULT_INTERVAL
+
+
+def set_sink(sink: ProgressSink, interval: float = DEFAULT_INTERVAL) -> None:
+    """ sink that receives events of all stages started after this call """
+    global _sink, _interval
+    _sink = sink
+    _interval = interval
+
+
+class Progress:
+    """ Progress of one stage, made by `progress()`
+
+    `update(done)` is cheap enough for hot loops: the clock is only read every `total / CHECKS_PER_STAGE` steps
+    and an event is sent at most once per interval. Used as context manager, the final event is sent on exit.
+    """
+
+    def __init__(self, stage: str, total: int, sink: ProgressSink, interval: float):
+        self.stage = stage
+        self.total = total
+        self.sink = sink
+        self.interval = interval
+        self.done = 0
+        self._start = perf_counter()
+        self._stride = max(1, total // CHECKS_PER_STAGE)
+        if type(sink) is ProgressSink:
+            self._check_at = float("inf")  # nothing to report to
+        else:
+            self._check_at = self._stride
+            self._emit_at = self._start + interval
+            sink.emit(self._event())
+
+    def _event(self, finished: bool = False) -> ProgressEvent:
+        return ProgressEvent(self.stage, self.done, self.total, round(perf_counter() - self._start, 3), finished)
+
+    def update(self, done: int) -> None:
+        self.done = done
+        if done < self._check_at:
+            return
+        self._check_at = done + self._stride
+        now = perf_counter()
+        if now >= self._emit_at:
+            self._emit_at = now + self.interval
+            self.sink.emit(self._event())
+
+    def advance(self, count: int = 1) -> None:
+        self.update(self.done + count)
+
+    def close(self) -> None:
+        if self._check_at != float("inf"):
+            self._check_at = float("inf")
+            self.sink.emit(self._event(finished=True))
+
+    def __enter__(self) -> "Progress":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def progress(stage: str, total: int) -> Progress:
+    return Progress(stage, total, _sink, _interval)
@@ -0,0 +1,130 @@
+#  ___              _
+# / __| ___ ______ (_)___ _ _
+# \__ \/ -_|_-<_-< | / _ \ ' \
+# |___/\___/__/__/ |_\___/_||_|
+# Session
+import logging
+from time import perf_counter
+from typing import Any, Optional
+
+from .base import Action, ActionHandler
+from .maps.consistency import EntityReport, check_entities
+from .maps.format import TimberbornMap, TimberbornSingletons
+from .maps.gamemap import Terrain, ascii_preview, ground_templates, load_singletons, load_terrain, upgrade_game_map
+
+# actions that change map data they are given, they get a copy so the loaded map stays as it was read
+FORKING_ACTIONS = {"apply-patch", "patch-terrain", "transform-map", "upgrade-map"}
+
+
+def fork_map_data(data: dict) -> dict:
+    """ copy of map data that actions may change
+
+    Singletons are copied as a whole, their array strings are shared. Entities are copied down to the BlockObject
+    Coordinates and Orientation, which actions move, snap and turn, other components are shared and only read.
+    """
+    def copy_dicts(node: Any) -> Any:
+        return {key: copy_dicts(value) for key, value in node.items()} if isinstance(node, dict) else node
+
+    entities = []
+    for entity in data.get("Entities", []):
+        entity = dict(entity)
+        components = entity.get("Components")
+        if isinstance(components, dict) and isinstance(components.get("BlockObject"), dict):
+            entity["Components"] = components = dict(components)
+            components["BlockObject"] = block_object = dict(components["BlockObject"])
+            for key in ("Coordinates", "Orientation"):
+                if isinstance(block_object.get(key), dict):
+                    block_object[key] = dict(block_object[key])
+        entities.append(entity)
+
+    forked = dict(data)
+    forked["Singletons"] = copy_dicts(data["Singletons"])
+    forked["Entities"] = entities
+    return forked
+
+
+class MapSession:
+    """ Parsed map kept in memory while actions are picked one after another
+
+    What actions derive from the map (terrain, loaded singletons, entity check, upgraded map) is made once and
+    reused by later actions, so only the first action on a large map waits for it.
+    """
+
+    def __init__(self, data: dict, config: Any):
+        self.data = data
+        self.config = config
+        self._terrain: Optional[Terrain] = None
+        self._singletons: Optional[TimberbornSingletons] = None
+        self._consistency: Optional[EntityReport] = None
+        self._upgraded: Optional[TimberbornMap] = None
+
+    @property
+    def terrain(self) -> Terrain:
+        if self._terrain is None:
+            if self._singletons is not None:
+                self._terrain = (self._singletons["TerrainMap"]["Heights"].array_list,
+                                 self._singletons["MapSize"]["Size"].value)
+            else:
+                self._terrain = load_terrain(self.data)
+        return self._terrain
+
+    @property
+    def singletons(self) -> TimberbornSingletons:
+        if self._singletons is None:
+            self._singletons = load_singletons(self.data["Singletons"])
+        return self._singletons
+
+    @property
+    def consistency(self) -> EntityReport:
+        if self._consistency is None:
+            heights, map_size = self.terrain
+            self._consistency = check_entities(self.data["Entities"], heights, map_size, ground_templates())
+        return self._consistency
+
+    def upgraded(self) -> TimberbornMap:
+        """ map upgraded with session config, made on first call """
+        if self._upgraded is None:
+            self._upgraded = upgrade_game_map(fork_map_data(self.data), self.config, self.singletons, self.consistency)
+        else:
+            logging.info("Map was upgraded earlier in this session, reusing it")
+        return self._upgraded
+
+    def preview(self, *_: Any) -> None:
+        answer = input(f"Preview size in cells, 0 to fit terminal [{self.config.preview_size}]: ").strip()
+        size = int(answer) if answer.isdigit() else self.config.preview_size
+        ascii_preview(self.data, self.config, resize_to_max=size, terrain=self.terrain)
+
+    def upgrade(self, *_: Any, output_path=None) -> None:
+        timber_map = self.upgraded()
+        if output_path:
+            timber_path = timber_map.write(output_path, self.config)
+            print(f"\nSaved to '{timber_path}'\nIt's HIGHLY recommended you open map in in-game editor and re-save it.")
+
+    def run_action(self, action: Action) -> Any:
+        """ run action on session map instead of the map it was made with """
+        if action.code == "map-ascii":
+            return self.preview()
+        if action.code == "upgrade-map":
+            return self.upgrade(**action.kwargs)
+        args = list(action.args)
+        if args and args[0] is self.data:
+            args[0] = fork_map_data(self.data) if action.code in FORKING_ACTIONS else self.data
+        if action.code == "export-terrain":
+            return action.function(*args, terrain=self.terrain, **action.kwargs)
+        return action.function(*args, **action.kwargs)
+
+    def run(self, action_handler: ActionHandler) -> None:
+        """ pick and run actions until user quits, failed action is reported and the map stays loaded """
+        while True:
+            action_handler.render_choices()
+            action = action_handler.get_action(action_handler.select_by_input())
+            if action.code == "quit":
+                action.function(*action.args)
+            start = perf_counter()
+            try:
+                self.run_action(action)
+            except (KeyboardInterrupt, Exception) as exc:
+                logging.error(f"Action '{action.code}' failed: {type(exc).__name__}: {exc}")
+            else:
+                logging.info(f"'{action.code}' took {perf_counter() - start:.2f} sec.")
+            print()
@@ -0,0 +1,70 @@
+#  ___
+# / __|_ __ _____ ___ _ __
+# \__ \ V  V / -_) -_) '_ \
+# |___/\_/\_/\___\___| .__/
+#                    |_|
+# Sweep
+import itertools
+from typing import Any, Iterator, List, Tuple
+
+# parameters that take a list as a single value, they are swept only when given a list of lists
+LIST_PARAMETERS = {"weights"}
+
+ParameterPath = Tuple[str, ...]
+
+
+def is_axis(key: str, value: Any) -> bool:
+    if not isinstance(value, list):
+        return False
+    if key in LIST_PARAMETERS:
+        return bool(value) and all(isinstance(item, list) for item in value)
+    return True
+
+
+def find_axes(specdict: dict, prefix: ParameterPath = ()) -> Iterator[Tuple[ParameterPath, list]]:
+    """ (path, values) of every list-valued parameter in spec """
+    for key, value in specdict.items():
+        if isinstance(value, dict):
+            yield from find_axes(value, prefix + (key,))
+        elif is_axis(key, value):
+            yield prefix + (key,), value
+
+
+def is_sweep(specdict: dict) -> bool:
+    return any(True for _ in find_axes(specdict))
+
+
+def set_parameter(specdict: dict, path: ParameterPath, value: Any) -> dict:
+    """ copy of spec with one parameter replaced, untouched branches are shared """
+    updated = dict(specdict)
+    if len(path) == 1:
+        updated[path[0]] = value
+    else:
+        updated[path[0]] = set_parameter(specdict[path[0]], path[1:], value)
+    return updated
+
+
+def format_value(value: Any) -> str:
+    if isinstance(value, list):
+        return "-".join(format_value(item) for item in value)
+    return str(value).replace("/", "-").replace("\\", "-").replace(":", "-")
+
+
+def expand_sweep(specdict: dict) -> List[Tuple[str, dict]]:
+    """ spec with list-valued parameters -> (name suffix, plain spec) for each combination of values
+
+    Suffix is made of swept parameter names and values, like 'width-128_min_height-3'.
+    """
+    axes = list(find_axes(specdict))
+    if not axes:
+        return [("", specdict)]
+
+    variants = []
+    for values in itertools.product(*(axis_values for _, axis_values in axes)):
+        variant = specdict
+        suffix = []
+        for (path, _), value in zip(axes, values):
+            variant = set_parameter(variant, path, value)
+            suffix.append(f"{path[-1]}-{format_value(value)}")
+        variants.append(("_".join(suffix), variant))
+    return variants
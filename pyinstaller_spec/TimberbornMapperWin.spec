@@ -1,4 +1,5 @@
 # -*- mode: python ; coding: utf-8 -*-
+from PyInstaller.utils.hooks import collect_submodules
 
 
 block_cipher = None
@@ -6,10 +7,10 @@ block_cipher = None
 
 a = Analysis(
     ['C:\\Storage\\devel\\timberbornmapper\\mapper\\__main__.py'],
-    pathex=['C:\\Storage\\devel\\timberbornmapper\\mapper\\', 'C:\\Storage\\devel\\timberbornmapper\\mapper\\maps\\'],
+    pathex=['C:\\Storage\\devel\\timberbornmapper\\'],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    hiddenimports=collect_submodules('mapper'),
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -1,15 +1,16 @@
 # -*- mode: python ; coding: utf-8 -*-
+from PyInstaller.utils.hooks import collect_submodules
 
 
 block_cipher = None
 
 
 a = Analysis(
-    ['mapper\\__main__.py', 'mapper\\base.py', 'mapper\\image_utils.py'],
-    pathex=['mapper\\', 'mapper\\maps\\'],
+    ['mapper\\__main__.py'],
+    pathex=['.'],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    hiddenimports=collect_submodules('mapper'),
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],